@@ -24,11 +24,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
 get_ipython().run_line_magic('matplotlib', 'inline')
 
 import lsst.afw.geom as afw_geom
 import lsst.afw.cameraGeom as cameraGeom
 import lsst.daf.persistence as dp
+from stackclub.footprints import load_footprints, pixel_to_sky
+from stackclub.opsim import focal_planes
+from stackclub.skyplot import plot_polygons
 # The lsst_sims code issues some ignorable warnings regarding ids used for querying the object
 # databases.
 
@@ -83,7 +87,28 @@ def make_patch(vertexList, wcs=None):
 # In[ ]:
 
 
-def plot_skymap_tract(skyMap, tract=0, title=None, ax=None):
+def label_patches_in_view(ax):
+    """
+    Label the patches within the axes limits, if there are no more than `max_labels` of them.
+    
+    This is called whenever the axes limits change, so that the patch labels appear
+    as you zoom in to a few tracts, and disappear again as you zoom out.
+    """
+    info = ax._patch_labels
+    for text in info['texts']:
+        text.remove()
+    info['texts'] = []
+    ra, dec = np.concatenate(info['ra']), np.concatenate(info['dec'])
+    x0, x1 = sorted(ax.get_xlim())
+    y0, y1 = sorted(ax.get_ylim())
+    inview = np.flatnonzero((ra >= x0) & (ra <= x1) & (dec >= y0) & (dec <= y1))
+    if len(inview) <= info['max_labels']:
+        names = [name for names in info['names'] for name in names]
+        info['texts'] = [ax.text(ra[i], dec[i], names[i], size=6, ha="center", va="center")
+                         for i in inview]
+
+
+def plot_skymap_tract(skyMap, tract=0, title=None, ax=None, labels='auto', max_labels=100):
     """
     Plot a tract from a skyMap.
     
@@ -97,6 +122,12 @@ def plot_skymap_tract(skyMap, tract=0, title=None, ax=None):
         Title of the tract plot.  If None, the use `tract <id>`.
     ax: matplotlib.axes._subplots.AxesSubplot [None]
         The subplot object to contain the tract plot.  If None, then make a new one.
+    labels: str ['auto']
+        Which labels to draw: 'patches' for the tract id and all the patch indices,
+        'tracts' for just the tract id, None for no labels, or 'auto' for the tract id,
+        plus the patch indices whenever no more than `max_labels` patches are in view.
+    max_labels: int [100]
+        The most patch labels to draw with labels='auto'.
 
     Returns
     -------
@@ -106,7 +137,6 @@ def plot_skymap_tract(skyMap, tract=0, title=None, ax=None):
         title = 'tract {}'.format(tract)
     tractInfo = skyMap[tract]
     tractBox = afw_geom.Box2D(tractInfo.getBBox())
-    tractPosList = tractBox.getCorners()
     wcs = tractInfo.getWcs()
     xNum, yNum = tractInfo.getNumPatches()
 
@@ -114,27 +144,43 @@ def plot_skymap_tract(skyMap, tract=0, title=None, ax=None):
         fig = plt.figure(figsize=(12,8))
         ax = fig.add_subplot(111)
 
-    tract_center = wcs.pixelToSky(tractBox.getCenter())                      .getPosition(afw_geom.degrees)
-    ax.text(tract_center[0], tract_center[1], '%d' % tract, size=16,
-            ha="center", va="center", color='blue')
-    for x in range(xNum):
-        for y in range(yNum):
-            patchInfo = tractInfo.getPatchInfo([x, y])
-            patchBox = afw_geom.Box2D(patchInfo.getOuterBBox())
-            pixelPatchList = patchBox.getCorners()
-            path = make_patch(pixelPatchList, wcs)
-            patch = patches.PathPatch(path, alpha=0.1, lw=1)
-            ax.add_patch(patch)
-            center = wcs.pixelToSky(patchBox.getCenter())                        .getPosition(afw_geom.degrees)
-            ax.text(center[0], center[1], '%d,%d'%(x,y), size=6,
-                    ha="center", va="center")
-
-    skyPosList = [wcs.pixelToSky(pos).getPosition(afw_geom.degrees)
-                  for pos in tractPosList]
-    ax.set_xlim(max(coord[0] for coord in skyPosList) + 1,
-                min(coord[0] for coord in skyPosList) - 1)
-    ax.set_ylim(min(coord[1] for coord in skyPosList) - 1,
-                max(coord[1] for coord in skyPosList) + 1)
+    # Gather the corners and centers of all the patches, and of the tract, so that
+    # we can transform them to the sky with one WCS call:
+    indices = [(x, y) for x in range(xNum) for y in range(yNum)]
+    patchBoxes = [afw_geom.Box2D(tractInfo.getPatchInfo([x, y]).getOuterBBox())
+                  for x, y in indices]
+    points = [pos for patchBox in patchBoxes for pos in patchBox.getCorners()]
+    points += [patchBox.getCenter() for patchBox in patchBoxes]
+    points += list(tractBox.getCorners()) + [tractBox.getCenter()]
+    ra, dec = pixel_to_sky(wcs, np.array([pos.getX() for pos in points]),
+                           np.array([pos.getY() for pos in points]))
+    n = len(patchBoxes)
+    corners = np.stack([ra[:4*n], dec[:4*n]], axis=-1).reshape(n, 4, 2)
+    center_ra, center_dec = ra[4*n:5*n], dec[4*n:5*n]
+    tract_ra, tract_dec = ra[5*n:5*n+4], dec[5*n:5*n+4]
+
+    # One collection for all the patches is much quicker to make and draw than a
+    # PathPatch for each one:
+    ax.add_collection(PolyCollection(corners, alpha=0.1, lw=1))
+    if labels is not None:
+        ax.text(ra[-1], dec[-1], '%d' % tract, size=16,
+                ha="center", va="center", color='blue')
+    names = ['%d,%d' % index for index in indices]
+    if labels == 'patches':
+        for x, y, name in zip(center_ra, center_dec, names):
+            ax.text(x, y, name, size=6, ha="center", va="center")
+    elif labels == 'auto':
+        if not hasattr(ax, '_patch_labels'):
+            ax._patch_labels = {'ra': [], 'dec': [], 'names': [], 'texts': [], 'max_labels': max_labels}
+            ax.callbacks.connect('xlim_changed', label_patches_in_view)
+            ax.callbacks.connect('ylim_changed', label_patches_in_view)
+        ax._patch_labels['ra'].append(center_ra)
+        ax._patch_labels['dec'].append(center_dec)
+        ax._patch_labels['names'].append(names)
+        ax._patch_labels['max_labels'] = max_labels
+
+    ax.set_xlim(tract_ra.max() + 1, tract_ra.min() - 1)
+    ax.set_ylim(tract_dec.min() - 1, tract_dec.max() + 1)
     ax.grid(ls=':',color='gray')
     ax.set_xlabel("RA (deg.)")
     ax.set_ylabel("Dec (deg.)")
@@ -142,20 +188,21 @@ def plot_skymap_tract(skyMap, tract=0, title=None, ax=None):
     return ax
 
 
-# The following function loops over the available calexps as returned by the data butler to determine which CCDs to draw.  Unfortunately, looping over those calexps using the butler is rather slow, but would be necessary if we wanted to access CCD-level information, like the PSF, from the calexps.
-# We include this function here for your edification, but then provide a faster function below.
+# The following function uses the calexps available from the data butler to determine which CCDs to draw.  Reading whole calexps is rather slow, and would only be necessary if we wanted to access CCD-level information, like the PSF, so `stackclub.footprints.load_footprints` just reads the bounding box and WCS of each one, from the FITS headers, for all the CCDs in parallel.
+# We also provide a function below that does not need the calexps at all.
 
 # In[ ]:
 
 
-def plot_focal_plane(butler, visit, ax, color='red'):
+def plot_focal_plane(butler, visit, ax, color='red', repo=None):
     """
     Plot the CCDs in the LSST focal plane using the coordinate information in the calexps.
     
     Notes
     -----
     By looping over the available calexps, we only plot the CCDs for which image data
-    are available.
+    are available.  Only the bounding box and WCS of each calexp are read (for all the 
+    CCDs at once, given the repo), and the results are cached for each visit.
     
     Parameters
     ----------
@@ -167,30 +214,30 @@ def plot_focal_plane(butler, visit, ax, color='red'):
         The matplotlib subplot object onto which to plot the focal plane.
     color: str ['red']
         Color to use for plotting the individual CCDs.
+    repo: str [None]
+        Path to the butler's repo. If given, the calexps are read in parallel, each thread
+        with its own butler (one butler can't be shared between threads).
         
     Returns
     -------
     matplotlib.axes._subplots.AxesSubplot: The subplot object used for plotting.
     """
-    # We use the `subset` method to obtain all of the `datarefs` (i.e., references to calexp
-    # data in this case) that satisfy an "incomplete" dataId.   For visit-level calexp data,
-    # a unique dataset would specify visit, raft, and sensor.  If we just give the visit, then
-    # references to the available data for all of the CCDs would be returned.
-    dataId = dict(visit=visit)
-    datarefs = list(butler.subset('calexp', dataId=dataid))
-    for i, dataref in enumerate(datarefs):
-        calexp = dataref.get('calexp')
-        # We're not going to do anything with it here, but we can get the PSF from the calexp
-        # like this:
-        # psf = calexp.getPsf()
-        # and we can get the zero-point (in ADU) like this
-        # zero_point = calexp.getCalib().getFluxMag0()
-        ccd_box = afw_geom.Box2D(calexp.getBBox())
-        wcs = calexp.getWcs()
-        path = make_patch(ccd_box.getCorners(), wcs)
-        ccd = patches.PathPatch(path, alpha=0.2, lw=1, color=color)
-        ax.add_patch(ccd)
-        center = wcs.pixelToSky(ccd_box.getCenter()).getPosition(afw_geom.degrees)
+    # load_footprints uses the `subset` method to obtain all of the `datarefs` (i.e., references
+    # to calexp data in this case) that satisfy an "incomplete" dataId.   For visit-level calexp
+    # data, a unique dataset would specify visit, raft, and sensor.  If we just give the visit,
+    # then references to the available data for all of the CCDs are returned.  For each one, it
+    # then asks the butler for just the `calexp_bbox` and `calexp_wcs`, which come from the FITS
+    # headers, rather than the whole calexp.
+    footprints = load_footprints(butler, visit, repo=repo)
+    # We're not going to do anything with them here, but if we wanted CCD-level information
+    # we would need the full calexps, e.g.
+    # calexp = butler.get('calexp', dataId=footprints['dataIds'][0])
+    # Then we can get the PSF from the calexp like this:
+    # psf = calexp.getPsf()
+    # and we can get the zero-point (in ADU) like this
+    # zero_point = calexp.getCalib().getFluxMag0()
+    corners = np.stack([footprints['ra'], footprints['dec']], axis=-1)
+    ax.add_collection(PolyCollection(corners, alpha=0.2, lw=1, color=color))
     return ax
 
 
@@ -282,6 +329,53 @@ def plot_focal_plane_fast(butler, visit, ax, color='red', opsimdb=None):
     return ax
 
 
+# To plot the focal planes of many visits, e.g. to see the cadence or coverage of a whole run, the following batch version of `plot_focal_plane_fast` does the work for all the visits at once.  It does not need the lsst_sims code, since it projects the CCD corners onto the sky itself.
+
+# In[ ]:
+
+
+def plot_focal_planes(butler, visits, ax, color='red', opsimdb=None, max_polygons=5000):
+    """
+    Plot the CCDs in the LSST focal plane for many visits at once, using the pointing info
+    in the OpSim db.
+    
+    Notes
+    -----
+    Like `plot_focal_plane_fast`, this only plots the CCDs whose calexps are on disk, but the 
+    pointings of all the visits come from one database query, the CCD corners for all the visits
+    are computed together (see `stackclub.opsim.focal_planes`), and each visit's calexp folder 
+    is only listed once.  Above `max_polygons` CCDs, an image of the number of CCDs covering 
+    each point on the sky is plotted instead of their outlines.
+
+    Parameters
+    ----------
+    butler: lsst.daf.persistence.Butler
+        The data butler serving up data from the desired repo.
+    visits: list of ints
+        The visit or obsHistID numbers.
+    ax: matplotlib.axes._subplots.AxesSubplot
+        The matplotlib subplot object onto which to plot the focal planes.
+    color: str ['red']
+        Color to use for plotting the individual CCDs.
+    opsimDb: str [None]
+        Filename of the OpSim sqlite database.  If None, then the dithered opsim db for Run1.1p
+        is used.
+    max_polygons: int [5000]
+        The most CCDs to plot individually.
+
+    Returns
+    -------
+    matplotlib.axes._subplots.AxesSubplot: The subplot object used for plotting.
+    """
+    if opsimdb is None:
+        opsimdb = '/global/projecta/projectdirs/lsst/groups/SSim/DC2/minion_1016_desc_dithered_v4.db'
+    footprints = focal_planes(butler, visits, opsimdb)
+    available = footprints['available']
+    plot_polygons(footprints['ra'][available], footprints['dec'][available], ax=ax,
+                  max_polygons=max_polygons, fill=True, color=color, alpha=0.2, lw=1)
+    return ax
+
+
 # The following function just plots the boundaries of the Run1.1p regions as described in the [Run 1.1p Specifications document](https://docs.google.com/document/d/1aQOPL9smeDlhtlwDrp39Zuu2q8DKivDaHLQX3_omwOI/edit).
 
 # In[ ]:
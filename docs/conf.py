@@ -3,10 +3,10 @@ import os
 import sphinx_rtd_theme
 
 # Provide path to the python modules we want to run autodoc on
-sys.path.insert(0, os.path.abspath('../stackclub'))
+sys.path.insert(0, os.path.abspath('..'))
 # Avoid imports that may be unsatisfied when running sphinx, see:
 # http://stackoverflow.com/questions/15889621/sphinx-how-to-exclude-imports-in-automodule#15912502
-autodoc_mock_imports = ["nbformat", "IPython", "IPython.core.interactiveshell"]
+autodoc_mock_imports = ["nbformat", "IPython", "IPython.core.interactiveshell", "numpy", "lsst"]
 
 extensions = [
     'sphinx.ext.autodoc',
@@ -1,4 +1,45 @@
-from .where_is import *
-from .wimport import *
+"""
+Utilities for use in e.g. the Stack Club LSST tutorial notebooks.
+
+Importing ``stackclub`` is meant to be quick: only the notebook import hook
+(:mod:`stackclub.nbimport`) is set up straight away, and the other modules -
+along with IPython, numpy, urllib and the rest of their dependencies - are
+only imported when one of their functions or classes is first used, e.g.
+``stackclub.Taster`` or ``stackclub.wimport``.
+"""
+import types, importlib
+
+# Importing this registers the notebook finder, so that "import Notebook" works:
 from .nbimport import *
-from .taster import *
\ No newline at end of file
+from . import nbimport as _nbimport
+
+# The other public names, and the modules they live in:
+_lazy = {
+    'where_is': 'where_is',
+    'wimport': 'wimport',
+    'wimport_many': 'wimport',
+    'Taster': 'taster',
+    'CachingButler': 'butlercache',
+    'Tracer': 'tracer',
+    'SpatialIndex': 'spatial',
+    'TilePyramid': 'tiles',
+}
+
+# What "from stackclub import *" gives you (which imports the lazy modules):
+__all__ = sorted({name for name, value in vars(_nbimport).items()
+                  if not name.startswith('_') and not isinstance(value, types.ModuleType)} | set(_lazy))
+
+def __getattr__(name):
+    if name in _lazy:
+        module = importlib.import_module('.' + _lazy[name], __name__)
+        # Importing the module set it as an attribute of the package, which
+        # for where_is and wimport we want to be the function instead - so
+        # bind all the names from this module now:
+        for other in _lazy:
+            if _lazy[other] == _lazy[name]:
+                globals()[other] = getattr(module, other)
+        return globals()[name]
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
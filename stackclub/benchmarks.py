@@ -0,0 +1,303 @@
+"""
+Performance benchmarks for the ``stackclub`` package.
+
+Run them all with::
+
+    python -m stackclub.benchmarks
+
+Each benchmark returns a dictionary of timings (in seconds) and other numbers,
+so that they can be tracked over time; the ``check_*`` functions raise an
+``AssertionError`` if a performance regression is detected. The benchmarks of
+the code that talks to a Butler use a :class:`stackclub.synthetic.SyntheticButler`,
+so they run without the LSST Stack or a real repo.
+"""
+import os, sys, json, time, glob, shutil, tempfile, importlib, subprocess
+
+# Modules that "import stackclub" should not pull in by itself:
+HEAVY_MODULES = ['IPython', 'nbformat', 'numpy', 'matplotlib', 'urllib.request', 'lsst']
+
+def import_time(module='stackclub', repeat=5):
+    """
+    Time importing a module in a fresh python process.
+
+    Parameters
+    ----------
+    module: string, optional
+        Name of the module to import [def='stackclub'].
+    repeat: int, optional
+        Number of fresh processes to time the import in [def=5].
+
+    Returns
+    -------
+    result: dict
+        The best (``'seconds'``) and median (``'median_seconds'``) import
+        times, and the heavy modules (``'heavy_modules'``, from
+        ``HEAVY_MODULES``) that the import loaded.
+    """
+    script = ("import sys, time, json\n"
+              "t0 = time.perf_counter()\n"
+              "import {module}\n"
+              "t = time.perf_counter() - t0\n"
+              "heavy = [m for m in {heavy!r} if m in sys.modules]\n"
+              "print(json.dumps([t, heavy]))\n").format(module=module, heavy=HEAVY_MODULES)
+    times, heavy = [], []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        t, heavy = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(t)
+    times.sort()
+    return {'seconds': times[0], 'median_seconds': times[len(times)//2], 'heavy_modules': heavy}
+
+def check_import_time(max_seconds=0.1):
+    """
+    Check that ``import stackclub`` stays lightweight.
+
+    Parameters
+    ----------
+    max_seconds: float, optional
+        Slowest acceptable (best of 5) import time [def=0.1].
+
+    Returns
+    -------
+    result: dict
+        As returned by :func:`import_time`.
+    """
+    result = import_time('stackclub')
+    assert not result['heavy_modules'], \
+        "import stackclub loaded {}".format(result['heavy_modules'])
+    assert result['seconds'] < max_seconds, \
+        "import stackclub took {:.3f}s (limit {}s)".format(result['seconds'], max_seconds)
+    return result
+
+def taster_benchmark(scale='small', latency=0.0):
+    """
+    Time the :class:`Taster` inventory of a synthetic repo.
+
+    Parameters
+    ----------
+    scale: string, optional
+        Size of the repo, one of ``stackclub.synthetic.SCALES`` [def='small'].
+    latency: float or dict, optional
+        Butler latency, see :class:`stackclub.synthetic.SyntheticButler` [def=0].
+
+    Returns
+    -------
+    result: dict
+        The time taken by each step (``'what_exists'``, ``'count_things'``,
+        ``'estimate_sky_area'``), the number of Butler calls made, and the
+        numbers of visits, sensor visits and sources counted.
+    """
+    from .synthetic import SyntheticButler
+    from .taster import Taster
+    butler = SyntheticButler.from_scale(scale, latency=latency)
+    root = tempfile.mkdtemp(prefix='stackclub-benchmark-')
+    try:
+        butler.make_tree(root)
+        taster = Taster(root, butler=butler, cache=False)
+        for name, section in taster.sections():
+            pass
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    result = dict(taster.timings)
+    result['butler_calls'] = sum(butler.calls.values())
+    result['visits'] = len(butler.visit_ra)
+    result['sensor_visits'] = len(butler.visit_ra) * butler.ccds
+    result['sources'] = taster.counts.get('Number of Sources')
+    return result
+
+def nbimport_benchmark(ncells=200):
+    """
+    Time importing a notebook, the first time (parsing and compiling it) and again from the cache.
+
+    Parameters
+    ----------
+    ncells: int, optional
+        Number of code cells in the notebook, each defining a function [def=200].
+
+    Returns
+    -------
+    result: dict
+        The ``'cold_seconds'`` and ``'warm_seconds'`` import times.
+    """
+    import stackclub
+    folder = tempfile.mkdtemp(prefix='stackclub-benchmark-')
+    name = 'BenchmarkNotebook{}'.format(os.getpid())
+    cells = [{'cell_type': 'code', 'execution_count': None, 'metadata': {}, 'outputs': [],
+              'source': ['def f{}(x):\n'.format(i), '    return x + {}\n'.format(i)]} for i in range(ncells)]
+    notebook = {'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2}
+    with open(os.path.join(folder, name + '.ipynb'), 'w') as f:
+        json.dump(notebook, f)
+    # Top-level notebook imports look in the current folder:
+    cwd = os.getcwd()
+    os.chdir(folder)
+    times = []
+    try:
+        for _ in range(2):
+            importlib.invalidate_caches()
+            sys.modules.pop(name, None)
+            start = time.perf_counter()
+            importlib.import_module(name)
+            times.append(time.perf_counter() - start)
+    finally:
+        os.chdir(cwd)
+        sys.modules.pop(name, None)
+        shutil.rmtree(folder, ignore_errors=True)
+    return {'cold_seconds': times[0], 'warm_seconds': times[1]}
+
+def skymap_benchmark(ntracts=None):
+    """
+    Time reading tract outlines from a synthetic full-sky skymap, and finding their area.
+
+    Parameters
+    ----------
+    ntracts: int, optional
+        Number of tracts to use [def=all of them, about 14,000].
+
+    Returns
+    -------
+    result: dict
+        Times taken to read the tract vertices (``'vertices_seconds'``), 
+        to work out their exact areas and the area of their union, and to 
+        make a coverage image of them.
+    """
+    from .synthetic import SkyMap
+    from .skyarea import tract_vertices, polygon_areas, union_area
+    from .skyplot import coverage_image
+    skyMap = SkyMap()
+    tracts = list(range(len(skyMap) if ntracts is None else min(ntracts, len(skyMap))))
+    result = {'tracts': len(tracts)}
+    start = time.perf_counter()
+    ra, dec = tract_vertices(skyMap, tracts)
+    result['vertices_seconds'] = time.perf_counter() - start
+    start = time.perf_counter()
+    result['area'] = float(polygon_areas(ra, dec).sum())
+    result['areas_seconds'] = time.perf_counter() - start
+    start = time.perf_counter()
+    result['union_area'] = union_area(ra, dec)
+    result['union_seconds'] = time.perf_counter() - start
+    start = time.perf_counter()
+    coverage_image(ra, dec)
+    result['coverage_image_seconds'] = time.perf_counter() - start
+    return result
+
+def scanner_benchmark(scale='small'):
+    """
+    Time scanning a synthetic repo's coadd files, with :func:`stackclub.scanner.scan` and with ``glob``.
+
+    Returns
+    -------
+    result: dict
+        The number of files found, and the ``'scan_seconds'`` and
+        ``'glob_seconds'`` taken to find them.
+    """
+    from .synthetic import SyntheticButler
+    from .scanner import scan
+    butler = SyntheticButler.from_scale(scale)
+    root = tempfile.mkdtemp(prefix='stackclub-benchmark-')
+    pattern = 'deepCoadd-results/HSC-I/*/*/calexp-*.fits'
+    try:
+        butler.make_tree(root, files=True)
+        start = time.perf_counter()
+        found = scan(root, pattern)
+        scan_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        globbed = glob.glob(os.path.join(root, pattern))
+        glob_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    assert len(found) == len(globbed), "scan found {} files, glob {}".format(len(found), len(globbed))
+    return {'files': len(found), 'scan_seconds': scan_seconds, 'glob_seconds': glob_seconds}
+
+def butlercache_benchmark(latency=0.001, passes=3):
+    """
+    Time repeated passes over the same ``src`` and ``calexp_md`` datasets, through a :class:`stackclub.butlercache.CachingButler`.
+
+    Parameters
+    ----------
+    latency: float, optional
+        Time taken by each call to the synthetic Butler, in seconds [def=0.001].
+    passes: int, optional
+        Number of times to read every dataset [def=3].
+
+    Returns
+    -------
+    result: dict
+        The time taken by each pass (``'pass_seconds'``), and the cache's
+        ``'hit_rate'``.
+    """
+    from .synthetic import SyntheticButler
+    from .butlercache import CachingButler
+    with CachingButler(SyntheticButler(latency=latency)) as butler:
+        dataIds = [{'visit': visit, 'ccd': ccd} for visit in butler.queryMetadata('calexp', ['visit'])
+                   for ccd in butler.queryMetadata('calexp', ['ccd'])]
+        seconds = []
+        for _ in range(passes):
+            start = time.perf_counter()
+            for dataId in dataIds:
+                butler.get('src', dataId=dataId)
+                butler.get('calexp_md', **dataId)
+            seconds.append(time.perf_counter() - start)
+        info = butler.cache_info()
+    return {'pass_seconds': seconds, 'hit_rate': info['hit_rate']}
+
+def tiles_benchmark(ntracts=None):
+    """
+    Time building a tile pyramid of a synthetic full-sky skymap's tract outlines, and loading views of it.
+
+    Parameters
+    ----------
+    ntracts: int, optional
+        Number of tracts to use [def=all of them, about 14,000].
+
+    Returns
+    -------
+    result: dict
+        Time taken to build the pyramid (``'build_seconds'``), and, for
+        views from 360 down to 1 degree across, the time taken to load each
+        view from a fresh pyramid (``'view_seconds'``) and the number of
+        polygons (or coverage image pixels) in it.
+    """
+    from .synthetic import SkyMap
+    from .skyarea import tract_vertices
+    from .tiles import build_tiles, TilePyramid
+    skyMap = SkyMap()
+    tracts = list(range(len(skyMap) if ntracts is None else min(ntracts, len(skyMap))))
+    ra, dec = tract_vertices(skyMap, tracts)
+    folder = tempfile.mkdtemp(prefix='stackclub-tiles-')
+    try:
+        start = time.perf_counter()
+        build_tiles(folder, {'tract': {'ra': ra, 'dec': dec}})
+        result = {'tracts': len(tracts), 'build_seconds': time.perf_counter() - start,
+                  'view_seconds': {}, 'view_size': {}}
+        for width in (360.0, 60.0, 10.0, 1.0):
+            pyramid = TilePyramid(folder)
+            start = time.perf_counter()
+            view = pyramid.view('tract', 150.0 - width / 2, 150.0 + width / 2, -width / 4, width / 4)
+            result['view_seconds'][width] = time.perf_counter() - start
+            result['view_size'][width] = view['image'].size if view['kind'] == 'coverage' else len(view['index'])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+def run_all(vb=True):
+    """
+    Run all the benchmarks, and return their results in a dictionary.
+    """
+    results = {}
+    benchmarks = [('import_stackclub', check_import_time),
+                  ('nbimport', nbimport_benchmark),
+                  ('taster', taster_benchmark),
+                  ('taster_with_latency', lambda: taster_benchmark(latency=0.001)),
+                  ('butlercache', butlercache_benchmark),
+                  ('skymap', skymap_benchmark),
+                  ('tiles', tiles_benchmark),
+                  ('scanner', scanner_benchmark)]
+    for name, benchmark in benchmarks:
+        results[name] = benchmark()
+        if vb:
+            print("{:30s} {}".format(name, results[name]))
+    return results
+
+if __name__ == '__main__':
+    run_all()
@@ -0,0 +1,343 @@
+"""
+A caching proxy for a Butler, so that repeated ``get``, ``queryMetadata``,
+``subset`` and ``getUri`` calls with the same arguments only go to the repo once.
+
+Wrap a Butler and use the wrapper wherever you would have used the Butler::
+
+    from stackclub.butlercache import CachingButler
+    butler = CachingButler(dafPersist.Butler(repo))
+    calexp = butler.get('calexp', visit=1228, ccd=49)   # read from the repo
+    calexp = butler.get('calexp', visit=1228, ccd=49)   # from memory
+    butler.cache_info()
+
+Everything else (``datasetExists``, ``getKeys``, ...) is passed straight on to
+the wrapped Butler.
+"""
+import os, sys, time, shutil, pickle, hashlib, tempfile, threading, weakref
+from collections import OrderedDict
+from .cache import cache_dir, prune, write_atomic
+
+# The Butler methods whose results are cached:
+CACHED_METHODS = ('get', 'queryMetadata', 'subset', 'getUri')
+SUFFIX = '.pkl'
+
+def sizeof(value):
+    """
+    Estimate how much memory an object takes up, in bytes.
+
+    Notes
+    -----
+    Arrays (and anything else with an ``nbytes``, like an astropy table)
+    report their own size, and containers are added up; afw exposures,
+    images and catalogs are measured through their pixel and column arrays.
+    Anything else counts as ``sys.getsizeof`` - which underestimates the
+    size of objects that hold onto others, so the byte limits are soft.
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    # afw Exposures, MaskedImages and Images:
+    for method in ('getMaskedImage', 'getImage', 'getArray'):
+        if hasattr(value, method):
+            try:
+                part = getattr(value, method)()
+            except Exception:
+                break
+            if method == 'getMaskedImage':
+                return sum(sizeof(getattr(part, m)()) for m in ('getImage', 'getMask', 'getVariance'))
+            return sizeof(part)
+    # afw tables:
+    if hasattr(value, 'getSchema') and hasattr(value, '__len__'):
+        try:
+            return len(value) * value.getSchema().getRecordSize()
+        except Exception:
+            pass
+    return sys.getsizeof(value)
+
+def _freeze(value):
+    """
+    Turn a call argument into something hashable (dataIds are dicts), or raise TypeError.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((k, _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_freeze(v) for v in value))
+    if hasattr(value, 'items') and hasattr(value, 'keys'):
+        # e.g. a daf_persistence DataId
+        return ('dict', tuple(sorted((k, _freeze(v)) for k, v in value.items())))
+    hash(value)
+    return value
+
+class CachingButler(object):
+    """
+    Wrap a Butler, remembering the results of its ``get``, ``queryMetadata``, ``subset`` and ``getUri`` calls.
+
+    Parameters
+    ----------
+    butler: lsst.daf.persistence.Butler
+        The Butler to wrap (anything with the same methods will do).
+    max_bytes: int, optional
+        Limit on the (estimated) size of the results kept in memory; the
+        least recently used ones are dropped beyond it [def=512 MB].
+    spill_bytes: int, optional
+        Results bigger than this are pickled to the disk cache instead of
+        being kept in memory [def=64 MB]. Set it to None to never spill.
+    disk_bytes: int, optional
+        Limit on the size of the disk cache [def=4 GB].
+    repo: string, optional
+        The path to the repo, to keep spilled results on disk between
+        sessions, in ``cache_dir('butler', ...)``. They are only valid as
+        long as the repo does not change: the folder they go in is named
+        after the modification times and sizes of the repo folder and its
+        ``registry.sqlite3`` file (as in :class:`stackclub.taster.Taster`),
+        so they are not reused once those change - but changes further
+        down a repo without a registry go unnoticed, so call
+        :meth:`clear` with ``disk=True`` after changing one. By default,
+        spilled results go into a private folder, made when the first 
+        result spills, and deleted by :meth:`close` (or when the wrapper
+        is garbage collected, or at exit).
+    methods: list of strings, optional
+        Butler methods to cache [def=``CACHED_METHODS``].
+
+    Notes
+    -----
+    The arguments of each call (the dataset type, and the dataId as a dict
+    and/or keyword arguments) make up its cache key; calls that cannot be
+    keyed (e.g. with a callback argument) just go to the Butler. As with
+    ``functools.lru_cache``, a cached result is the *same object* every
+    time, so do not modify it in place - take a copy first.
+
+    The wrapper is thread-safe, although two threads asking for the same
+    missing result at once will both read it from the repo.
+    """
+    def __init__(self, butler, max_bytes=512*1024**2, spill_bytes=64*1024**2,
+                 disk_bytes=4*1024**3, repo=None, methods=CACHED_METHODS):
+        self.butler = butler
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.disk_bytes = disk_bytes
+        self.repo = repo
+        self.methods = tuple(methods)
+        self._memory = OrderedDict()   # key -> (value, size)
+        self.nbytes = 0
+        self._folder = None
+        self._repo_name = None
+        self._cleanup = None
+        # Names of the files spilled to disk (None until first needed):
+        self._spilled = None
+        self._lock = threading.Lock()
+        self.stats = {method: {'hits': 0, 'disk_hits': 0, 'misses': 0, 'uncached': 0,
+                               'spills': 0, 'evictions': 0, 'seconds_saved': 0.0}
+                      for method in self.methods}
+        self._seconds = {}   # key -> time the Butler took to produce it
+        return
+
+    # Anything not cached is the wrapped Butler's business:
+    def __getattr__(self, name):
+        if name in ('butler', 'methods') or name.startswith('__'):
+            raise AttributeError(name)
+        if name in self.methods:
+            return lambda *args, **kwargs: self._call(name, args, kwargs)
+        return getattr(self.butler, name)
+
+    def __repr__(self):
+        return "<CachingButler of {!r}: {} results, {:.1f} MB in memory>".format(
+            self.butler, len(self._memory), self.nbytes / 1024**2)
+
+    def _call(self, method, args, kwargs):
+        try:
+            key = (method, _freeze(args), _freeze(kwargs))
+        except TypeError:
+            self.stats[method]['uncached'] += 1
+            return getattr(self.butler, method)(*args, **kwargs)
+        found, value = self._lookup(method, key)
+        if found:
+            return value
+        start = time.perf_counter()
+        value = getattr(self.butler, method)(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.stats[method]['misses'] += 1
+            self._seconds[key] = seconds
+        self._store(method, key, value)
+        return value
+
+    def _lookup(self, method, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats[method]['hits'] += 1
+                self.stats[method]['seconds_saved'] += self._seconds.get(key, 0.0)
+                return True, self._memory[key][0]
+        if self.spill_bytes is None:
+            return False, None
+        # Only go to the disk for results we know were spilled there:
+        name = self._disk_name(key)
+        if name not in self._spilled_names():
+            return False, None
+        path = os.path.join(self._disk_folder(), name)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # Mark the file as recently used, for the benefit of prune():
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # e.g. pruned to make room for others
+            with self._lock:
+                self._spilled.discard(name)
+            return False, None
+        with self._lock:
+            self.stats[method]['disk_hits'] += 1
+            self.stats[method]['seconds_saved'] += self._seconds.get(key, 0.0)
+        return True, value
+
+    def _store(self, method, key, value):
+        size = sizeof(value)
+        if self.spill_bytes is not None and size > self.spill_bytes:
+            try:
+                data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                name, folder = self._disk_name(key), self._disk_folder()
+                write_atomic(os.path.join(folder, name), data)
+                spilled = self._spilled_names()
+                with self._lock:
+                    spilled.add(name)
+                if prune(folder, self.disk_bytes, suffix=SUFFIX):
+                    # Some files went: find out which are left.
+                    left = set(os.listdir(folder))
+                    with self._lock:
+                        self._spilled = left
+            except Exception:
+                # Unpicklable, or no room on disk: just don't cache it.
+                return
+            with self._lock:
+                self.stats[method]['spills'] += 1
+            return
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self.nbytes -= self._memory.pop(key)[1]
+            self._memory[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                old, (_, old_size) = self._memory.popitem(last=False)
+                self.nbytes -= old_size
+                self._seconds.pop(old, None)
+                self.stats[old[0]]['evictions'] += 1
+        return
+
+    def _repo_folder(self):
+        """
+        Return the disk cache folder for ``repo``, named after the repo and the state it was in when first asked.
+        """
+        if self._repo_name is None:
+            signature = [str(self.repo)]
+            for path in (str(self.repo), os.path.join(str(self.repo), 'registry.sqlite3')):
+                try:
+                    st = os.stat(path)
+                    signature.append([path, st.st_mtime_ns, st.st_size])
+                except OSError:
+                    signature.append([path, None, None])
+            self._repo_name = hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir('butler'), self._repo_name)
+
+    def _disk_folder(self):
+        """
+        Return the disk cache folder, making it if necessary (so only call this to spill, or to read a spilled result).
+        """
+        with self._lock:
+            if self._folder is None:
+                if self.repo is not None:
+                    self._folder = self._repo_folder()
+                    os.makedirs(self._folder, exist_ok=True)
+                else:
+                    self._folder = tempfile.mkdtemp(prefix='butler-', dir=cache_dir('butler'))
+                    self._cleanup = weakref.finalize(self, shutil.rmtree, self._folder, ignore_errors=True)
+            return self._folder
+
+    def _spilled_names(self):
+        """
+        Return the set of names of the spilled results' files.
+        """
+        if self._spilled is None:
+            spilled = set()
+            # Results spilled for the same repo in earlier sessions count too:
+            if self.repo is not None and os.path.isdir(self._repo_folder()):
+                spilled = set(os.listdir(self._repo_folder()))
+            with self._lock:
+                if self._spilled is None:
+                    self._spilled = spilled
+        return self._spilled
+
+    @staticmethod
+    def _disk_name(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + SUFFIX
+
+    def cache_info(self):
+        """
+        Return the cache's hit and miss counts.
+
+        Returns
+        -------
+        info: dict
+            For each cached method, the number of ``'hits'`` (from memory),
+            ``'disk_hits'``, ``'misses'`` (calls that went to the Butler),
+            ``'uncached'`` calls (whose arguments could not be keyed),
+            ``'spills'`` to disk and ``'evictions'`` from memory, and the
+            ``'seconds_saved'`` by not calling the Butler again. Also the
+            ``'entries'`` and ``'nbytes'`` held in memory, and the overall
+            ``'hit_rate'``.
+        """
+        with self._lock:
+            info = {method: dict(counts) for method, counts in self.stats.items()}
+            info['entries'] = len(self._memory)
+            info['nbytes'] = self.nbytes
+        hits = sum(info[m]['hits'] + info[m]['disk_hits'] for m in self.methods)
+        calls = hits + sum(info[m]['misses'] + info[m]['uncached'] for m in self.methods)
+        info['hit_rate'] = hits / calls if calls else 0.0
+        return info
+
+    def clear(self, disk=False):
+        """
+        Forget the results kept in memory (and, if ``disk`` is True, on disk too).
+        """
+        with self._lock:
+            self._memory.clear()
+            self._seconds.clear()
+            self.nbytes = 0
+        if disk and self._folder is not None:
+            for filename in os.listdir(self._folder):
+                if filename.endswith(SUFFIX):
+                    try:
+                        os.remove(os.path.join(self._folder, filename))
+                    except OSError:
+                        pass
+            with self._lock:
+                self._spilled = set()
+        return
+
+    def close(self):
+        """
+        Empty the cache, and delete the private disk cache folder (if there is one).
+        """
+        self.clear()
+        if self._cleanup is not None:
+            # Deletes the private folder, once:
+            self._cleanup()
+            self._cleanup = None
+            self._folder = None
+            self._spilled = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
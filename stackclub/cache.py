@@ -0,0 +1,108 @@
+"""
+Helpers for the local on-disk caches kept by the ``stackclub`` package.
+"""
+import os, tempfile
+
+def cache_dir(*subdirs):
+    """
+    Return the path to a folder in the ``stackclub`` cache, creating it if necessary.
+
+    Parameters
+    ----------
+    subdirs: strings, optional
+        Sub-folder names, e.g. ``'nbimport'``.
+
+    Returns
+    -------
+    folder: string
+        Path to the cache folder.
+
+    Notes
+    -----
+    The cache lives in ``$STACKCLUB_CACHE_DIR`` if that is set, otherwise in
+    ``$XDG_CACHE_HOME/stackclub`` (which defaults to ``~/.cache/stackclub``).
+    It is always safe to delete it.
+    """
+    root = os.environ.get('STACKCLUB_CACHE_DIR')
+    if not root:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(xdg, 'stackclub')
+    folder = os.path.join(root, *subdirs)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def prune(folder, max_bytes, suffix=''):
+    """
+    Delete the least recently used files in a cache folder until it fits in ``max_bytes``.
+
+    Parameters
+    ----------
+    folder: string
+        Cache folder to tidy up (sub-folders are included).
+    max_bytes: int
+        Maximum total size of the cached files, in bytes.
+    suffix: string, optional
+        Only consider files whose names end with this suffix.
+
+    Returns
+    -------
+    removed: int
+        Number of files deleted.
+
+    Notes
+    -----
+    "Recently used" is judged by modification time, since many file systems
+    do not keep access times: cache readers should ``os.utime`` the files
+    they hit.
+    """
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.endswith(suffix):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    removed = 0
+    if total <= max_bytes:
+        return removed
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+def write_atomic(path, data):
+    """
+    Write ``data`` (bytes) to ``path`` so that readers never see a partial file.
+
+    Notes
+    -----
+    The data go into a uniquely named ``.<name>.*.tmp`` file next to
+    ``path`` first, so that several threads (or processes) can write the
+    same file at once, the last one winning.
+    """
+    folder, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=folder or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return
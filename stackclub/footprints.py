@@ -0,0 +1,199 @@
+"""
+Fast loading of the footprints (sky outlines) of the CCDs in a visit.
+
+Plotting where a visit's CCDs fell on the sky only needs each calexp's
+bounding box and WCS, which are in its FITS headers - there is no need to read
+the image, mask and variance planes. :func:`load_footprints` asks the Butler
+for just those (the ``calexp_bbox`` and ``calexp_wcs`` components) - given the
+repo, for all the CCDs at once in a pool of threads - and remembers the answer
+for each visit::
+
+    from stackclub.footprints import load_footprints
+    from stackclub.skyplot import plot_polygons
+    footprints = load_footprints(butler, visit=219976, repo=repo)
+    plot_polygons(footprints['ra'], footprints['dec'], color='violet')
+"""
+import weakref, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# butler -> {(dataset, frozen dataId): footprints}
+_cache = weakref.WeakKeyDictionary()
+_cache_lock = threading.Lock()
+
+def _bbox_corners(bbox):
+    """
+    Return the x and y of the outer corners (and the centre) of an integer pixel bounding box.
+    """
+    # The outer edges of the edge pixels, as in afw's Box2D(Box2I):
+    x0, x1 = bbox.getMinX() - 0.5, bbox.getMaxX() + 0.5
+    y0, y1 = bbox.getMinY() - 0.5, bbox.getMaxY() + 0.5
+    return np.array([x0, x1, x1, x0, 0.5*(x0 + x1)]), np.array([y0, y0, y1, y1, 0.5*(y0 + y1)])
+
+def pixel_to_sky(wcs, x, y):
+    """
+    Transform arrays of pixel coordinates to RA and Dec, in degrees.
+
+    Notes
+    -----
+    Uses the WCS's ``pixelToSkyArray`` (one call for all the points) if it
+    has one, or else transforms the points one at a time.
+    """
+    if hasattr(wcs, 'pixelToSkyArray'):
+        ra, dec = wcs.pixelToSkyArray(np.asarray(x, dtype=float), np.asarray(y, dtype=float), degrees=True)
+        return np.asarray(ra), np.asarray(dec)
+    import lsst.afw.geom as afwGeom
+    coords = [wcs.pixelToSky(afwGeom.Point2D(xx, yy)) for xx, yy in zip(x, y)]
+    return (np.array([c.getRa().asDegrees() for c in coords]),
+            np.array([c.getDec().asDegrees() for c in coords]))
+
+def _is_missing(error):
+    """
+    Return True if an exception raised by a Butler ``get`` just means the dataset isn't there.
+    """
+    if isinstance(error, (FileNotFoundError, LookupError)):
+        return True
+    # The Gen2 Butler raises e.g. "No locations for get: datasetType:calexp ...":
+    return isinstance(error, RuntimeError) and str(error).lower().startswith('no ')
+
+def read_bbox_wcs(butler, dataId, dataset='calexp'):
+    """
+    Read the bounding box and WCS of one exposure, without reading its pixels.
+
+    Parameters
+    ----------
+    butler: lsst.daf.persistence.Butler
+        The Butler to ask.
+    dataId: dict
+        The exposure's data id, e.g. ``{'visit': 219976, 'raftName': 'R22', 'detectorName': 'S11'}``.
+    dataset: string, optional
+        The exposure's dataset type [def='calexp'].
+
+    Returns
+    -------
+    bbox: lsst.geom.Box2I
+        The exposure's pixel bounding box.
+    wcs: lsst.afw.geom.SkyWcs
+        The exposure's WCS.
+
+    Notes
+    -----
+    The ``<dataset>_bbox`` and ``<dataset>_wcs`` components are tried
+    first; if the repo's mapper does not know them (rather than the
+    exposure not being there), the file's headers are read with
+    ``lsst.afw.image.ExposureFitsReader`` instead.
+    """
+    try:
+        return butler.get(dataset + '_bbox', dataId), butler.get(dataset + '_wcs', dataId)
+    except Exception as error:
+        if _is_missing(error):
+            raise
+        components_error = error
+    try:
+        from lsst.afw.image import ExposureFitsReader
+    except ImportError:
+        raise components_error
+    reader = ExposureFitsReader(butler.getUri(dataset, dataId))
+    return reader.readBBox(), reader.readWcs()
+
+def load_footprints(butler, visit, dataset='calexp', max_workers=16, cache=True, vb=False, repo=None, **dataId):
+    """
+    Find the outlines on the sky of all the CCDs in a visit.
+
+    Parameters
+    ----------
+    butler: lsst.daf.persistence.Butler
+        The Butler serving up the visit's exposures.
+    visit: int
+        The visit number.
+    dataset: string, optional
+        The CCD exposures' dataset type [def='calexp'].
+    max_workers: int, optional
+        Number of CCDs to read at once, if ``repo`` is given [def=16].
+    cache: boolean, optional
+        Reuse the footprints found by an earlier call with the same Butler,
+        visit and dataset [def=True].
+    vb: boolean, optional
+        Print a warning about CCDs that could not be read [def=False].
+    repo: string, optional
+        The path to the Butler's repo. If given, the CCDs are read in a
+        pool of threads, each with its own ``Butler(repo)``; otherwise they
+        are read one at a time, through ``butler`` [def=None].
+    dataId: keyword arguments, optional
+        More data id keys to narrow down the CCDs, e.g. ``raftName='R22'``.
+
+    Returns
+    -------
+    footprints: dict
+        The ``'dataIds'`` of the CCDs found, and numpy arrays of their corners'
+        RA and Dec (``'ra'`` and ``'dec'``, shape (N, 4), in degrees, as
+        used by :mod:`stackclub.skyarea` and :mod:`stackclub.skyplot`), and
+        of their centres (``'center_ra'`` and ``'center_dec'``, shape (N,)).
+        Also the ``'missing'`` dataIds, that the Butler knows about but
+        could not be read.
+
+    Notes
+    -----
+    The CCDs are found with ``butler.subset``, so only the ones in the
+    repo's registry are read; each one costs a couple of FITS header
+    reads, rather than the tens of MB of a full calexp. A Gen2 Butler's
+    sqlite registry can't be shared between threads, hence the separate
+    Butlers for parallel reads. CCDs whose files are not there are listed
+    as ``'missing'``; any other error is raised.
+    """
+    dataId = dict(dataId, visit=visit)
+    key = (dataset, tuple(sorted(dataId.items())))
+    if cache:
+        with _cache_lock:
+            try:
+                found = _cache.get(butler, {}).get(key)
+            except TypeError:
+                # Butler can't be weakly referenced, so we can't cache for it
+                found = None
+        if found is not None:
+            return found
+
+    dataIds = [dict(dataRef.dataId) for dataRef in butler.subset(dataset, dataId=dataId)]
+
+    local = threading.local()
+
+    def footprint(ccdId):
+        if repo is None:
+            reader = butler
+        else:
+            if not hasattr(local, 'butler'):
+                from lsst.daf.persistence import Butler
+                local.butler = Butler(repo)
+            reader = local.butler
+        try:
+            bbox, wcs = read_bbox_wcs(reader, ccdId, dataset=dataset)
+        except Exception as error:
+            if _is_missing(error):
+                return None
+            raise
+        x, y = _bbox_corners(bbox)
+        return pixel_to_sky(wcs, x, y)
+
+    if repo is None:
+        results = [footprint(ccdId) for ccdId in dataIds]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(footprint, dataIds))
+
+    good = [i for i, result in enumerate(results) if result is not None]
+    ra = np.array([results[i][0] for i in good]).reshape(len(good), 5)
+    dec = np.array([results[i][1] for i in good]).reshape(len(good), 5)
+    footprints = {'dataIds': [dataIds[i] for i in good],
+                  'ra': ra[:, :4], 'dec': dec[:, :4],
+                  'center_ra': ra[:, 4], 'center_dec': dec[:, 4],
+                  'missing': [ccdId for ccdId, result in zip(dataIds, results) if result is None]}
+    if vb and footprints['missing']:
+        print("WARNING: could not read {} of the {} {}s in visit {}".format(
+            len(footprints['missing']), len(dataIds), dataset, visit))
+    if cache:
+        with _cache_lock:
+            try:
+                _cache.setdefault(butler, {})[key] = footprints
+            except TypeError:
+                pass
+    return footprints
@@ -0,0 +1,138 @@
+"""
+A persistent cache of compiled notebook code, used by :mod:`nbimport`.
+
+Importing a notebook means parsing its JSON, pushing every code cell through
+the IPython input transformer, and compiling the result. None of that changes
+until the notebook does, so - just like ``__pycache__`` does for ``.py`` files -
+we keep the compiled code objects on disk and reuse them.
+"""
+import os, hashlib, marshal
+import importlib.util
+from .cache import cache_dir, prune, write_atomic
+
+# Code objects can only be unmarshalled by the interpreter that made them:
+MAGIC = importlib.util.MAGIC_NUMBER
+SUFFIX = '.nbc'
+
+class NotebookCache(object):
+    """
+    On-disk store of the compiled code cells of imported notebooks.
+
+    Parameters
+    ----------
+    folder: string, optional
+        Where to keep the cache files [def=``cache_dir('nbimport')``].
+    max_bytes: int, optional
+        Size limit of the cache; least recently used entries are evicted
+        beyond it [def=64 MB].
+
+    Notes
+    -----
+    Entries are keyed on the absolute path of the notebook, and validated
+    against its modification time and size. If those have changed but the
+    size is the same, the SHA-256 hash of the notebook contents is checked
+    as well, so that merely touching a notebook does not force a recompile.
+    """
+    def __init__(self, folder=None, max_bytes=64*1024*1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, nb_path):
+        if self.folder is None:
+            self.folder = cache_dir('nbimport')
+        key = hashlib.sha1(os.path.abspath(nb_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key + SUFFIX)
+
+    def _read_entry(self, nb_path):
+        try:
+            with open(self._entry_path(nb_path), 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+                entry = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or entry.get('path') != os.path.abspath(nb_path):
+            return None
+        return entry
+
+    def _write_entry(self, nb_path, entry):
+        try:
+            write_atomic(self._entry_path(nb_path), MAGIC + marshal.dumps(entry))
+            prune(self.folder, self.max_bytes, suffix=SUFFIX)
+        except (OSError, ValueError):
+            # A read-only or full cache should never stop an import.
+            pass
+        return
+
+    def load(self, nb_path, key='cells'):
+        """
+        Return the cached item ``key`` for a notebook, or None if it is missing or stale.
+
+        Parameters
+        ----------
+        nb_path: string
+            File name of the notebook.
+        key: string, optional
+            Which cached item to return [def='cells', the list of compiled code cells].
+        """
+        try:
+            st = os.stat(nb_path)
+        except OSError:
+            return None
+        entry = self._read_entry(nb_path)
+        if entry is None or entry.get('size') != st.st_size or key not in entry:
+            return None
+        if entry.get('mtime') != st.st_mtime_ns:
+            # Same size, new timestamp: only a change of contents counts.
+            if entry.get('hash') != file_hash(nb_path):
+                return None
+            entry['mtime'] = st.st_mtime_ns
+            self._write_entry(nb_path, entry)
+        else:
+            # Mark the entry as recently used, for the benefit of prune().
+            try:
+                os.utime(self._entry_path(nb_path))
+            except OSError:
+                pass
+        return entry[key]
+
+    def store(self, nb_path, value, key='cells', digest=None, st=None):
+        """
+        Save an item (by default, the list of compiled code cells) for a notebook.
+
+        Parameters
+        ----------
+        nb_path: string
+            File name of the notebook.
+        value: marshallable object
+            The thing to cache, e.g. a list of code objects.
+        key: string, optional
+            Name of the cached item [def='cells'].
+        digest: string, optional
+            SHA-256 hex digest of the notebook contents the value was made
+            from. Computed here if not supplied.
+        st: os.stat_result, optional
+            Result of ``os.stat`` on the notebook taken *before* it was read.
+        """
+        if st is None:
+            st = os.stat(nb_path)
+        if digest is None:
+            digest = file_hash(nb_path)
+        entry = self._read_entry(nb_path)
+        if entry is None or entry.get('hash') != digest:
+            entry = {'path': os.path.abspath(nb_path), 'hash': digest}
+        entry['mtime'] = st.st_mtime_ns
+        entry['size'] = st.st_size
+        entry[key] = value
+        self._write_entry(nb_path, entry)
+        return
+
+def file_hash(path):
+    """
+    Return the SHA-256 hex digest of a file's contents.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,268 @@
+"""
+Static analysis of notebook code, used by :mod:`nbimport` to avoid running
+cells that an import does not need.
+
+Everything here works on the Python source of a notebook's code cells (after
+the IPython input transformer has turned any magics into function calls):
+nothing is executed.
+"""
+import ast
+
+def definitions_only(tree):
+    """
+    Strip a parsed cell down to the statements that just define things.
+
+    Parameters
+    ----------
+    tree: ast.Module
+        A parsed code cell.
+
+    Returns
+    -------
+    tree: ast.Module
+        The same cell, keeping only function and class definitions, imports,
+        and assignments of literal constants (numbers, strings, and tuples,
+        lists, sets and dicts of them).
+    """
+    body = [stmt for stmt in tree.body if is_definition(stmt)]
+    return ast.Module(body=body, type_ignores=[])
+
+def is_definition(stmt):
+    """
+    Is this statement a definition that is (usually) cheap and safe to run?
+    """
+    if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef,
+                         ast.Import, ast.ImportFrom)):
+        return True
+    if isinstance(stmt, (ast.Assign, ast.AnnAssign)) and stmt.value is not None:
+        targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+        if not all(isinstance(t, (ast.Name, ast.Tuple, ast.List)) for t in targets):
+            return False
+        try:
+            ast.literal_eval(stmt.value)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return False
+        return True
+    return False
+
+def names_in(stmts):
+    """
+    Find the module-level names that some statements bind, and the global names they read.
+
+    Parameters
+    ----------
+    stmts: list of ast statements
+        E.g. the body of a parsed code cell.
+
+    Returns
+    -------
+    binds: tuple of strings
+        Names bound at module level (including by ``global`` statements in
+        functions). A ``from module import *`` binds the special name ``'*'``.
+    reads: tuple of strings
+        Global names read anywhere, including inside function bodies; names
+        that are local to a function, class or comprehension are left out.
+    """
+    collector = _NameCollector()
+    for stmt in stmts:
+        collector.visit(stmt)
+    return tuple(sorted(collector.binds)), tuple(sorted(collector.reads))
+
+def _bound_in(nodes):
+    """
+    Return the names bound directly in a scope (not in nested ones), and those declared global.
+    """
+    names, globs = set(), set()
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Global):
+            globs.update(node.names)
+            continue
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+            continue
+        if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        stack.extend(ast.iter_child_nodes(node))
+    return names - globs, globs
+
+def _arg_names(args):
+    names = [a.arg for a in args.posonlyargs + args.args + args.kwonlyargs]
+    if args.vararg:
+        names.append(args.vararg.arg)
+    if args.kwarg:
+        names.append(args.kwarg.arg)
+    return set(names)
+
+class _NameCollector(ast.NodeVisitor):
+    """
+    Walk some module-level statements, keeping track of the enclosing scopes.
+    """
+    def __init__(self):
+        self.binds = set()
+        self.reads = set()
+        # Stack of (is_class, local names) for the scopes we are inside:
+        self.scopes = []
+
+    def _is_local(self, name):
+        for depth, (is_class, names) in enumerate(reversed(self.scopes)):
+            # Class bodies are not visible from the methods inside them.
+            if is_class and depth > 0:
+                continue
+            if name in names:
+                return True
+        return False
+
+    def _bind(self, name):
+        if not self.scopes:
+            self.binds.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            if not self._is_local(node.id):
+                self.reads.add(node.id)
+        elif isinstance(node.ctx, ast.Store):
+            self._bind(node.id)
+
+    def visit_AugAssign(self, node):
+        # x += 1 reads x as well as binding it.
+        if isinstance(node.target, ast.Name) and not self._is_local(node.target.id):
+            self.reads.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._bind(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            self._bind(alias.asname or alias.name)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self._bind(node.name)
+        self.generic_visit(node)
+
+    def _visit_scope(self, node, body, is_class, local_names):
+        names, globs = _bound_in(body)
+        self.binds.update(globs)
+        self.scopes.append((is_class, names | local_names))
+        for child in body:
+            self.visit(child)
+        self.scopes.pop()
+
+    def _visit_function(self, node):
+        # Decorators, defaults and annotations are evaluated where the function is defined:
+        for child in node.decorator_list + node.args.defaults + \
+                     [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(child)
+        self._bind(node.name)
+        self._visit_scope(node, node.body, False, _arg_names(node.args))
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+
+    def visit_Lambda(self, node):
+        for child in node.args.defaults + [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(child)
+        self.scopes.append((False, _arg_names(node.args)))
+        self.visit(node.body)
+        self.scopes.pop()
+
+    def visit_ClassDef(self, node):
+        for child in node.decorator_list + node.bases + [k.value for k in node.keywords]:
+            self.visit(child)
+        self._bind(node.name)
+        self._visit_scope(node, node.body, True, set())
+
+    def _visit_comprehension(self, node):
+        targets = set()
+        for generator in node.generators:
+            targets |= {n.id for n in ast.walk(generator.target) if isinstance(n, ast.Name)}
+        self.scopes.append((False, targets))
+        self.generic_visit(node)
+        self.scopes.pop()
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+
+class DependencyGraph(object):
+    """
+    Which units of code (statements, or cells) bind which names, and which names they read.
+
+    Parameters
+    ----------
+    units: list of (binds, reads) pairs
+        As returned by :func:`names_in`, one per unit, in execution order.
+
+    Notes
+    -----
+    A read is resolved to the last unit *before* the reader that binds the
+    name, or - for names that are only bound later, which function bodies
+    are allowed to refer to - to the last unit that binds it at all. Star
+    imports could bind anything, so they are always treated as needed.
+    """
+    def __init__(self, units):
+        self.binds = [set(binds) for binds, reads in units]
+        self.reads = [set(reads) for binds, reads in units]
+        self.binders = {}
+        for i, binds in enumerate(self.binds):
+            for name in binds:
+                self.binders.setdefault(name, []).append(i)
+        self.stars = self.binders.pop('*', [])
+
+    def names(self):
+        """
+        Return the set of all names bound by the units.
+        """
+        return set(self.binders)
+
+    def binder(self, name, before=None):
+        """
+        Return the index of the unit that provides ``name`` (to the unit ``before``), or None.
+        """
+        indices = self.binders.get(name)
+        if not indices:
+            return None
+        if before is not None:
+            earlier = [i for i in indices if i < before]
+            if earlier:
+                return earlier[-1]
+        return indices[-1]
+
+    def closure(self, names, done=()):
+        """
+        Return the indices of the units needed to provide some names.
+
+        Parameters
+        ----------
+        names: iterable of strings
+            The names wanted.
+        done: collection of ints, optional
+            Units that have already been run (and so are not needed again).
+
+        Returns
+        -------
+        needed: list of ints
+            Indices of the units to run, in execution order.
+        """
+        done = set(done)
+        stack = [self.binder(name) for name in names] + list(self.stars)
+        needed = set()
+        while stack:
+            i = stack.pop()
+            if i is None or i in needed or i in done:
+                continue
+            needed.add(i)
+            stack.extend(self.binder(name, before=i) for name in self.reads[i])
+        return sorted(needed)
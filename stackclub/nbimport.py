@@ -1,12 +1,16 @@
 """
 This module was adapted from the `Jupyter notebook documentation <https://github.com/jupyter/notebook/blob/master/docs/source/examples/Notebook/Importing%20Notebooks.ipynb>`_ (copyright (c) Jupyter Development Team, and distributed under the terms of the `Modified BSD License <https://github.com/jupyter/notebook/blob/master/COPYING.md>`_) for use in the ``stackclub`` package.
 """
-import io, os, sys, types
-from IPython import get_ipython
-from nbformat import read
-from IPython.core.interactiveshell import InteractiveShell
+import io, os, sys, types, time, hashlib, ast
+import importlib.util
 from io import StringIO
 import contextlib
+from .nbcache import NotebookCache
+from .nbgraph import DependencyGraph, definitions_only, names_in
+from .nbstream import read_code_cells, NotV4Error
+
+# Compiled notebook cells, shared by all loaders:
+notebook_cache = NotebookCache()
 
 def find_notebook(fullname, path=None):
     """
@@ -60,60 +64,137 @@ def stdoutIO(stdout=None):
     sys.stdout = old
     return
 
+# How to import notebooks - see import_mode():
+MODES = ('all', 'definitions', 'lazy', 'minimal')
+default_mode = 'all'
+
+@contextlib.contextmanager
+def import_mode(mode):
+    """
+    Import notebooks in a different mode, within a ``with`` block.
+    
+    Parameters
+    ----------
+    mode: string
+        One of:
+        
+        * ``'all'``: run every code cell (the default);
+        * ``'definitions'``: only run the function and class definitions, 
+          imports, and assignments of constants;
+        * ``'lazy'``: like ``'definitions'``, but only run each definition
+          (and the ones it depends on) when the module attribute it defines 
+          is first accessed;
+        * ``'minimal'``: run whole cells, but only the ones needed for the 
+          module attributes that are actually used - so 
+          ``from Notebook import foo`` runs the cell that defines ``foo``,
+          and the cells that define what *that* cell uses, and so on.
+    
+    Examples
+    --------
+    Get one function out of a notebook, without running its long analysis cells:
+    
+    >>> import stackclub
+    >>> with stackclub.import_mode('lazy'):
+    ...     import UndersampledMoments
+    >>> UndersampledMoments.UndersampledGalSim
+    
+    Notes
+    -----
+    Notebooks are imported once per session, whatever the mode: use 
+    ``importlib.reload`` (or restart the kernel) to import one again in 
+    a different mode. Cells whose statements are skipped are *not* run, 
+    so any functions that rely on the global variables they set up will 
+    fail when called.
+    """
+    global default_mode
+    if mode not in MODES:
+        raise ValueError("unrecognized import mode "+str(mode)+", expecting one of "+str(MODES))
+    old, default_mode = default_mode, mode
+    try:
+        yield
+    finally:
+        default_mode = old
+    return
+
 class NotebookLoader(object):
     """
     Module Loader for Jupyter Notebooks
+    
+    Parameters
+    ----------
+    path: list of strings, optional
+        Folders to look for notebooks in.
+    cache: NotebookCache, optional
+        Store of compiled notebook cells [def=``notebook_cache``]. 
+        Pass ``False`` to always re-read and re-compile the notebooks.
+    mode: string, optional
+        How to import the notebooks, see :func:`import_mode` 
+        [def=the current ``default_mode``].
     """
-    def __init__(self, path=None):
-        self.shell = InteractiveShell.instance()
+    def __init__(self, path=None, cache=None, mode=None):
         self.path = path
+        if cache is None:
+            cache = notebook_cache
+        self.cache = cache or None
+        self.mode = mode
     
-    def load_module(self, fullname):
+    @property
+    def shell(self):
         """
-        Import a notebook as a module
+        The IPython shell, which is only started up when it is first needed.
+        """
+        from IPython.core.interactiveshell import InteractiveShell
+        return InteractiveShell.instance()
+    
+    def create_module(self, spec):
+        """
+        Use the default module creation semantics.
+        """
+        return None
+    
+    def exec_module(self, mod):
+        """
+        Execute a notebook in the namespace of an (empty) module.
         
         Parameters
         ----------
-        fullname: string
-            Name of notebook (without the .ipynb extension)
-            
-        Returns
-        -------
         mod: module
-            Notebook in module form, after it has been imported (executed).
+            Module created by the import machinery for the notebook 
+            at ``mod.__spec__.origin``.
             
         Notes
         -----
-        All code cells in the notebook are executed, silently 
-        (by redirecting the standard output).
+        By default, all code cells in the notebook are executed, silently 
+        (by redirecting the standard output). See :func:`import_mode` for
+        the alternatives.
         """
-        path = find_notebook(fullname, self.path)
+        path = mod.__spec__.origin
+        mode = self.mode or default_mode
         
         print ("Importing code from Jupyter notebook %s" % path)
-                                       
-        # load the notebook object
-        with io.open(path, 'r', encoding='utf-8') as f:
-            nb = read(f, 4)
-        
-        # create the module and add it to sys.modules
-        # if name in sys.modules:
-        #    return sys.modules[name]
-        mod = types.ModuleType(fullname)
-        mod.__file__ = path
-        mod.__loader__ = self
+        
+        from IPython import get_ipython
         mod.__dict__['get_ipython'] = get_ipython
-        sys.modules[fullname] = mod
         
+        # get the compiled code cells, from the cache if possible
+        code = self.get_code(path, mode=mode)
+        if mode in ('lazy', 'minimal'):
+            self.make_lazy(mod, code)
+        else:
+            self.run(mod, code)
+        return
+    
+    def run(self, mod, cells):
+        """
+        Execute some compiled code cells in a module's namespace.
+        """
         # extra work to ensure that magics that would affect the user_ns
         # actually affect the notebook module's ns
         save_user_ns = self.shell.user_ns
         self.shell.user_ns = mod.__dict__
         
         try:
-          for cell in nb.cells:
-            if cell.cell_type == 'code':
-                # transform the input to executable Python
-                code = self.shell.input_transformer_manager.transform_cell(cell.source)
+            for code in cells:
                 # run the code in the module, catching the stdout:
                 with stdoutIO() as s:
                     try:
@@ -123,7 +204,194 @@ class NotebookLoader(object):
                         print(s.getvalue())        
         finally:
             self.shell.user_ns = save_user_ns
+        return
+    
+    def make_lazy(self, mod, units):
+        """
+        Arrange for a module's attributes to be defined when they are first accessed.
+        
+        Parameters
+        ----------
+        mod: module
+            The (empty) notebook module.
+        units: list of (code, binds, reads) tuples
+            Compiled pieces of the notebook, with the names each one binds 
+            and reads (see :func:`nbgraph.names_in`).
+            
+        Notes
+        -----
+        This uses a module-level ``__getattr__`` (PEP 562): asking for a name
+        runs the piece of code that defines it, along with anything that piece 
+        depends on, and nothing else.
+        """
+        graph = DependencyGraph([(binds, reads) for code, binds, reads in units])
+        done = set()
+        
+        def __getattr__(name):
+            if name in graph.binders:
+                todo = graph.closure([name], done)
+                done.update(todo)
+                self.run(mod, [units[i][0] for i in todo])
+                if name in mod.__dict__:
+                    return mod.__dict__[name]
+            raise AttributeError("module '{}' has no attribute '{}'".format(mod.__name__, name))
+        
+        def __dir__():
+            return sorted(set(mod.__dict__) | graph.names())
+        
+        mod.__dict__['__getattr__'] = __getattr__
+        mod.__dict__['__dir__'] = __dir__
+        # so that "from notebook import *" still gets everything:
+        mod.__dict__['__all__'] = sorted(name for name in graph.names() if not name.startswith('_'))
+        return
+    
+    def load_module(self, fullname):
+        """
+        Import a notebook as a module
+        
+        Parameters
+        ----------
+        fullname: string
+            Name of notebook (without the .ipynb extension)
+            
+        Returns
+        -------
+        mod: module
+            Notebook in module form, after it has been imported (executed).
+            
+        Notes
+        -----
+        This is the legacy (pre-PEP 451) loader interface, kept for code that
+        calls it directly: the import system itself uses :meth:`exec_module`.
+        """
+        path = find_notebook(fullname, self.path)
+        spec = importlib.util.spec_from_file_location(fullname, path, loader=self)
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[fullname] = mod
+        self.exec_module(mod)
         return mod
+    
+    def get_code(self, path, mode='all'):
+        """
+        Return the code cells of a notebook, transformed and compiled.
+        
+        Parameters
+        ----------
+        path: string
+            File name of the notebook.
+        mode: string, optional
+            Import mode, see :func:`import_mode` [def='all'].
+            
+        Returns
+        -------
+        code: list
+            In ``'all'`` mode, one code object per code cell, in notebook order.
+            In ``'definitions'`` mode, the same but with only the definitions
+            kept in each cell. In ``'lazy'`` mode, a ``(code, binds, reads)`` 
+            tuple for each definition; in ``'minimal'`` mode, one for each cell.
+            
+        Notes
+        -----
+        The compiled cells are kept in a :class:`nbcache.NotebookCache`, so 
+        that repeat imports of an unchanged notebook need neither ``nbformat`` 
+        nor the IPython input transformer. For the ``'minimal'`` mode, the 
+        cached dependency graph (the names bound and read by each cell) is 
+        combined with the cached compiled cells.
+        """
+        if mode == 'minimal':
+            cells = self.get_code(path, mode='all')
+            graph = self.cache.load(path, key='graph') if self.cache is not None else None
+            if graph is None or len(graph) != len(cells):
+                sources, digest, st = self.read_cells(path)
+                graph = [names_in(_parse(source).body) for source in sources]
+                if self.cache is not None:
+                    self.cache.store(path, graph, key='graph', digest=digest, st=st)
+            return [(code, binds, reads) for code, (binds, reads) in zip(cells, graph)]
+        
+        key = 'cells' if mode == 'all' else mode
+        if self.cache is not None:
+            code = self.cache.load(path, key=key)
+            if code is not None:
+                return code
+        
+        sources, digest, st = self.read_cells(path)
+        
+        code = []
+        for i, source in enumerate(sources):
+            filename = '%s[%d]' % (path, i)
+            if mode == 'all':
+                code.append(_compile(source, filename))
+                continue
+            try:
+                tree = definitions_only(ast.parse(source, filename))
+            except SyntaxError:
+                continue
+            if mode == 'definitions':
+                code.append(compile(tree, filename, 'exec'))
+            else:
+                for stmt in tree.body:
+                    binds, reads = names_in([stmt])
+                    unit = ast.Module(body=[stmt], type_ignores=[])
+                    code.append((compile(unit, filename, 'exec'), binds, reads))
+        
+        if self.cache is not None:
+            self.cache.store(path, code, key=key, digest=digest, st=st)
+        return code
+    
+    def read_cells(self, path):
+        """
+        Read the source of a notebook's code cells, as executable Python.
+        
+        Returns
+        -------
+        sources: list of strings
+            The code cells, after the IPython input transformer has 
+            turned any magics into function calls.
+        digest: string
+            SHA-256 hex digest of the notebook file.
+        st: os.stat_result
+            Status of the notebook file, from before it was read.
+        
+        Notes
+        -----
+        Version 4 notebooks are read with :func:`nbstream.read_code_cells`, 
+        which never loads the cell outputs into memory; older ones are 
+        read (and converted) with ``nbformat``.
+        """
+        st = os.stat(path)
+        try:
+            # stream the code out of the notebook, skipping the outputs
+            code_cells, digest = read_code_cells(path)
+        except NotV4Error:
+            # load the (old format) notebook object
+            with io.open(path, 'rb') as f:
+                raw = f.read()
+            from nbformat import reads
+            nb = reads(raw.decode('utf-8'), 4)
+            code_cells = [cell.source for cell in nb.cells if cell.cell_type == 'code']
+            digest = hashlib.sha256(raw).hexdigest()
+        
+        # transform the input to executable Python
+        sources = [self.shell.input_transformer_manager.transform_cell(source) for source in code_cells]
+        return sources, digest, st
+
+def _parse(source):
+    """
+    Parse a cell, treating one with a syntax error as empty.
+    """
+    try:
+        return ast.parse(source)
+    except SyntaxError:
+        return ast.Module(body=[], type_ignores=[])
+
+def _compile(source, filename):
+    """
+    Compile a cell, deferring any syntax error until the cell is run.
+    """
+    try:
+        return compile(source, filename, 'exec')
+    except SyntaxError as error:
+        return compile('raise SyntaxError(%r)' % str(error), filename, 'exec')
 
 class NotebookFinder(object):
     """
@@ -134,6 +402,13 @@ class NotebookFinder(object):
     Once an instance of this class is appended to ``sys.meta_path``, 
     the ``import`` statement will work on notebook names. 
     
+    Every import that no other finder resolves ends up here, so the finder
+    keeps an index of the notebooks in each folder it has looked in (refreshed
+    when the folder's modification time changes, like the standard library's
+    ``FileFinder``), and remembers failed lookups for ``refresh`` seconds.
+    Most non-notebook imports therefore cost a dictionary lookup, rather than
+    a couple of ``stat`` calls per folder.
+    
     Examples
     --------
     To gain the ability to import notebooks, we just import the :mod:`nbimport` module.
@@ -150,29 +425,125 @@ class NotebookFinder(object):
     >>> skymapper = stackclub.wimport(dm_butler_skymap_notebook, vb=True)
     
     The `DataInventory notebook <https://github.com/LSSTScienceCollaborations/StackClub/blob/master/Basics/DataInventory.ipynb>`_ provides a live demo of this example.
+    
+    Parameters
+    ----------
+    refresh: float, optional
+        How often (in seconds) to check an indexed folder for changes [def=2.0].
     """
-    def __init__(self):
+    def __init__(self, refresh=2.0):
         self.loaders = {}
+        self.refresh = refresh
+        # folder -> (time checked, folder mtime, {module name: notebook file name})
+        self._index = {}
+        # (module name, folders) -> time of the failed lookup
+        self._misses = {}
     
-    def find_module(self, fullname, path=None):
+    def invalidate_caches(self):
         """
-        Find the notebook module and return a suitable loader.
+        Forget all directory listings and failed lookups.
+        
+        Notes
+        -----
+        This is called by ``importlib.invalidate_caches()``. Without it, a 
+        notebook created in an already-indexed folder becomes importable 
+        within ``refresh`` seconds.
+        """
+        self._index.clear()
+        self._misses.clear()
+        return
+    
+    def _listing(self, folder, now):
+        """
+        Return the {module name: notebook file name} index of a folder.
+        
+        The folder is only re-listed when its modification time has changed,
+        and that is checked at most once every ``refresh`` seconds.
+        """
+        entry = self._index.get(folder)
+        if entry is not None and now - entry[0] < self.refresh:
+            return entry[2]
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtime = None
+        if entry is not None and entry[1] == mtime:
+            self._index[folder] = (now, mtime, entry[2])
+            return entry[2]
+        
+        names = {}
+        if mtime is not None:
+            try:
+                filenames = [e.name for e in os.scandir(folder)]
+            except OSError:
+                filenames = []
+            for filename in sorted(filenames):
+                if not filename.endswith('.ipynb'):
+                    continue
+                name = filename[:-len('.ipynb')]
+                names[name] = filename
+                # let import Notebook_Name find "Notebook Name.ipynb"
+                if ' ' in name:
+                    names.setdefault(name.replace(' ', '_'), filename)
+        self._index[folder] = (now, mtime, names)
+        return names
+    
+    def find_notebook(self, fullname, path=None):
+        """
+        Indexed equivalent of :func:`find_notebook`.
         
         Parameters
         ----------
         fullname: string
             Name of the notebook to be found (without ipynb extension)
-        path: string
-            Path of folder containing notebook (optional).
+        path: list of strings, optional
+            Folders that might contain the notebook.
+        
+        Returns
+        -------
+        nb_path: string
+            File name of notebook, if found (else None)
+        """
+        name = fullname.rsplit('.', 1)[-1]
+        if not path:
+            path = ['']
+        now = time.monotonic()
+        # The current folder can change under us, so it is part of the keys:
+        cwd = os.getcwd()
+        key = (name, cwd, tuple(path))
+        missed = self._misses.get(key)
+        if missed is not None and now - missed < self.refresh:
+            return None
+        for d in path:
+            filename = self._listing(os.path.join(cwd, d), now).get(name)
+            if filename is not None:
+                self._misses.pop(key, None)
+                return os.path.join(d, filename)
+        self._misses[key] = now
+        return None
+    
+    def find_spec(self, fullname, path=None, target=None):
+        """
+        Find the notebook module and return a module spec for it.
+        
+        Parameters
+        ----------
+        fullname: string
+            Name of the notebook to be found (without ipynb extension)
+        path: list of strings, optional
+            Folders that might contain the notebook.
+        target: module, optional
+            Ignored.
             
         Returns
         -------
-        loaders[path]: NotebookLoader
-            Suitable loader object for dealing with Notebook import statements.
+        spec: ModuleSpec
+            Spec pointing at the notebook, with a suitable :class:`NotebookLoader`,
+            or None if there is no such notebook.
         """
-        nb_path = find_notebook(fullname, path)
+        nb_path = self.find_notebook(fullname, path)
         if not nb_path:
-            return
+            return None
         
         key = path
         if path:
@@ -181,8 +552,32 @@ class NotebookFinder(object):
         
         if key not in self.loaders:
             self.loaders[key] = NotebookLoader(path)
-        return self.loaders[key]
+        return importlib.util.spec_from_file_location(fullname, nb_path, loader=self.loaders[key])
+    
+    def find_module(self, fullname, path=None):
+        """
+        Find the notebook module and return a suitable loader.
+        
+        Parameters
+        ----------
+        fullname: string
+            Name of the notebook to be found (without ipynb extension)
+        path: string
+            Path of folder containing notebook (optional).
+            
+        Returns
+        -------
+        loaders[path]: NotebookLoader
+            Suitable loader object for dealing with Notebook import statements.
+            
+        Notes
+        -----
+        Legacy interface: the import system uses :meth:`find_spec`.
+        """
+        spec = self.find_spec(fullname, path)
+        if spec is None:
+            return
+        return spec.loader
 
 # Register the NotebookFinder:
 sys.meta_path.append(NotebookFinder())
-
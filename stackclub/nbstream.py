@@ -0,0 +1,250 @@
+"""
+A streaming reader for Jupyter notebooks, used by :mod:`nbimport`.
+
+Executed notebooks can be hundreds of MB, almost all of it cell outputs
+(base64 images, bokeh and datashader HTML...) that an import does not need.
+Rather than loading the whole JSON document, the reader here scans the file in
+fixed-size chunks, keeping only the type and source of each cell, and skipping
+over everything else without decoding it.
+"""
+import json, re, hashlib
+
+# Runs of string content, possibly with escapes, up to (not including) a quote:
+_STRING_BODY = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# The next character that matters when skipping a container:
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+# The rest of a number, true, false or null:
+_SCALAR = re.compile(rb'[^,}\]\s]*')
+_WHITESPACE = b' \t\r\n'
+
+class NotV4Error(ValueError):
+    """
+    The notebook is not in nbformat version 4, so the streaming reader cannot handle it.
+    """
+    pass
+
+def read_code_cells(path, chunk_size=1 << 16):
+    """
+    Read the source of the code cells of a notebook, without loading its outputs.
+
+    Parameters
+    ----------
+    path: string
+        File name of the notebook.
+    chunk_size: int, optional
+        Number of bytes to read at a time [def=64 kB].
+
+    Returns
+    -------
+    sources: list of strings
+        The code cells' source, in notebook order.
+    digest: string
+        SHA-256 hex digest of the notebook file.
+
+    Raises
+    ------
+    NotV4Error
+        If the file is an older (v3 or earlier) notebook.
+    ValueError
+        If the file is not valid notebook JSON.
+
+    Notes
+    -----
+    Memory use is set by ``chunk_size`` and the size of the code, however
+    big the cell outputs are.
+    """
+    with open(path, 'rb') as f:
+        scanner = _Scanner(f, chunk_size)
+        sources = scanner.notebook()
+        # Hash whatever is left after the closing brace, too:
+        while scanner.fill():
+            scanner.pos = len(scanner.buf)
+    return sources, scanner.hash.hexdigest()
+
+class _Scanner(object):
+    """
+    Just enough of an incremental JSON parser to pull the code out of a notebook.
+    """
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = b''
+        self.pos = 0
+        self.hash = hashlib.sha256()
+
+    def fill(self):
+        """
+        Read another chunk, dropping the part of the buffer already scanned.
+        """
+        data = self.f.read(self.chunk_size)
+        self.hash.update(data)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return len(data) > 0
+
+    def peek(self):
+        """
+        Skip whitespace, and return the next character (as bytes) without consuming it.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos:self.pos+1]
+            if not self.fill():
+                raise ValueError("unexpected end of notebook file")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("expected one of {} in notebook, found {}".format(chars, c))
+        self.pos += 1
+        return c
+
+    def string(self, keep=True):
+        """
+        Consume a JSON string, returning it decoded if ``keep`` (else None).
+        """
+        self.expect(b'"')
+        pieces = []
+        while True:
+            end = _STRING_BODY.match(self.buf, self.pos).end()
+            if end < len(self.buf) and self.buf[end:end+1] == b'"':
+                if keep:
+                    pieces.append(self.buf[self.pos:end])
+                self.pos = end + 1
+                break
+            # The string carries on into the next chunk (perhaps mid-escape,
+            # in which case we keep the backslash for next time):
+            if end == len(self.buf) or self.buf[end:end+1] != b'\\':
+                end = len(self.buf)
+            if keep:
+                pieces.append(self.buf[self.pos:end])
+            self.pos = end
+            if not self.fill():
+                raise ValueError("unterminated string in notebook file")
+        if keep:
+            return json.loads(b'"' + b''.join(pieces) + b'"')
+        return None
+
+    def skip(self):
+        """
+        Consume any JSON value, without building it.
+        """
+        c = self.peek()
+        if c == b'"':
+            self.string(keep=False)
+            return
+        if c not in b'[{':
+            self.scalar()
+            return
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("unexpected end of notebook file")
+                continue
+            c = match.group()
+            if c == b'"':
+                self.pos = match.start()
+                self.string(keep=False)
+                continue
+            self.pos = match.end()
+            depth += 1 if c in b'[{' else -1
+            if depth == 0:
+                return
+
+    def scalar(self):
+        """
+        Consume a number, true, false or null.
+        """
+        self.peek()
+        pieces = []
+        while True:
+            end = _SCALAR.match(self.buf, self.pos).end()
+            pieces.append(self.buf[self.pos:end])
+            self.pos = end
+            if end < len(self.buf) or not self.fill():
+                break
+        return json.loads(b''.join(pieces))
+
+    def members(self):
+        """
+        Iterate over the keys of a JSON object; the caller must consume each value.
+        """
+        self.expect(b'{')
+        if self.peek() == b'}':
+            self.pos += 1
+            return
+        while True:
+            key = self.string()
+            self.expect(b':')
+            yield key
+            if self.expect(b',}') == b'}':
+                return
+
+    def elements(self):
+        """
+        Iterate over the elements of a JSON array; the caller must consume each one.
+        """
+        self.expect(b'[')
+        if self.peek() == b']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(b',]') == b']':
+                return
+
+    def source(self):
+        """
+        Read a cell source, which is either a string or a list of strings.
+        """
+        if self.peek() == b'"':
+            return self.string()
+        lines = []
+        for _ in self.elements():
+            lines.append(self.string())
+        return ''.join(lines)
+
+    def cell(self):
+        """
+        Read one cell, returning its source if it is a code cell (else None).
+        """
+        cell_type, source = None, None
+        for key in self.members():
+            if key == 'cell_type':
+                cell_type = self.string()
+            elif key == 'source' and cell_type in (None, 'code'):
+                source = self.source()
+            else:
+                self.skip()
+        if cell_type == 'code':
+            return source or ''
+        return None
+
+    def notebook(self):
+        """
+        Read the top-level notebook object, returning the code cell sources.
+        """
+        sources = None
+        for key in self.members():
+            if key == 'cells':
+                sources = []
+                for _ in self.elements():
+                    source = self.cell()
+                    if source is not None:
+                        sources.append(source)
+            elif key == 'nbformat':
+                version = self.scalar()
+                if version < 4:
+                    raise NotV4Error("notebook is in nbformat version {}".format(version))
+            elif key == 'worksheets':
+                raise NotV4Error("notebook has worksheets, so is in nbformat version 3 or earlier")
+            else:
+                self.skip()
+        if sources is None:
+            raise NotV4Error("notebook has no cells")
+        return sources
@@ -0,0 +1,313 @@
+"""
+Pointings and focal plane footprints for many visits at once, from an OpSim database.
+
+Plotting where thousands of visits fell on the sky one visit at a time means
+thousands of database connections and queries, and a camera-geometry calculation
+per CCD per visit. Here, the pointings of all the visits come from one query
+(over a connection that is kept open), and the CCD corners of all the visits
+are worked out together with numpy::
+
+    from stackclub.opsim import get_pointings, camera_corners, sky_corners
+    pointings = get_pointings(opsimdb, visits)
+    names, x, y = camera_corners(butler.get('camera'))
+    ra, dec = sky_corners(pointings['ra'], pointings['dec'], pointings['rotSkyPos'], x, y)
+
+:func:`focal_planes` does all that, and also finds which CCDs have calexps.
+"""
+import os, re, sqlite3, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .scanner import scan
+
+# Latitude of the LSST site on Cerro Pachon, in degrees:
+LSST_LATITUDE = -30.2444
+# OpSim summary table columns (as used for DC2, with the DESC dithers):
+COLUMNS = {'ra': 'descDitheredRA', 'dec': 'descDitheredDec', 'rotTelPos': 'descDitheredRotTelPos',
+           'lst': 'lst', 'filter': 'filter', 'mjd': 'expMJD'}
+# Columns stored in radians, that we return in degrees:
+ANGLES = ['ra', 'dec', 'rotTelPos', 'lst']
+# Columns of text, rather than numbers:
+TEXT = ['filter']
+
+_local = threading.local()
+
+def connect(opsimdb):
+    """
+    Return a (read-only) connection to an OpSim database, reusing this thread's connection if it has one.
+    """
+    path = os.path.abspath(opsimdb)
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        if not os.path.exists(path):
+            raise IOError("no OpSim database at {}".format(path))
+        connections[path] = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    return connections[path]
+
+def _identifier(name):
+    # Table and column names can't be query parameters, so check them instead:
+    if not re.match(r'^[A-Za-z_]\w*$', name):
+        raise ValueError("bad SQL name '{}'".format(name))
+    return name
+
+def get_pointings(opsimdb, visits, columns=None, table='summary', id_column='obsHistID'):
+    """
+    Look up the pointings of many visits in an OpSim database, with one query.
+
+    Parameters
+    ----------
+    opsimdb: string
+        File name of the OpSim sqlite database.
+    visits: list of ints
+        The visit (obsHistID) numbers.
+    columns: dict, optional
+        Names to give the results, and the summary table columns they come
+        from [def=``COLUMNS``].
+    table, id_column: strings, optional
+        The table to query, and its visit number column [def='summary', 'obsHistID'].
+
+    Returns
+    -------
+    pointings: dict of numpy arrays
+        One entry per visit, in the order given: ``'visit'``, ``'found'``
+        (False for visits not in the database, whose other values are NaN,
+        or empty strings for the columns in ``TEXT``), each of the ``columns`` (with the angles in ``ANGLES``
+        converted to degrees), and, if the columns needed are there,
+        ``'rotSkyPos'`` (see :func:`rot_sky_pos`).
+
+    Notes
+    -----
+    The visit numbers go into a temporary table, which is joined to the
+    summary table, so the query is the same however many visits there are.
+    OpSim summary tables have a row per proposal that a visit counts
+    towards; the first one is used.
+    """
+    if columns is None:
+        columns = COLUMNS
+    names = list(columns)
+    visits = np.asarray(visits, dtype=np.int64)
+    conn = connect(opsimdb)
+    conn.execute('create temp table if not exists stackclub_visits (visit integer primary key)')
+    conn.execute('delete from temp.stackclub_visits')
+    conn.executemany('insert or ignore into temp.stackclub_visits values (?)',
+                     ((int(visit),) for visit in visits))
+    query = ('select s.{id}, {columns} from {table} s join temp.stackclub_visits v on s.{id} = v.visit '
+             'group by s.{id}').format(id=_identifier(id_column), table=_identifier(table),
+                                       columns=', '.join('s.' + _identifier(columns[name]) for name in names))
+    rows = conn.execute(query).fetchall()
+    conn.execute('delete from temp.stackclub_visits')
+
+    # Put the rows in the order of the visits asked for:
+    found_visits = np.array([row[0] for row in rows], dtype=np.int64)
+    if len(rows):
+        order = np.argsort(found_visits)
+        where = np.minimum(np.searchsorted(found_visits[order], visits), len(rows) - 1)
+        found = found_visits[order][where] == visits
+        index = order[where]
+    else:
+        found = np.zeros(len(visits), dtype=bool)
+        index = np.zeros(len(visits), dtype=np.int64)
+    pointings = {'visit': visits, 'found': found}
+    for i, name in enumerate(names):
+        values = [row[i + 1] for row in rows]
+        # Going by the values alone, a text column with no rows would come out as NaNs:
+        if name not in TEXT and all(isinstance(value, (int, float)) or value is None for value in values):
+            column = np.array(values, dtype=float)
+            result = np.full(len(visits), np.nan)
+        else:
+            column = np.array(['' if value is None else value for value in values], dtype=str)
+            result = np.full(len(visits), '', dtype=column.dtype if len(rows) else str)
+        if len(rows):
+            result[found] = column[index[found]]
+        if name in ANGLES:
+            result = np.degrees(result)
+        pointings[name] = result
+    if all(name in pointings for name in ('ra', 'dec', 'rotTelPos', 'lst')):
+        pointings['rotSkyPos'] = rot_sky_pos(pointings['ra'], pointings['dec'],
+                                             pointings['rotTelPos'], pointings['lst'])
+    return pointings
+
+def parallactic_angle(ra, dec, lst, latitude=LSST_LATITUDE):
+    """
+    Return the parallactic angle (in degrees) of sky positions, given the local sidereal time.
+
+    Parameters
+    ----------
+    ra, dec, lst: array_like
+        RA, Dec and local sidereal time, all in degrees.
+    latitude: float, optional
+        Latitude of the observatory, in degrees [def=``LSST_LATITUDE``].
+    """
+    hour_angle = np.radians(np.asarray(lst) - np.asarray(ra))
+    dec, latitude = np.radians(dec), np.radians(latitude)
+    return np.degrees(np.arctan2(np.sin(hour_angle),
+                                 np.tan(latitude) * np.cos(dec) - np.sin(dec) * np.cos(hour_angle)))
+
+def rot_sky_pos(ra, dec, rotTelPos, lst, latitude=LSST_LATITUDE):
+    """
+    Convert the rotator angle of many visits to the orientation of the camera on the sky.
+
+    Notes
+    -----
+    As in ``lsst.sims.utils.getRotSkyPos``, ``rotSkyPos = rotTelPos -
+    parallactic angle``, all in degrees. Refraction and aberration are
+    ignored, which is fine for plots.
+    """
+    return np.mod(np.asarray(rotTelPos) - parallactic_angle(ra, dec, lst, latitude), 360.0)
+
+def camera_corners(camera, detector_type=None):
+    """
+    Return the corners of a camera's detectors, as angles from the boresight.
+
+    Parameters
+    ----------
+    camera: lsst.afw.cameraGeom.Camera
+        The camera, e.g. from ``butler.get('camera')``.
+    detector_type: lsst.afw.cameraGeom.DetectorType, optional
+        Which detectors to include [def=``cameraGeom.SCIENCE``].
+
+    Returns
+    -------
+    names: list of strings
+        The detector names.
+    x, y: numpy arrays, shape (D, 4)
+        The field angles of each detector's corners, in degrees, going
+        round the detector.
+    """
+    import lsst.afw.cameraGeom as cameraGeom
+    if detector_type is None:
+        detector_type = cameraGeom.SCIENCE
+    names, corners = [], []
+    for det in camera:
+        if det.getType() != detector_type:
+            continue
+        names.append(det.getName())
+        corners.extend(det.getCorners(cameraGeom.FOCAL_PLANE))
+    angles = camera.transform(corners, cameraGeom.FOCAL_PLANE, cameraGeom.FIELD_ANGLE)
+    x = np.degrees([point.getX() for point in angles]).reshape(len(names), 4)
+    y = np.degrees([point.getY() for point in angles]).reshape(len(names), 4)
+    return names, x, y
+
+def sky_corners(ra, dec, rotSkyPos, x, y):
+    """
+    Project the corners of a camera's detectors onto the sky, for many visits at once.
+
+    Parameters
+    ----------
+    ra, dec, rotSkyPos: array_like, shape (V,)
+        The visits' pointings and camera orientations, in degrees.
+    x, y: array_like, shape (D, 4)
+        Field angles of the detector corners, in degrees (see :func:`camera_corners`).
+
+    Returns
+    -------
+    ra, dec: numpy arrays, shape (V, D, 4)
+        The sky positions of the corners, in degrees.
+
+    Notes
+    -----
+    The camera's +y axis points at position angle ``rotSkyPos`` (east of
+    north), and +x at ``rotSkyPos`` + 90 degrees; the field angles are
+    taken to be gnomonic (tangent plane) coordinates.
+    """
+    ra0 = np.radians(np.asarray(ra, dtype=float))[:, None, None]
+    dec0 = np.radians(np.asarray(dec, dtype=float))[:, None, None]
+    theta = np.radians(np.asarray(rotSkyPos, dtype=float))[:, None, None]
+    x, y = np.tan(np.radians(x))[None], np.tan(np.radians(y))[None]
+    # Tangent plane coordinates, xi to the east and eta to the north:
+    xi = x * np.cos(theta) + y * np.sin(theta)
+    eta = -x * np.sin(theta) + y * np.cos(theta)
+    denominator = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denominator)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denominator))
+    return np.mod(np.degrees(ra), 360.0), np.degrees(dec)
+
+def lsstsim_sensor(detname):
+    """
+    Turn an obs_lsstSim detector name (e.g. "R:2,2 S:1,1") into its calexp path within a visit folder ("R22/S11.fits").
+    """
+    raft, sensor = re.match(r'R:?(\d,?\d)[_ ]S:?(\d,?\d)', detname).groups()
+    return 'R{}/S{}.fits'.format(raft.replace(',', ''), sensor.replace(',', ''))
+
+def visit_folders(root, pattern=r'v0*(\d+)'):
+    """
+    Map visit numbers to the folders under ``root`` that hold their files, with one directory listing.
+
+    Parameters
+    ----------
+    root: string
+        The folder containing one sub-folder per visit, e.g. a repo's
+        ``calexp`` folder.
+    pattern: string, optional
+        Regular expression matching the sub-folder names, whose first
+        group is the visit number [def=obs_lsstSim's ``v00219976-fr``].
+    """
+    folders = {}
+    with os.scandir(root) as entries:
+        for entry in entries:
+            match = re.match(pattern, entry.name)
+            if match and entry.is_dir():
+                folders.setdefault(int(match.group(1)), []).append(entry.path)
+    return folders
+
+def focal_planes(butler, visits, opsimdb, dataset='calexp', sensor_path=lsstsim_sensor, max_workers=8):
+    """
+    Work out the sky footprints of all the CCDs of many visits, and which of them have calexps.
+
+    Parameters
+    ----------
+    butler: lsst.daf.persistence.Butler
+        The Butler serving up the calexps, and the camera.
+    visits: list of ints
+        The visit numbers.
+    opsimdb: string
+        File name of the OpSim sqlite database with the visits' pointings.
+    dataset: string, optional
+        Dataset type whose files show which CCDs are available [def='calexp'].
+    sensor_path: function, optional
+        Turns a detector name into its file's path within a visit's folder
+        [def=:func:`lsstsim_sensor`, for obs_lsstSim].
+    max_workers: int, optional
+        Number of visit folders to scan at once [def=8].
+
+    Returns
+    -------
+    footprints: dict
+        The ``'visit'`` numbers and detector ``'names'``, and numpy arrays
+        of the corners' ``'ra'`` and ``'dec'`` (shape (V, D, 4), in degrees),
+        and whether each CCD has a calexp (``'available'``, shape (V, D)).
+
+    Notes
+    -----
+    The folder of each visit's calexps is found from one calexp's file
+    name (from the first visit that has any), assuming (as in obs_lsstSim)
+    that it is two levels down from a folder with one sub-folder per visit,
+    which is then listed once. Each visit's folder is scanned once for the
+    CCDs that are there. If none of the visits has a calexp, no CCD is
+    ``available``.
+    """
+    pointings = get_pointings(opsimdb, visits)
+    names, x, y = camera_corners(butler.get('camera'))
+    ra, dec = sky_corners(pointings['ra'], pointings['dec'], pointings['rotSkyPos'], x, y)
+
+    folders = {}
+    for visit in pointings['visit']:
+        datarefs = list(butler.subset(dataset, visit=int(visit)))
+        if datarefs:
+            filename = datarefs[0].get(dataset + '_filename')[0]
+            folders = visit_folders(os.path.dirname(os.path.dirname(os.path.dirname(filename))))
+            break
+    paths = [sensor_path(name) for name in names]
+
+    def available(visit):
+        found = set()
+        for folder in folders.get(int(visit), []):
+            found.update(scan(folder, '*/*', dirs=False, max_workers=1))
+        return [path in found for path in paths]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        flags = list(pool.map(available, pointings['visit']))
+    flags = np.array(flags, dtype=bool).reshape(len(pointings['visit']), len(names))
+    flags &= pointings['found'][:, None]
+    return {'visit': pointings['visit'], 'names': names, 'ra': ra, 'dec': dec, 'available': flags}
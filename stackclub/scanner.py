@@ -0,0 +1,267 @@
+"""
+A fast, parallel scanner for the files in a (Gen2) data repo.
+
+``glob.glob`` lists every directory it passes through, one at a time, which on
+a big repo on a network filesystem can take minutes. :func:`scan` walks the
+repo with ``os.scandir`` in a pool of threads, only going into the directories
+that its pattern can match, and :class:`FileTable` parses the data ids
+(filter, tract, patch, visit, ccd) out of the paths it finds, into arrays that
+can be queried. For example::
+
+    from stackclub.scanner import scan_repo
+    coadds = scan_repo(rerun, 'deepCoadd-results/HSC-I/*/*/calexp-*.fits')
+    coadds.unique('tract')
+    coadds.select(tract=9813).patch
+"""
+import os, re, fnmatch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Regular expressions for the data ids in repo paths, tried in order - the
+# first one to find a given key sets it. Add to this list for other layouts.
+PATH_PATTERNS = [
+    # Coadds, eg deepCoadd-results/HSC-I/9813/4,4/calexp-HSC-I-9813-4,4.fits
+    # (the "filter" of merged coadd products is "merged"):
+    re.compile(r'deepCoadd-results/(?P<filter>[^/]+)/(?P<tract>\d+)(?:/(?P<patch>\d+,\d+))?'),
+    # HSC single frames, eg 00762/HSC-I/corr/CORR-0034342-049.fits:
+    re.compile(r'(?:^|/)(?P<filter>[^/]+)/(?:corr|output)/[A-Z]+-(?P<visit>\d+)-(?P<ccd>\d+)\.fits$'),
+    # LSST (DC2) single frames, eg calexp/v219976-fr/R22/calexp_219976-r-R22-S11-det094.fits:
+    re.compile(r'(?:^|/)v(?P<visit>\d+)-f(?P<filter>[^/]+)/.*det(?P<ccd>\d+)'),
+    # Anything else with a visit and ccd number on the end:
+    re.compile(r'-(?P<visit>\d{7})-(?P<ccd>\d{3})\.fits$'),
+]
+# The dataset type is (roughly) the start of the file name:
+DATASET_PATTERN = re.compile(r'^(?P<dataset>[A-Za-z]\w*?)[-_.]')
+
+def scan(root, pattern=None, max_workers=8, dirs=None):
+    """
+    Find the files (and/or directories) in a repo that match a glob-style pattern.
+
+    Parameters
+    ----------
+    root: string
+        Directory to scan.
+    pattern: string, optional
+        Pattern for the paths to find, relative to ``root``, with ``/``
+        separating the directory levels, ``*``, ``?`` and ``[]`` wildcards
+        within a level, and ``**`` for any number of directory levels (so
+        ``'**/*'`` rather than ``'**'`` to find everything). The default
+        (None) finds all files under ``root``.
+    max_workers: int, optional
+        Number of directories to list at once [def=8].
+    dirs: boolean, optional
+        Return directories (True), files (False), or both (None) [def=None,
+        or False if no pattern is given].
+
+    Returns
+    -------
+    paths: list of strings
+        Matching paths, relative to ``root``, sorted.
+
+    Notes
+    -----
+    Each directory is only listed if the pattern can match something inside
+    it, and levels of the pattern without wildcards are checked with a
+    single ``stat`` rather than by listing the directory above. As with
+    ``glob``, names starting with ``.`` are only matched by patterns that
+    start with ``.`` too.
+    """
+    if pattern is None:
+        pattern, dirs = '**/*', False if dirs is None else dirs
+    parts = [part for part in pattern.strip('/').split('/') if part != '']
+    # Each level is matched by "**" (None), a literal name, or a regex:
+    matchers = [None if part == '**' else
+                re.compile(fnmatch.translate(part)).match if any(c in part for c in '*?[') else
+                part for part in parts]
+    found = set()
+
+    def want(is_dir):
+        return dirs is None or dirs == is_dir
+
+    def listdir(relpath):
+        try:
+            with os.scandir(os.path.join(root, relpath)) as entries:
+                return [(entry.name, entry.is_dir()) for entry in entries]
+        except OSError:
+            return []
+
+    def step(relpath, level, is_dir, todo):
+        """
+        Work out what to do with a path that matches the first ``level`` parts of the pattern.
+        """
+        if level == len(parts):
+            if relpath and want(is_dir):
+                found.add(relpath)
+            return
+        if not is_dir:
+            return
+        matcher = matchers[level]
+        if isinstance(matcher, str):
+            # No wildcards, so no need to list the directory:
+            path = os.path.join(relpath, matcher) if relpath else matcher
+            full = os.path.join(root, path)
+            if os.path.exists(full):
+                step(path, level + 1, os.path.isdir(full), todo)
+            return
+        if matcher is None:
+            # "**" matches no levels, as well as any number of them:
+            step(relpath, level + 1, True, todo)
+        todo.append((relpath, level))
+
+    def expand(relpath, level, entries, todo):
+        """
+        Match the entries of a listed directory against part ``level`` of the pattern.
+        """
+        matcher = matchers[level]
+        for name, is_dir in entries:
+            path = os.path.join(relpath, name) if relpath else name
+            if matcher is None:
+                if is_dir and not name.startswith('.'):
+                    step(path, level, True, todo)
+            elif matcher(name) and (not name.startswith('.') or parts[level].startswith('.')):
+                step(path, level + 1, is_dir, todo)
+
+    todo = []
+    step('', 0, True, todo)
+    # Keep the pool busy listing directories, queuing up their subdirectories as they come back:
+    listed = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while todo or running:
+            while todo:
+                relpath, level = todo.pop()
+                if (relpath, level) in listed:
+                    continue
+                listed.add((relpath, level))
+                running[pool.submit(listdir, relpath)] = (relpath, level)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                relpath, level = running.pop(future)
+                expand(relpath, level, future.result(), todo)
+    return sorted(found)
+
+def scan_repo(root, pattern=None, max_workers=8, dirs=None):
+    """
+    Scan a repo (see :func:`scan`), and parse the data ids of the paths found.
+
+    Returns
+    -------
+    table: FileTable
+        The paths found, and their data ids.
+    """
+    return FileTable(root, scan(root, pattern=pattern, max_workers=max_workers, dirs=dirs))
+
+class FileTable(object):
+    """
+    A table of repo paths and the data ids parsed from them.
+
+    Parameters
+    ----------
+    root: string
+        The repo directory.
+    paths: list of strings
+        Paths relative to ``root``, eg as returned by :func:`scan`.
+
+    Notes
+    -----
+    Each column is a numpy array, one entry per path: ``path``,
+    ``dataset``, ``filter`` and ``patch`` are strings (empty if not
+    found in the path), and ``tract``, ``visit`` and ``ccd`` are integers
+    (-1 if not found). The paths are parsed with the regular expressions
+    in ``PATH_PATTERNS``.
+    """
+    string_columns = ['path', 'dataset', 'filter', 'patch']
+    int_columns = ['tract', 'visit', 'ccd']
+
+    def __init__(self, root, paths, columns=None):
+        self.root = root
+        if columns is None:
+            columns = self._parse(paths)
+        self.columns = columns
+        return
+
+    @classmethod
+    def _parse(cls, paths):
+        keys = cls.string_columns[1:] + cls.int_columns
+        values = {key: [] for key in keys}
+        for path in paths:
+            ids = {}
+            match = DATASET_PATTERN.match(os.path.basename(path))
+            if match:
+                ids['dataset'] = match.group('dataset')
+            for regex in PATH_PATTERNS:
+                match = regex.search(path)
+                if match:
+                    for key, value in match.groupdict().items():
+                        if value is not None and key not in ids:
+                            ids[key] = value
+            for key in keys:
+                values[key].append(ids.get(key, '' if key in cls.string_columns else -1))
+        columns = {'path': np.array(paths, dtype=str)}
+        for key in cls.string_columns[1:]:
+            columns[key] = np.array(values[key], dtype=str)
+        for key in cls.int_columns:
+            columns[key] = np.array(values[key], dtype=np.int64)
+        return columns
+
+    def __len__(self):
+        return len(self.columns['path'])
+
+    def __getattr__(self, name):
+        # Columns as attributes, eg table.tract:
+        if name != 'columns' and name in self.columns:
+            return self.columns[name]
+        raise AttributeError("'FileTable' object has no attribute '{}'".format(name))
+
+    def __repr__(self):
+        return "<FileTable of {} paths in {}>".format(len(self), self.root)
+
+    @property
+    def full_paths(self):
+        """
+        The paths, including the repo directory.
+        """
+        return [os.path.join(self.root, path) for path in self.columns['path']]
+
+    def mask(self, **criteria):
+        """
+        Return a boolean array picking out the rows that match all the criteria.
+
+        Parameters
+        ----------
+        criteria: column=value pairs
+            The value can be a single value, or a list of acceptable values,
+            eg ``filter=['HSC-G', 'HSC-R'], tract=9813``.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for key, value in criteria.items():
+            if key not in self.columns:
+                raise KeyError("no column '{}' in FileTable".format(key))
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                keep &= np.isin(self.columns[key], list(value))
+            else:
+                keep &= self.columns[key] == value
+        return keep
+
+    def select(self, **criteria):
+        """
+        Return a new FileTable with just the rows that match all the criteria (see :meth:`mask`).
+        """
+        keep = self.mask(**criteria)
+        return FileTable(self.root, None, {key: column[keep] for key, column in self.columns.items()})
+
+    def unique(self, column):
+        """
+        Return the sorted, distinct values of a column (leaving out missing ones).
+        """
+        values = np.unique(self.columns[column])
+        if column in self.int_columns:
+            return values[values >= 0]
+        return values[values != '']
+
+    def count(self, column):
+        """
+        Return a dictionary of the number of rows with each value of a column.
+        """
+        values, counts = np.unique(self.columns[column], return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
@@ -0,0 +1,371 @@
+"""
+Vectorized sky area calculations for tracts, patches and CCDs.
+
+Sky regions are passed around as NumPy arrays of polygon vertices: ``ra`` and
+``dec``, in degrees, each of shape ``(N, K)`` for ``N`` polygons with ``K``
+vertices apiece, joined by great circle arcs. That is what
+:func:`tract_vertices` returns for the tracts of a skymap.
+"""
+import numpy as np
+
+# Square degrees per steradian:
+SQDEG = (180.0 / np.pi)**2
+
+def unit_vectors(ra, dec):
+    """
+    Convert RA and Dec (in degrees) to unit vectors, with the xyz axis last.
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cosdec = np.cos(dec)
+    return np.stack([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)], axis=-1)
+
+def polygon_areas(ra, dec):
+    """
+    Compute the exact areas of some spherical polygons.
+
+    Parameters
+    ----------
+    ra, dec: array_like, shape (N, K)
+        Vertices of the polygons, in degrees, in order around each polygon
+        (either way round).
+
+    Returns
+    -------
+    area: numpy array, shape (N,)
+        Area of each polygon, in square degrees.
+
+    Notes
+    -----
+    Each polygon is split into a fan of triangles from its first vertex,
+    and the triangle areas (spherical excesses, from the formula of
+    Van Oosterom & Strackee 1983) are added up with their signs, so the
+    polygons do not need to be convex - just simple.
+    """
+    v = unit_vectors(np.atleast_2d(ra), np.atleast_2d(dec))
+    a = v[:, :1, :]
+    b = v[:, 1:-1, :]
+    c = v[:, 2:, :]
+    triple = np.einsum('nki,nki->nk', a, np.cross(b, c))
+    denominator = 1.0 + np.einsum('nki,nki->nk', a, b) + np.einsum('nki,nki->nk', b, c) \
+                      + np.einsum('nki,nki->nk', c, a)
+    excess = 2.0 * np.arctan2(triple, denominator)
+    return np.abs(excess.sum(axis=1)) * SQDEG
+
+class Pixelization(object):
+    """
+    An equal-area pixelization of the sphere, in rings of constant Dec.
+
+    Parameters
+    ----------
+    pixel_size: float, optional
+        Approximate pixel size, in arcminutes [def=5].
+
+    Notes
+    -----
+    Like HEALPix, the pixels are all the same area, and the pixel
+    boundaries lie along lines of constant Dec, which makes finding the
+    pixels inside a polygon's bounding box simple; unlike HEALPix, the
+    pixels get stretched towards the poles. Each pixel has a unique
+    integer index, ``ring * nphi + column``.
+    """
+    def __init__(self, pixel_size=5.0):
+        self.pixel_size = pixel_size
+        size = np.radians(pixel_size / 60.0)
+        self.nz = int(np.ceil(2.0 / size))
+        self.nphi = int(np.ceil(2.0 * np.pi / size))
+        self.dz = 2.0 / self.nz
+        self.dphi = 2.0 * np.pi / self.nphi
+        self.npix = self.nz * self.nphi
+        # Square degrees per pixel:
+        self.pixel_area = 4.0 * np.pi / self.npix * SQDEG
+        # Pixel center coordinates, by ring and by column:
+        self._z = -1.0 + (np.arange(self.nz) + 0.5) * self.dz
+        self._r = np.sqrt(1.0 - self._z**2)
+        phi = (np.arange(self.nphi) + 0.5) * self.dphi
+        self._cos, self._sin = np.cos(phi), np.sin(phi)
+
+    def centers(self, pixels):
+        """
+        Return the RA and Dec (in degrees) of the centers of some pixels.
+        """
+        ring, column = np.divmod(np.asarray(pixels), self.nphi)
+        return np.degrees((column + 0.5) * self.dphi), np.degrees(np.arcsin(self._z[ring]))
+
+    def pixels(self, ra, dec):
+        """
+        Return the indices of the pixels containing some points, given in degrees.
+        """
+        ring = np.clip(np.floor((np.sin(np.radians(dec)) + 1.0) / self.dz).astype(np.int64), 0, self.nz - 1)
+        column = np.floor(np.radians(np.mod(ra, 360.0)) / self.dphi).astype(np.int64) % self.nphi
+        return ring * self.nphi + column
+
+    def polygon_pixels(self, ra, dec, max_candidates=4000000):
+        """
+        Find the pixels whose centers lie inside some convex spherical polygons.
+
+        Parameters
+        ----------
+        ra, dec: array_like, shape (N, K)
+            Vertices of the polygons, in degrees.
+        max_candidates: int, optional
+            Passed on to :meth:`polygon_runs`.
+
+        Returns
+        -------
+        polygon: numpy array of ints
+            Index (0 to N-1) of the polygon containing each pixel.
+        pixel: numpy array of ints
+            Index of each pixel.
+
+        Notes
+        -----
+        A pixel inside several polygons is listed once for each of them.
+        """
+        polygon, ring, first, last = self.polygon_runs(ra, dec, max_candidates)
+        counts = last - first + 1
+        column = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(polygon, counts), np.repeat(ring, counts) * self.nphi + column
+
+    def polygon_runs(self, ra, dec, max_candidates=4000000):
+        """
+        Find the runs of pixels whose centers lie inside some convex spherical polygons.
+
+        Parameters
+        ----------
+        ra, dec: array_like, shape (N, K)
+            Vertices of the polygons, in degrees.
+        max_candidates: int, optional
+            Number of candidate pixels to test at once, for polygons that
+            have to be tested pixel by pixel; sets the memory use
+            [def=4 million].
+
+        Returns
+        -------
+        polygon: numpy array of ints
+            Index (0 to N-1) of the polygon each run is in.
+        ring, first, last: numpy arrays of ints
+            The ring of each run, and its first and last columns (from 0 to
+            ``nphi-1``, with ``first <= last``).
+
+        Notes
+        -----
+        Most polygons are scanned a ring at a time, by finding where their
+        edges cross the ring; only those around a pole, or spanning more
+        than 180 degrees of RA, are tested pixel by pixel (giving runs of
+        one pixel).
+        """
+        ra, dec = np.atleast_2d(ra).astype(float), np.atleast_2d(dec).astype(float)
+        v = unit_vectors(ra, dec)
+        edges = np.cross(v, np.roll(v, -1, axis=1))
+        # Normals to the edges, pointing into each polygon:
+        center = v.sum(axis=1)
+        center /= np.linalg.norm(center, axis=1, keepdims=True)
+        normals = edges * np.sign(np.einsum('nki,ni->nk', edges, center))[:, :, np.newaxis]
+
+        # Bounding boxes in ring and column. Great circle edges can bulge
+        # poleward of their end points, by less than 1-cos(half their length):
+        chord = np.linalg.norm(v - np.roll(v, -1, axis=1), axis=2)
+        bulge = (chord**2 / 8.0).max(axis=1) * 1.01
+        z = v[:, :, 2]
+        zmin, zmax = z.min(axis=1) - bulge, z.max(axis=1) + bulge
+        ring0 = np.clip(np.floor((zmin + 1.0) / self.dz), 0, self.nz - 1).astype(np.int64)
+        ring1 = np.clip(np.floor((zmax + 1.0) / self.dz), 0, self.nz - 1).astype(np.int64)
+        # RA range, measured from the first vertex so that RA=0 is not a problem
+        # (RA changes monotonically along each edge, so the vertices set it):
+        dra = np.mod(ra - ra[:, :1] + 180.0, 360.0) - 180.0
+        col0 = np.floor(np.radians(ra[:, 0] + dra.min(axis=1)) / self.dphi).astype(np.int64)
+        col1 = np.floor(np.radians(ra[:, 0] + dra.max(axis=1)) / self.dphi).astype(np.int64)
+        simple = dra.max(axis=1) - dra.min(axis=1) < 180.0
+        # Polygons around a pole cover all RAs:
+        for pole in (np.array([0.0, 0.0, 1.0]), np.array([0.0, 0.0, -1.0])):
+            around = (np.einsum('nki,i->nk', normals, pole) >= 0).all(axis=1)
+            col0[around], col1[around] = 0, self.nphi - 1
+            simple &= ~around
+            if pole[2] > 0:
+                ring1[around] = self.nz - 1
+            else:
+                ring0[around] = 0
+        box = (ring0, ring1, col0, col1)
+
+        polygon, ring, first, last, tricky = self._scan(np.flatnonzero(simple), np.radians(ra[:, 0]),
+                                                        np.radians(dra), v, edges, box)
+        tricky = np.concatenate([np.flatnonzero(~simple), tricky])
+        polygons, pixels = self._test(tricky, normals, box, max_candidates)
+        rings, columns = np.divmod(pixels, self.nphi)
+        # Split the runs that wrap round through RA=0 in two:
+        first, last = np.mod(first, self.nphi), np.mod(last, self.nphi)
+        wraps = last < first
+        return (np.concatenate([polygon, polygon[wraps], polygons]),
+                np.concatenate([ring, ring[wraps], rings]),
+                np.concatenate([np.where(wraps, 0, first), first[wraps], columns]),
+                np.concatenate([last, np.full(wraps.sum(), self.nphi - 1), columns]))
+
+    def _scan(self, which, phi0, dphi, v, edges, box):
+        """
+        Find the pixels inside some polygons, from where their edges cross each ring.
+
+        Returns the runs, as for :meth:`polygon_runs` but with columns that
+        can be outside 0 to ``nphi-1``, and the polygons that need testing
+        pixel by pixel instead.
+        """
+        ring0, ring1 = box[0][which], box[1][which]
+        nrings = ring1 - ring0 + 1
+        # One row per (polygon, ring) pair:
+        polygon = np.repeat(which, nrings)
+        ring = np.repeat(ring0, nrings) + np.arange(nrings.sum()) - np.repeat(np.cumsum(nrings) - nrings, nrings)
+        z, r = self._z[ring][:, np.newaxis], self._r[ring][:, np.newaxis]
+
+        # Edge properties, by polygon and edge: the edge's great circle
+        # crosses a ring where A cos(phi - alpha) = -n_z z, ...
+        n = edges[which]
+        alpha = np.repeat(np.arctan2(n[:, :, 1], n[:, :, 0]), nrings, axis=0)
+        A = np.repeat(np.hypot(n[:, :, 0], n[:, :, 1]), nrings, axis=0) * r
+        nz = np.repeat(n[:, :, 2], nrings, axis=0)
+        # ... and (RA being monotonic along an edge) the crossing is on the
+        # edge itself if it is between the RAs of the ends, a and b,
+        # counting a but not b so that vertices are not counted twice.
+        # Edges along a meridian go by Dec instead.
+        a = np.repeat(dphi[which], nrings, axis=0)
+        b = np.roll(a, -1, axis=1)
+        za = np.repeat(v[which, :, 2], nrings, axis=0)
+        zb = np.roll(za, -1, axis=1)
+        meridian = np.abs(b - a) < 1e-12
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = -nz * z / A
+        crosses = np.abs(ratio) <= 1.0
+        width = np.arccos(np.clip(ratio, -1.0, 1.0))
+        crossings = []
+        for phi in (alpha - width, alpha + width):
+            relative = np.mod(phi - phi0[polygon][:, np.newaxis] + np.pi, 2.0 * np.pi) - np.pi
+            on = np.where(meridian,
+                          (np.abs(relative - a) < 1e-9) & (((za <= z) & (z < zb)) | ((zb < z) & (z <= za))),
+                          ((a <= relative) & (relative < b)) | ((b < relative) & (relative <= a)))
+            crossings.append(np.where(crosses & on, relative, np.inf))
+        crossings = np.concatenate(crossings, axis=1)
+        K = v.shape[1]
+        crossings.sort(axis=1)
+        # Each ring goes in and out of a polygon an even number of times - if
+        # not (the ring grazes a vertex, say) fall back on testing pixels:
+        odd = np.isfinite(crossings).sum(axis=1) % 2 == 1
+        tricky = np.unique(polygon[odd])
+        ok = ~np.isin(polygon, tricky)
+        polygon, ring, crossings = polygon[ok], ring[ok], crossings[ok]
+
+        # The pixel centers between each pair of crossings are inside:
+        start = phi0[polygon][:, np.newaxis] + crossings[:, 0::2]
+        stop = phi0[polygon][:, np.newaxis] + crossings[:, 1::2]
+        first = np.ceil(start / self.dphi - 0.5)
+        last = np.floor(stop / self.dphi - 0.5)
+        run = np.isfinite(stop) & (last >= first)
+        polygon = np.repeat(polygon, K).reshape(-1, K)[run]
+        ring = np.repeat(ring, K).reshape(-1, K)[run]
+        return polygon, ring, first[run].astype(np.int64), last[run].astype(np.int64), tricky
+
+    def _test(self, which, normals, box, max_candidates):
+        """
+        Find the pixels inside some polygons, by testing every pixel in their bounding boxes.
+        """
+        ring0, ring1, col0, col1 = box
+        width = np.minimum(col1 - col0 + 1, self.nphi)
+        ncandidates = (ring1 - ring0 + 1) * width
+        polygons, pixels = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        start = 0
+        while start < len(which):
+            # Take as many polygons as fit in one batch (at least one):
+            cumulative = np.cumsum(ncandidates[which[start:]])
+            stop = start + max(1, int(np.searchsorted(cumulative, max_candidates, side='right')))
+            batch = which[start:stop]
+            counts = ncandidates[batch]
+            polygon = np.repeat(batch, counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            row, col = np.divmod(offset, np.repeat(width[batch], counts))
+            ring = row + np.repeat(ring0[batch], counts)
+            column = np.mod(col + np.repeat(col0[batch], counts), self.nphi)
+            # Pixel centers, from the ring and column look-up tables:
+            x = self._r[ring] * self._cos[column]
+            y = self._r[ring] * self._sin[column]
+            z = self._z[ring]
+            inside = np.ones(len(ring), dtype=bool)
+            for k in range(normals.shape[1]):
+                n = normals[batch, k, :]
+                inside &= (np.repeat(n[:, 0], counts) * x + np.repeat(n[:, 1], counts) * y
+                           + np.repeat(n[:, 2], counts) * z) >= 0
+            polygons.append(polygon[inside])
+            pixels.append(ring[inside] * self.nphi + column[inside])
+            start = stop
+        return np.concatenate(polygons), np.concatenate(pixels)
+
+def union_area(ra, dec, pixel_size=5.0):
+    """
+    Estimate the area covered by some convex spherical polygons, counting overlaps once.
+
+    Parameters
+    ----------
+    ra, dec: array_like, shape (N, K)
+        Vertices of the polygons, in degrees.
+    pixel_size: float, optional
+        Resolution of the pixelization used, in arcminutes [def=5].
+
+    Returns
+    -------
+    area: float
+        Area of the union of the polygons, in square degrees.
+
+    Notes
+    -----
+    The area is the number of distinct :class:`Pixelization` pixels whose
+    centers fall inside any of the polygons, times the pixel area. The
+    error is of order the perimeter of the union times the pixel size.
+    Pixels are counted from runs along each ring, so the cost scales with
+    the number of polygons and rings rather than the number of pixels.
+    """
+    pixelization = Pixelization(pixel_size)
+    polygon, ring, first, last = pixelization.polygon_runs(ra, dec)
+    return count_union(ring, first, last, pixelization.nphi) * pixelization.pixel_area
+
+def count_union(ring, first, last, nphi):
+    """
+    Count the distinct pixels in some (possibly overlapping) runs of pixels.
+
+    Parameters
+    ----------
+    ring, first, last: numpy arrays of ints
+        The runs, as returned by :meth:`Pixelization.polygon_runs`.
+    nphi: int
+        Number of pixels per ring.
+
+    Returns
+    -------
+    count: int
+        Number of pixels in at least one run.
+    """
+    if len(ring) == 0:
+        return 0
+    # Lay the rings end to end, with gaps between, and merge overlapping runs:
+    start = ring * (nphi + 1) + first
+    stop = ring * (nphi + 1) + last
+    order = np.argsort(start, kind='stable')
+    start, stop = start[order], stop[order]
+    reached = np.concatenate([[-1], np.maximum.accumulate(stop)[:-1]])
+    return int(np.maximum(stop - np.maximum(start - 1, reached), 0).sum())
+
+def tract_vertices(skyMap, tracts):
+    """
+    Collect the (inner) vertices of some tracts into arrays.
+
+    Parameters
+    ----------
+    skyMap: lsst.skymap.BaseSkyMap
+        The skymap the tracts belong to.
+    tracts: list of ints
+        Tract ids.
+
+    Returns
+    -------
+    ra, dec: numpy arrays, shape (len(tracts), 4)
+        Vertices of the tracts, in degrees.
+    """
+    vertices = np.array([[(v[0].asDegrees(), v[1].asDegrees()) for v in skyMap[tract].getVertexList()]
+                         for tract in tracts], dtype=float).reshape(len(tracts), -1, 2)
+    return vertices[:, :, 0], vertices[:, :, 1]
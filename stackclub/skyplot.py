@@ -0,0 +1,188 @@
+"""
+Fast plots of many sky polygons (tracts, patches, CCDs) at once.
+
+Rather than one ``plt.plot`` call (and one matplotlib artist) per polygon,
+:func:`plot_polygons` draws all the outlines as a single ``LineCollection``
+(or ``PolyCollection``), and above ``max_polygons`` switches to an image of
+how many polygons cover each point on the sky, which costs the same to draw
+however many polygons there are. Polygons are given as arrays of vertices, as
+in :mod:`stackclub.skyarea`.
+"""
+import numpy as np
+from .skyarea import Pixelization
+
+def wrap_ra(ra, start=None):
+    """
+    Shift some polygons' RAs so that none of them is split by the edge of the plot.
+
+    Parameters
+    ----------
+    ra: array_like, shape (N, K)
+        RA of the polygons' vertices, in degrees.
+    start: float, optional
+        RA at the left-hand (low RA) edge of the plot [def=the middle of
+        the widest gap between the polygons].
+
+    Returns
+    -------
+    ra: numpy array, shape (N, K)
+        The RAs, each polygon's continuous, between ``start`` and
+        ``start+360`` for the polygons' first vertices.
+    start: float
+        The RA of the plot edge used (which is negative if that keeps the
+        RAs below 360).
+    """
+    ra = np.atleast_2d(np.asarray(ra, dtype=float))
+    # Make each polygon continuous, measuring from its first vertex:
+    ra = ra[:, :1] + np.mod(ra - ra[:, :1] + 180.0, 360.0) - 180.0
+    if start is None:
+        centers = np.sort(np.mod(ra.mean(axis=1), 360.0))
+        if len(centers) == 0:
+            start = 0.0
+        else:
+            gaps = np.diff(np.concatenate([centers, [centers[0] + 360.0]]))
+            widest = np.argmax(gaps)
+            start = np.mod(centers[widest] + 0.5 * gaps[widest], 360.0)
+    shift = np.mod(ra[:, :1] - start, 360.0) + start - ra[:, :1]
+    ra = ra + shift
+    # Surveys across RA=0 look better from -ve RAs than beyond 360:
+    if ra.size > 0 and ra.max() > 360.0:
+        ra, start = ra - 360.0, start - 360.0
+    return ra, start
+
+def plot_polygons(ra, dec, ax=None, max_polygons=5000, pixel_size=None, fill=False,
+                  color='b', cmap='Blues', **kwargs):
+    """
+    Plot many sky polygons at once.
+
+    Parameters
+    ----------
+    ra, dec: array_like, shape (N, K)
+        Vertices of the polygons, in degrees.
+    ax: matplotlib.axes.Axes, optional
+        Axes to plot on [def=the current axes].
+    max_polygons: int, optional
+        Above this many polygons, plot an image of their coverage instead
+        of their outlines [def=5000].
+    pixel_size: float, optional
+        Pixel size of the coverage image, in arcminutes [def=about 1/500
+        of the RA range plotted].
+    fill: boolean, optional
+        Fill the polygons, rather than just drawing their outlines [def=False].
+    color: string, optional
+        Color of the polygons [def='b'].
+    cmap: string, optional
+        Color map of the coverage image [def='Blues'].
+    kwargs:
+        Passed on to the ``LineCollection``, ``PolyCollection`` or
+        ``pcolormesh``.
+
+    Returns
+    -------
+    artist: matplotlib artist
+        The collection or mesh added to the axes.
+
+    Notes
+    -----
+    RA increases to the right, as in :meth:`stackclub.taster.Taster.plot_sky_coverage`;
+    the plot is cut at the widest gap in RA between the polygons (see
+    :func:`wrap_ra`), so that surveys straddling RA=0 come out in one piece.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection, PolyCollection
+    if ax is None:
+        ax = plt.gca()
+    ra, start = wrap_ra(ra)
+    dec = np.atleast_2d(np.asarray(dec, dtype=float))
+    if len(ra) == 0:
+        return None
+    if len(ra) <= max_polygons:
+        vertices = np.stack([ra, dec], axis=-1)
+        if fill:
+            artist = PolyCollection(vertices, facecolors=color, edgecolors=color, **kwargs)
+        else:
+            # Close each outline by going back to its first vertex:
+            vertices = np.concatenate([vertices, vertices[:, :1, :]], axis=1)
+            artist = LineCollection(vertices, colors=color, **kwargs)
+        ax.add_collection(artist)
+        ax.autoscale_view()
+        return artist
+    artist = plot_coverage(ra, dec, ax=ax, pixel_size=pixel_size, start=start, cmap=cmap, **kwargs)
+    return artist
+
+def coverage_image(ra, dec, pixel_size=None, start=0.0):
+    """
+    Count the polygons covering each pixel of an RA, Dec grid.
+
+    Parameters
+    ----------
+    ra, dec: array_like, shape (N, K)
+        Vertices of the polygons, in degrees.
+    pixel_size: float, optional
+        Pixel size, in arcminutes [def=about 1/500 of the RA range covered].
+    start: float, optional
+        RA of the left-hand edge of the grid [def=0].
+
+    Returns
+    -------
+    counts: numpy array of ints, shape (nrings, ncolumns)
+        Number of polygons covering each pixel, for the range of rings
+        (Dec) and columns (RA) that the polygons cover.
+    ra_edges, dec_edges: numpy arrays
+        The pixel boundaries, in degrees, with RA from ``start`` upwards.
+
+    Notes
+    -----
+    The grid is that of a :class:`stackclub.skyarea.Pixelization`, so the
+    pixels are equal in area (evenly spaced in RA and sin(Dec)), and built
+    up from runs of pixels, a ring at a time, without looking at each
+    pixel of each polygon.
+    """
+    ra, dec = np.atleast_2d(ra), np.atleast_2d(dec)
+    if pixel_size is None:
+        unwrapped, _ = wrap_ra(ra, start)
+        span = max(unwrapped.max() - unwrapped.min(), 1.0)
+        pixel_size = max(span * 60.0 / 500.0, 0.1)
+    pixelization = Pixelization(pixel_size)
+    polygon, ring, first, last = pixelization.polygon_runs(ra, dec)
+    nphi = pixelization.nphi
+    # Columns counted from the start RA, so that the image does not wrap:
+    offset = int(np.floor(np.radians(np.mod(start, 360.0)) / pixelization.dphi))
+    first, last = np.mod(first - offset, nphi), np.mod(last - offset, nphi)
+    wraps = last < first
+    ring = np.concatenate([ring, ring[wraps]])
+    first = np.concatenate([np.where(wraps, 0, first), first[wraps]])
+    last = np.concatenate([last, np.full(wraps.sum(), nphi - 1)])
+    if len(ring) == 0:
+        return np.zeros((0, 0), dtype=int), np.zeros(1), np.zeros(1)
+    ring0, ring1 = ring.min(), ring.max()
+    col0, col1 = first.min(), last.max()
+    # Add one at the start of each run, and take one away after its end,
+    # then add up along each ring:
+    steps = np.zeros((ring1 - ring0 + 1, col1 - col0 + 2), dtype=np.int64)
+    np.add.at(steps, (ring - ring0, first - col0), 1)
+    np.add.at(steps, (ring - ring0, last - col0 + 1), -1)
+    counts = np.cumsum(steps, axis=1)[:, :-1]
+    ra_edges = np.degrees((np.arange(col0, col1 + 2) + offset) * pixelization.dphi) + start - np.mod(start, 360.0)
+    dec_edges = np.degrees(np.arcsin(np.clip(-1.0 + np.arange(ring0, ring1 + 2) * pixelization.dz, -1.0, 1.0)))
+    return counts, ra_edges, dec_edges
+
+def plot_coverage(ra, dec, ax=None, pixel_size=None, start=None, cmap='Blues', **kwargs):
+    """
+    Plot an image of how many polygons cover each point on the sky (see :func:`coverage_image`).
+
+    Returns
+    -------
+    mesh: matplotlib.collections.QuadMesh
+        The (rasterized) image.
+    """
+    import matplotlib.pyplot as plt
+    if ax is None:
+        ax = plt.gca()
+    if start is None:
+        ra, start = wrap_ra(ra)
+    counts, ra_edges, dec_edges = coverage_image(ra, dec, pixel_size=pixel_size, start=start)
+    image = np.ma.masked_equal(counts, 0)
+    kwargs.setdefault('rasterized', True)
+    mesh = ax.pcolormesh(ra_edges, dec_edges, image, cmap=cmap, **kwargs)
+    return mesh
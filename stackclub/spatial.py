@@ -0,0 +1,562 @@
+"""
+A persistent spatial index of which tracts, patches and visit CCDs cover each part of the sky.
+
+The Gen2 Butler can't answer "which tracts, patches and visits cover this
+RA/Dec box?", so :class:`SpatialIndex` keeps the answer in an sqlite file,
+built from the skymap and the calexp footprints (see :mod:`stackclub.footprints`)::
+
+    from stackclub.spatial import SpatialIndex
+    index = SpatialIndex('coverage.sqlite3')
+    index.add_skymap(butler.get('deepCoadd_skyMap'), tracts)
+    index.add_visits(butler, visits)
+    index.query_box(52.0, 58.0, -32.0, -27.0, kind='patch')
+    index.query_cone(55.0, -30.0, 0.5, kind='ccd')
+
+Each region is stored as the runs of :class:`stackclub.skyarea.Pixelization`
+pixels that it touches, so a query first finds the regions sharing pixels with
+it (in one indexed SQL join), and then checks those candidates exactly. New
+visits can be added whenever they land, without rebuilding the index.
+"""
+import json, sqlite3
+import numpy as np
+from .skyarea import Pixelization, unit_vectors, tract_vertices
+from .footprints import load_footprints, pixel_to_sky, _bbox_corners
+
+# Columns identifying a region (with '' or -1 when they don't apply):
+KEY_COLUMNS = ['kind', 'tract', 'patch', 'visit', 'ccd']
+
+SCHEMA = """
+create table if not exists meta (key text primary key, value text);
+create table if not exists regions (id integer primary key, kind text, tract integer, patch text,
+                                    visit integer, ccd text, filter text, dataId text,
+                                    ra blob, dec blob);
+create unique index if not exists regions_key on regions (kind, tract, patch, visit, ccd);
+create index if not exists regions_visit on regions (visit);
+create table if not exists runs (region integer, ring integer, first integer, last integer);
+create index if not exists runs_ring on runs (ring, first);
+create index if not exists runs_region on runs (region);
+"""
+
+class SpatialIndex(object):
+    """
+    Sky coverage index of tracts, patches and CCDs, kept in an sqlite database.
+
+    Parameters
+    ----------
+    filename: string, optional
+        The database file, which is created if it does not exist [def=':memory:',
+        for an index that only lasts as long as this object].
+    pixel_size: float, optional
+        Pixel size of the index, in arcminutes; it should be smaller than
+        the smallest region indexed [def=3, or whatever the existing index
+        file was made with].
+
+    Notes
+    -----
+    Regions are convex spherical polygons, given by their vertices as in
+    :mod:`stackclub.skyarea`. Each one is indexed by the runs of pixels it
+    touches (the pixels whose centers it contains, grown by a pixel all
+    round), so that no region overlapping a query is missed; candidates
+    are then checked exactly against the query.
+    """
+    def __init__(self, filename=':memory:', pixel_size=None):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+        stored = self.conn.execute("select value from meta where key = 'pixel_size'").fetchone()
+        if stored is not None:
+            if pixel_size is not None and float(stored[0]) != pixel_size:
+                print("WARNING: {} was made with {} arcmin pixels, using those".format(filename, stored[0]))
+            pixel_size = float(stored[0])
+        elif pixel_size is None:
+            pixel_size = 3.0
+        if stored is None:
+            with self.conn:
+                self.conn.execute("insert into meta values ('pixel_size', ?)", (repr(pixel_size),))
+        self.pixel_size = pixel_size
+        self.pixelization = Pixelization(pixel_size)
+        return
+
+    def __repr__(self):
+        return "<SpatialIndex of {} regions in {}>".format(len(self), self.filename)
+
+    def __len__(self):
+        return self.conn.execute('select count(*) from regions').fetchone()[0]
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.conn.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _runs(self, ra, dec):
+        """
+        Return the (polygon, ring, first, last) runs of pixels touched by some polygons.
+        """
+        pix = self.pixelization
+        ra, dec = np.atleast_2d(ra), np.atleast_2d(dec)
+        polygon, ring, first, last = pix.polygon_runs(ra, dec)
+        # Polygons smaller than a pixel may contain no pixel centers, but
+        # they do contain their vertices:
+        vring, vcolumn = np.divmod(pix.pixels(ra, dec).ravel(), pix.nphi)
+        polygon = np.concatenate([polygon, np.repeat(np.arange(len(ra)), ra.shape[1])])
+        ring, first, last = np.concatenate([ring, vring]), np.concatenate([first, vcolumn]), np.concatenate([last, vcolumn])
+        # Grow the runs by a pixel each way, to take in pixels that the
+        # edges cut through:
+        polygon = np.tile(polygon, 3)
+        ring = np.concatenate([ring - 1, ring, ring + 1])
+        first, last = np.tile(first - 1, 3), np.tile(last + 1, 3)
+        keep = (ring >= 0) & (ring < pix.nz)
+        polygon, ring, first, last = polygon[keep], ring[keep], first[keep], last[keep]
+        # Runs that now go past RA=0 (or 360) get their other end:
+        low, high = first < 0, last >= pix.nphi
+        polygon = np.concatenate([polygon, polygon[low], polygon[high]])
+        ring = np.concatenate([ring, ring[low], ring[high]])
+        first = np.concatenate([np.maximum(first, 0), np.full(low.sum(), pix.nphi - 1), np.zeros(high.sum(), np.int64)])
+        last = np.concatenate([np.minimum(last, pix.nphi - 1), np.full(low.sum(), pix.nphi - 1), np.zeros(high.sum(), np.int64)])
+        return merge_runs(polygon, ring, first, last)
+
+    def add(self, kind, ra, dec, ids):
+        """
+        Add some regions to the index, replacing any with the same ids.
+
+        Parameters
+        ----------
+        kind: string
+            What the regions are: 'tract', 'patch' or 'ccd' (or anything else).
+        ra, dec: array_like, shape (N, K)
+            The regions' vertices, in degrees.
+        ids: list of dicts
+            Each region's data id: any of ``tract``, ``patch``, ``visit``,
+            ``ccd`` and ``filter``, plus anything else, which is kept in the
+            ``dataId`` column.
+        """
+        ra, dec = np.atleast_2d(np.asarray(ra, dtype=float)), np.atleast_2d(np.asarray(dec, dtype=float))
+        if len(ra) == 0:
+            return
+        polygon, ring, first, last = self._runs(ra, dec)
+        rows = []
+        for i, dataId in enumerate(ids):
+            rows.append((kind, int(dataId.get('tract', -1)), str(dataId.get('patch', '')),
+                         int(dataId.get('visit', -1)), str(dataId.get('ccd', '')),
+                         str(dataId.get('filter', '')), json.dumps(dataId, sort_keys=True, default=str),
+                         ra[i].tobytes(), dec[i].tobytes()))
+        with self.conn:
+            # Replace any regions we already had:
+            self.conn.execute('create temp table if not exists stackclub_keys '
+                              '(kind text, tract integer, patch text, visit integer, ccd text)')
+            self.conn.execute('delete from temp.stackclub_keys')
+            self.conn.executemany('insert into temp.stackclub_keys values (?, ?, ?, ?, ?)', [row[:5] for row in rows])
+            old = 'select r.id from regions r join temp.stackclub_keys k using (kind, tract, patch, visit, ccd)'
+            self.conn.execute('delete from runs where region in ({})'.format(old))
+            self.conn.execute('delete from regions where id in ({})'.format(old))
+            ids = []
+            for row in rows:
+                ids.append(self.conn.execute('insert into regions (kind, tract, patch, visit, ccd, filter, dataId, ra, dec) '
+                                             'values (?, ?, ?, ?, ?, ?, ?, ?, ?)', row).lastrowid)
+            ids = np.array(ids, dtype=np.int64)
+            self.conn.executemany('insert into runs values (?, ?, ?, ?)',
+                                  zip(ids[polygon].tolist(), ring.tolist(), first.tolist(), last.tolist()))
+        return
+
+    def add_skymap(self, skyMap, tracts=None, patches=True):
+        """
+        Add some tracts of a skymap (and their patches) to the index.
+
+        Parameters
+        ----------
+        skyMap: lsst.skymap.BaseSkyMap
+            The skymap, e.g. from ``butler.get('deepCoadd_skyMap')``.
+        tracts: list of ints, optional
+            The tracts to add [def=all of them].
+        patches: boolean, optional
+            Add the tracts' patches (their outer, overlapping, boundaries) too [def=True].
+        """
+        if tracts is None:
+            tracts = [tractInfo.getId() for tractInfo in skyMap]
+        tracts = [int(tract) for tract in tracts]
+        ra, dec = tract_vertices(skyMap, tracts)
+        self.add('tract', ra, dec, [{'tract': tract} for tract in tracts])
+        if not patches:
+            return
+        for tract in tracts:
+            tractInfo = skyMap[tract]
+            nx, ny = tractInfo.getNumPatches()
+            ids, xs, ys = [], [], []
+            for x in range(nx):
+                for y in range(ny):
+                    xx, yy = _bbox_corners(tractInfo.getPatchInfo((x, y)).getOuterBBox())
+                    ids.append({'tract': tract, 'patch': '{},{}'.format(x, y)})
+                    xs.append(xx[:4])
+                    ys.append(yy[:4])
+            # All the patch corners of a tract in one WCS call:
+            ra, dec = pixel_to_sky(tractInfo.getWcs(), np.concatenate(xs), np.concatenate(ys))
+            self.add('patch', ra.reshape(-1, 4), dec.reshape(-1, 4), ids)
+        return
+
+    def add_visits(self, butler, visits, dataset='calexp', update=False, max_workers=16, repo=None):
+        """
+        Add the CCDs of some visits to the index, reading their footprints with :func:`stackclub.footprints.load_footprints`.
+
+        Parameters
+        ----------
+        butler: lsst.daf.persistence.Butler
+            The Butler serving up the visits' calexps.
+        visits: list of ints
+            The visit numbers.
+        dataset: string, optional
+            The CCD exposures' dataset type [def='calexp'].
+        update: boolean, optional
+            Read visits that are already in the index again, from the repo
+            rather than from :func:`load_footprints`'s memory, to pick up
+            CCDs that have landed since [def=False, only add new ones].
+        max_workers: int, optional
+            Number of CCDs to read at once, if ``repo`` is given [def=16].
+        repo: string, optional
+            The path to the Butler's repo, so that the CCDs can be read in
+            parallel, each thread with its own Butler [def=None, read them
+            one at a time].
+
+        Returns
+        -------
+        added: list of ints
+            The visits added.
+        """
+        if not update:
+            have = set(self.visits())
+            visits = [visit for visit in visits if int(visit) not in have]
+        added = []
+        for visit in visits:
+            footprints = load_footprints(butler, int(visit), dataset=dataset, max_workers=max_workers,
+                                         repo=repo, cache=not update)
+            ids = []
+            for dataId in footprints['dataIds']:
+                dataId = dict(dataId)
+                if 'ccd' not in dataId:
+                    # e.g. raftName and detectorName, or detector:
+                    rest = [str(value) for key, value in sorted(dataId.items())
+                            if key not in ('visit', 'filter', 'tract', 'patch')]
+                    dataId['ccd'] = str(dataId.get('detector', ','.join(rest)))
+                ids.append(dataId)
+            if ids:
+                self.add('ccd', footprints['ra'], footprints['dec'], ids)
+                added.append(int(visit))
+        return added
+
+    def remove(self, **criteria):
+        """
+        Remove the regions matching all the criteria, e.g. ``visit=219976`` or ``kind='patch'``.
+
+        Returns
+        -------
+        removed: int
+            Number of regions removed.
+        """
+        where, values = self._where(criteria)
+        with self.conn:
+            self.conn.execute('delete from runs where region in (select id from regions {})'.format(where), values)
+            removed = self.conn.execute('delete from regions {}'.format(where), values).rowcount
+        return removed
+
+    @staticmethod
+    def _where(criteria, prefix=''):
+        clauses, values = [], []
+        for key, value in criteria.items():
+            if key not in KEY_COLUMNS + ['filter', 'id']:
+                raise KeyError("can't select regions by '{}'".format(key))
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                value = list(value)
+                clauses.append('{}{} in ({})'.format(prefix, key, ', '.join('?' * len(value))))
+                values.extend(value)
+            else:
+                clauses.append('{}{} = ?'.format(prefix, key))
+                values.append(value)
+        return ('where ' + ' and '.join(clauses)) if clauses else '', values
+
+    def visits(self):
+        """
+        Return the sorted visit numbers in the index.
+        """
+        return [row[0] for row in self.conn.execute("select distinct visit from regions where kind = 'ccd' order by visit")]
+
+    def tracts(self):
+        """
+        Return the sorted tract numbers in the index.
+        """
+        return [row[0] for row in self.conn.execute("select distinct tract from regions where kind = 'tract' order by tract")]
+
+    def _candidates(self, ring, first, last, criteria):
+        """
+        Find the regions with runs overlapping some runs of pixels, and matching some criteria.
+        """
+        self.conn.execute('create temp table if not exists stackclub_runs (ring integer, first integer, last integer)')
+        self.conn.execute('delete from temp.stackclub_runs')
+        self.conn.executemany('insert into temp.stackclub_runs values (?, ?, ?)',
+                              zip(ring.tolist(), first.tolist(), last.tolist()))
+        where, values = self._where(criteria, prefix='g.')
+        query = ('select g.id, g.kind, g.tract, g.patch, g.visit, g.ccd, g.filter, g.dataId, g.ra, g.dec '
+                 'from regions g where g.id in (select distinct r.region from temp.stackclub_runs q '
+                 'join runs r on r.ring = q.ring and r.first <= q.last and r.last >= q.first) '
+                 + where.replace('where', 'and', 1))
+        rows = self.conn.execute(query, values).fetchall()
+        self.conn.execute('delete from temp.stackclub_runs')
+        return rows
+
+    @staticmethod
+    def _results(rows, keep):
+        results = []
+        for row, good in zip(rows, keep):
+            if good:
+                result = {'kind': row[1], 'tract': row[2], 'patch': row[3], 'visit': row[4],
+                          'ccd': row[5], 'filter': row[6], 'dataId': json.loads(row[7])}
+                results.append(result)
+        results.sort(key=lambda result: tuple(result[key] for key in KEY_COLUMNS))
+        return results
+
+    @staticmethod
+    def _vertices(rows):
+        """
+        Unpack the candidate regions' vertices, as unit vectors, shape (M, K, 3).
+        """
+        if not rows:
+            return np.zeros((0, 0, 3))
+        ra = np.array([np.frombuffer(row[8]) for row in rows])
+        dec = np.array([np.frombuffer(row[9]) for row in rows])
+        return unit_vectors(ra, dec)
+
+    def query_polygon(self, ra, dec, exact=True, **criteria):
+        """
+        Find the regions that overlap a convex spherical polygon.
+
+        Parameters
+        ----------
+        ra, dec: array_like, shape (K,)
+            The polygon's vertices, in degrees.
+        exact: boolean, optional
+            Check each candidate region exactly, rather than just by the
+            pixels it touches [def=True].
+        criteria: optional
+            Only return regions matching these, e.g. ``kind='ccd'``, ``filter='r'``.
+
+        Returns
+        -------
+        regions: list of dicts
+            The ``kind``, ``tract``, ``patch``, ``visit``, ``ccd`` and
+            ``filter`` of each region (with -1 or '' where they do not
+            apply), and its full ``dataId``.
+        """
+        ra, dec = np.atleast_2d(np.asarray(ra, dtype=float)), np.atleast_2d(np.asarray(dec, dtype=float))
+        polygon, ring, first, last = self._runs(ra, dec)
+        rows = self._candidates(ring, first, last, criteria)
+        if not exact or not rows:
+            return self._results(rows, [True] * len(rows))
+        q = unit_vectors(ra, dec)[0]
+        keep = polygons_overlap(self._vertices(rows), q)
+        return self._results(rows, keep)
+
+    def query_box(self, ra_min, ra_max, dec_min, dec_max, exact=True, **criteria):
+        """
+        Find the regions that overlap an RA, Dec box.
+
+        Parameters
+        ----------
+        ra_min, ra_max: float
+            RA range of the box, in degrees, going up from ``ra_min`` (so
+            ``350, 10`` is 20 degrees wide).
+        dec_min, dec_max: float
+            Dec range of the box, in degrees.
+        exact, criteria:
+            As for :meth:`query_polygon`.
+
+        Notes
+        -----
+        The box's edges of constant Dec are not great circles, so for the
+        exact check they are split into great circle arcs of up to a
+        quarter of a degree, good to better than 0.1 arcsec.
+        """
+        pix = self.pixelization
+        width = np.mod(ra_max - ra_min, 360.0) or 360.0
+        ring0, ring1 = np.clip(np.floor((np.sin(np.radians([dec_min, dec_max])) + 1.0) / pix.dz).astype(np.int64),
+                               0, pix.nz - 1)
+        col0 = int(np.floor(np.radians(np.mod(ra_min, 360.0)) / pix.dphi))
+        ncols = min(int(np.ceil(np.radians(width) / pix.dphi)) + 1, pix.nphi)
+        rings = np.arange(ring0, ring1 + 1)
+        first = np.full(len(rings), col0)
+        last = first + ncols - 1
+        # Split the runs that go past RA=360:
+        wraps = last >= pix.nphi
+        ring = np.concatenate([rings, rings[wraps]])
+        first = np.concatenate([first, np.zeros(wraps.sum(), np.int64)])
+        last = np.concatenate([np.minimum(last, pix.nphi - 1), last[wraps] - pix.nphi])
+        rows = self._candidates(ring, first, last, criteria)
+        if not exact or not rows:
+            return self._results(rows, [True] * len(rows))
+        # The box outline, going round: along the bottom, up, back along the top, and down.
+        n = max(int(np.ceil(width / 0.25)), 1)
+        ras = ra_min + width * np.arange(n + 1) / n
+        outline_ra = np.concatenate([ras, ras[::-1]])
+        outline_dec = np.concatenate([np.full(n + 1, dec_min), np.full(n + 1, dec_max)])
+        q = unit_vectors(outline_ra, outline_dec)
+        v = self._vertices(rows)
+
+        def inside(p):
+            ra, dec = np.degrees(np.arctan2(p[..., 1], p[..., 0])), np.degrees(np.arcsin(np.clip(p[..., 2], -1, 1)))
+            return (np.mod(ra - ra_min, 360.0) <= width) & (dec >= dec_min) & (dec <= dec_max)
+
+        keep = polygons_overlap(v, q, inside=inside)
+        return self._results(rows, keep)
+
+    def query_cone(self, ra, dec, radius, exact=True, **criteria):
+        """
+        Find the regions that come within some distance of a point.
+
+        Parameters
+        ----------
+        ra, dec: float
+            The center of the cone, in degrees.
+        radius: float
+            The cone's radius, in degrees (less than 90).
+        exact, criteria:
+            As for :meth:`query_polygon`.
+        """
+        pix = self.pixelization
+        # Pixel runs: for each ring, the RA range within the radius.
+        z0 = np.sin(np.radians(dec))
+        zlo, zhi = np.sin(np.radians(max(dec - radius, -90.0))), np.sin(np.radians(min(dec + radius, 90.0)))
+        ring0 = int(np.clip(np.floor((zlo + 1.0) / pix.dz), 0, pix.nz - 1))
+        ring1 = int(np.clip(np.floor((zhi + 1.0) / pix.dz), 0, pix.nz - 1))
+        rings = np.arange(ring0, ring1 + 1)
+        # The ring's edge nearest the center's Dec is where the cone is widest:
+        z = np.clip(z0, -1.0 + rings * pix.dz, -1.0 + (rings + 1) * pix.dz)
+        r, r0 = np.sqrt(1.0 - z**2), np.sqrt(1.0 - z0**2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = (np.cos(np.radians(radius)) - z0 * z) / (r0 * r)
+        half = np.where(cosine <= -1.0, np.pi, np.arccos(np.clip(cosine, -1.0, 1.0)))
+        center = np.radians(np.mod(ra, 360.0))
+        first = np.floor((center - half) / pix.dphi).astype(np.int64) - 1
+        last = np.floor((center + half) / pix.dphi).astype(np.int64) + 1
+        whole = (last - first + 1 >= pix.nphi) | (r0 == 0)
+        first, last = np.where(whole, 0, first), np.where(whole, pix.nphi - 1, last)
+        low, high = first < 0, last >= pix.nphi
+        ring = np.concatenate([rings, rings[low], rings[high]])
+        first, last = (np.concatenate([np.maximum(first, 0), first[low] + pix.nphi, np.zeros(high.sum(), np.int64)]),
+                       np.concatenate([np.minimum(last, pix.nphi - 1), np.full(low.sum(), pix.nphi - 1), last[high] - pix.nphi]))
+        rows = self._candidates(ring, first, last, criteria)
+        if not exact or not rows:
+            return self._results(rows, [True] * len(rows))
+        p = unit_vectors(ra, dec)
+        keep = distances(self._vertices(rows), p) <= np.radians(radius)
+        return self._results(rows, keep)
+
+def merge_runs(polygon, ring, first, last):
+    """
+    Merge each polygon's overlapping (or touching) runs of pixels in the same ring.
+    """
+    if len(polygon) == 0:
+        return polygon, ring, first, last
+    order = np.lexsort((first, ring, polygon))
+    polygon, ring, first, last = polygon[order], ring[order], first[order], last[order]
+    same = np.concatenate([[False], (polygon[1:] == polygon[:-1]) & (ring[1:] == ring[:-1])])
+    # A run starts a new merged run unless it begins within (or just after)
+    # the ones before it in the same ring. Offsetting each (polygon, ring)
+    # makes the running maximum start again for each one:
+    offset = (np.cumsum(~same) - 1) * (int(last.max()) + 2)
+    reached = np.maximum.accumulate(last + offset) - offset
+    new = ~same | (first > np.concatenate([[-2], reached[:-1]]) + 1)
+    run = np.cumsum(new) - 1
+    merged_last = np.zeros(run[-1] + 1, dtype=np.int64)
+    np.maximum.at(merged_last, run, last)
+    return polygon[new], ring[new], first[new], merged_last
+
+def _normals(v):
+    """
+    Inward-pointing normals to the edges of some convex polygons (unit vectors, shape (M, K, 3)).
+    """
+    edges = np.cross(v, np.roll(v, -1, axis=1))
+    center = v.sum(axis=1)
+    return edges * np.sign(np.einsum('mki,mi->mk', edges, center))[:, :, np.newaxis]
+
+def polygons_overlap(v, q, inside=None):
+    """
+    Check which of some convex spherical polygons overlap a query region.
+
+    Parameters
+    ----------
+    v: numpy array, shape (M, K, 3)
+        The polygons' vertices, as unit vectors.
+    q: numpy array, shape (Q, 3)
+        The query region's outline, as unit vectors.
+    inside: function, optional
+        Returns whether some points (unit vectors, xyz axis last) are
+        inside the query region [def=inside the convex polygon ``q``].
+
+    Returns
+    -------
+    overlap: numpy array of booleans, shape (M,)
+        Whether each polygon overlaps the query region.
+
+    Notes
+    -----
+    Two regions overlap if a vertex of either is inside the other, or if
+    their edges cross.
+    """
+    if inside is None:
+        qnormals = _normals(q[np.newaxis])[0]
+
+        def inside(p):
+            return (np.einsum('...i,ki->...k', p, qnormals) >= 0).all(axis=-1)
+
+    overlap = inside(v).any(axis=1)
+    normals = _normals(v)
+    overlap |= (np.einsum('qi,mki->mqk', q, normals) >= 0).all(axis=2).any(axis=1)
+    # Edge crossings, for the rest:
+    rest = np.flatnonzero(~overlap)
+    if len(rest):
+        a, b = v[rest], np.roll(v[rest], -1, axis=1)            # (M, K, 3)
+        c, d = q, np.roll(q, -1, axis=0)                        # (Q, 3)
+        n1 = np.cross(a, b)[:, :, np.newaxis, :]                # (M, K, 1, 3)
+        n2 = np.cross(c, d)[np.newaxis, np.newaxis, :, :]       # (1, 1, Q, 3)
+        s1 = np.einsum('mkqi,qi->mkq', np.broadcast_to(n1, n1.shape[:2] + (len(q), 3)), c)
+        s2 = np.einsum('mkqi,qi->mkq', np.broadcast_to(n1, n1.shape[:2] + (len(q), 3)), d)
+        s3 = np.einsum('mkqi,mki->mkq', np.broadcast_to(n2, a.shape[:2] + (len(q), 3)), a)
+        s4 = np.einsum('mkqi,mki->mkq', np.broadcast_to(n2, a.shape[:2] + (len(q), 3)), b)
+        straddle = (s1 * s2 < 0) & (s3 * s4 < 0)
+        # The great circles meet at +/- x; both arcs have to contain the same one:
+        x = np.cross(n1, n2)
+        same = (np.einsum('mkqi,mki->mkq', x, a + b) * np.einsum('mkqi,qi->mkq', x, c + d)) > 0
+        overlap[rest] = (straddle & same).any(axis=(1, 2))
+    return overlap
+
+def distances(v, p):
+    """
+    Return the angular distances (in radians) from a point to some convex spherical polygons (zero if inside).
+
+    Parameters
+    ----------
+    v: numpy array, shape (M, K, 3)
+        The polygons' vertices, as unit vectors.
+    p: numpy array, shape (3,)
+        The point, as a unit vector.
+    """
+    normals = _normals(v)
+    a, b = v, np.roll(v, -1, axis=1)
+    n = normals / np.linalg.norm(normals, axis=2, keepdims=True)
+    # Distance to each edge's great circle, if the nearest point of the
+    # circle is on the edge, otherwise to the nearer end:
+    height = np.einsum('mki,i->mk', n, p)
+    foot = p[np.newaxis, np.newaxis, :] - height[:, :, np.newaxis] * n
+    within = (np.einsum('mki,mki->mk', np.cross(a, foot), n) >= 0) & \
+             (np.einsum('mki,mki->mk', np.cross(foot, b), n) >= 0)
+    ends = np.minimum(np.arccos(np.clip(np.einsum('mki,i->mk', a, p), -1, 1)),
+                      np.arccos(np.clip(np.einsum('mki,i->mk', b, p), -1, 1)))
+    edge = np.where(within, np.arcsin(np.clip(np.abs(height), 0, 1)), ends)
+    distance = edge.min(axis=1)
+    return np.where((height >= 0).all(axis=1), 0.0, distance)
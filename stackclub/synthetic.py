@@ -0,0 +1,508 @@
+"""
+A synthetic, in-memory stand-in for a (Gen2) Butler and its skymap.
+
+:class:`SyntheticButler` answers ``getKeys``, ``queryMetadata``, ``get``,
+``subset`` and ``datasetExists`` for a made-up repo of any size - so many
+visits, ccds, tracts, patches and sources per ccd - without the LSST Stack, so
+that the ``stackclub`` code that talks to a Butler (the :class:`Taster`, the
+skymap helpers) can be tried out and benchmarked on any machine::
+
+    from stackclub.synthetic import SyntheticButler
+    butler = SyntheticButler(visits=100, ccds=50, tracts=20, latency=0.01)
+    taster = Taster(butler.root, butler=butler)
+
+Only the parts of the Butler, skymap, WCS and bounding box APIs that
+``stackclub`` uses are provided, and the geometry is simple: tracts are laid
+out in rings of constant Dec, like a ``RingsSkyMap``, with gnomonic WCSs.
+"""
+import os, time, threading
+from collections import Counter
+import numpy as np
+
+# Some ready-made repo sizes:
+SCALES = {
+    'small': dict(visits=20, ccds=10, tracts=4, patches=3, sources=100),
+    'medium': dict(visits=500, ccds=100, tracts=50, patches=9, sources=1000),
+    'large': dict(visits=5000, ccds=200, tracts=1000, patches=9, sources=3000),
+}
+
+class Angle(float):
+    """
+    An angle in radians, with the ``lsst.geom.Angle`` methods ``stackclub`` uses.
+    """
+    def asDegrees(self):
+        return np.degrees(float(self))
+
+    def asRadians(self):
+        return float(self)
+
+class SpherePoint(tuple):
+    """
+    A position on the sky, as an (RA, Dec) pair of :class:`Angle`.
+    """
+    def __new__(cls, ra, dec):
+        return tuple.__new__(cls, (Angle(ra), Angle(dec)))
+
+    def getRa(self):
+        return self[0]
+
+    def getDec(self):
+        return self[1]
+
+    def getPosition(self, units=None):
+        return (self[0].asDegrees(), self[1].asDegrees())
+
+class Box(object):
+    """
+    An integer pixel bounding box, from (x0, y0) to (x1, y1) inclusive.
+    """
+    def __init__(self, x0, y0, x1, y1):
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+
+    def getBeginX(self):
+        return self.x0
+
+    def getBeginY(self):
+        return self.y0
+
+    def getEndX(self):
+        return self.x1 + 1
+
+    def getEndY(self):
+        return self.y1 + 1
+
+    def getMinX(self):
+        return self.x0
+
+    def getMinY(self):
+        return self.y0
+
+    def getMaxX(self):
+        return self.x1
+
+    def getMaxY(self):
+        return self.y1
+
+    def getWidth(self):
+        return self.x1 - self.x0 + 1
+
+    def getHeight(self):
+        return self.y1 - self.y0 + 1
+
+    def getCenter(self):
+        return (0.5 * (self.x0 + self.x1), 0.5 * (self.y0 + self.y1))
+
+    def getCorners(self):
+        return [(self.x0, self.y0), (self.x1, self.y0), (self.x1, self.y1), (self.x0, self.y1)]
+
+class Wcs(object):
+    """
+    A gnomonic (TAN) WCS, centered on a given RA, Dec (in degrees) and pixel.
+    """
+    def __init__(self, ra, dec, x0, y0, scale):
+        self.ra, self.dec = np.radians(ra), np.radians(dec)
+        self.x0, self.y0 = x0, y0
+        # Radians per pixel:
+        self.scale = np.radians(scale / 3600.0)
+
+    def pixelToSkyArray(self, x, y, degrees=False):
+        """
+        Convert arrays of pixel positions to RA and Dec (in radians, unless ``degrees``).
+        """
+        # Standard coordinates, with RA increasing to the left (-x):
+        xi = -(np.asarray(x, dtype=float) - self.x0) * self.scale
+        eta = (np.asarray(y, dtype=float) - self.y0) * self.scale
+        sind, cosd = np.sin(self.dec), np.cos(self.dec)
+        denominator = cosd - eta * sind
+        ra = self.ra + np.arctan2(xi, denominator)
+        dec = np.arctan2(sind + eta * cosd, np.hypot(xi, denominator))
+        ra = np.mod(ra, 2.0 * np.pi)
+        if degrees:
+            return np.degrees(ra), np.degrees(dec)
+        return ra, dec
+
+    def pixelToSky(self, x, y=None):
+        """
+        Convert a pixel position, given as x, y or an (x, y) pair, to a :class:`SpherePoint`.
+        """
+        if y is None:
+            x, y = x
+        ra, dec = self.pixelToSkyArray([x], [y])
+        return SpherePoint(ra[0], dec[0])
+
+class PatchInfo(object):
+    def __init__(self, index, inner, outer):
+        self.index = index
+        self.inner, self.outer = inner, outer
+
+    def getIndex(self):
+        return self.index
+
+    def getInnerBBox(self):
+        return self.inner
+
+    def getOuterBBox(self):
+        return self.outer
+
+class TractInfo(object):
+    """
+    A square tract, with its own WCS, divided into ``patches`` x ``patches`` patches.
+    """
+    def __init__(self, id, ra, dec, size, overlap, patches, scale):
+        self.id = id
+        self.ctr_coord = SpherePoint(np.radians(ra), np.radians(dec))
+        npix = int(round((size + 2.0 * overlap) * 3600.0 / scale))
+        border = int(round(overlap * 3600.0 / scale))
+        self.bbox = Box(0, 0, npix - 1, npix - 1)
+        self.inner = Box(border, border, npix - 1 - border, npix - 1 - border)
+        self.wcs = Wcs(ra, dec, 0.5 * (npix - 1), 0.5 * (npix - 1), scale)
+        self.num_patches = (patches, patches)
+        self.patch_size = int(np.ceil(npix / patches))
+        ra, dec = self.wcs.pixelToSkyArray(*zip(*self.inner.getCorners()))
+        self._vertexCoordList = [SpherePoint(r, d) for r, d in zip(ra, dec)]
+
+    def getId(self):
+        return self.id
+
+    def getCtrCoord(self):
+        return self.ctr_coord
+
+    def getBBox(self):
+        return self.bbox
+
+    def getWcs(self):
+        return self.wcs
+
+    def getNumPatches(self):
+        return self.num_patches
+
+    def getVertexList(self):
+        return self._vertexCoordList
+
+    def getPatchInfo(self, index):
+        x, y = index
+        size = self.patch_size
+        inner = Box(x * size, y * size, min((x + 1) * size, self.bbox.x1 + 1) - 1,
+                    min((y + 1) * size, self.bbox.y1 + 1) - 1)
+        border = size // 20
+        outer = Box(max(inner.x0 - border, 0), max(inner.y0 - border, 0),
+                    min(inner.x1 + border, self.bbox.x1), min(inner.y1 + border, self.bbox.y1))
+        return PatchInfo((x, y), inner, outer)
+
+    def __iter__(self):
+        for x in range(self.num_patches[0]):
+            for y in range(self.num_patches[1]):
+                yield self.getPatchInfo((x, y))
+
+class SkyMap(object):
+    """
+    A skymap of square tracts, in rings of constant Dec covering the whole sky.
+
+    Parameters
+    ----------
+    tract_size: float, optional
+        Width of the tracts' inner regions, in degrees [def=1.7].
+    overlap: float, optional
+        Overlap between neighboring tracts, in degrees [def=0.05].
+    patches: int, optional
+        Number of patches along each side of a tract [def=9].
+    scale: float, optional
+        Pixel scale, in arcsec [def=0.2].
+
+    Notes
+    -----
+    Tract 0 is at the South pole, and the ids increase along each ring
+    (eastwards) and then northwards. Tracts are only made when first
+    asked for.
+    """
+    def __init__(self, tract_size=1.7, overlap=0.05, patches=9, scale=0.2):
+        self.tract_size, self.overlap, self.patches, self.scale = tract_size, overlap, patches, scale
+        nrings = int(np.ceil(180.0 / tract_size))
+        self.ring_dec = -90.0 + (np.arange(nrings) + 0.5) * 180.0 / nrings
+        self.ring_count = np.maximum(1, np.ceil(360.0 * np.cos(np.radians(self.ring_dec))
+                                                / tract_size)).astype(int)
+        self.ring_start = np.concatenate([[0], np.cumsum(self.ring_count)[:-1]])
+        self._tracts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.ring_count.sum())
+
+    def __getitem__(self, tract):
+        with self._lock:
+            if tract not in self._tracts:
+                if not 0 <= tract < len(self):
+                    raise IndexError("no tract {} in this skymap".format(tract))
+                ring = np.searchsorted(self.ring_start, tract, side='right') - 1
+                ra = 360.0 * (tract - self.ring_start[ring]) / self.ring_count[ring]
+                self._tracts[tract] = TractInfo(tract, ra, self.ring_dec[ring], self.tract_size,
+                                                self.overlap, self.patches, self.scale)
+            return self._tracts[tract]
+
+    def __iter__(self):
+        for tract in range(len(self)):
+            yield self[tract]
+
+    def generateTract(self, tract):
+        return self[tract]
+
+class DataRef(object):
+    """
+    A reference to one dataset, as returned by :meth:`SyntheticButler.subset`.
+    """
+    def __init__(self, butler, datasetType, dataId):
+        self.butler, self.datasetType, self.dataId = butler, datasetType, dataId
+
+    def get(self, datasetType=None, **rest):
+        return self.butler.get(datasetType or self.datasetType, self.dataId, **rest)
+
+    def datasetExists(self, datasetType=None, **rest):
+        return self.butler.datasetExists(datasetType or self.datasetType, self.dataId, **rest)
+
+class Exposure(object):
+    """
+    Just the bounding box and WCS of a calexp.
+    """
+    def __init__(self, bbox, wcs):
+        self.bbox, self.wcs = bbox, wcs
+
+    def getBBox(self):
+        return self.bbox
+
+    def getWcs(self):
+        return self.wcs
+
+class SyntheticButler(object):
+    """
+    A stand-in for a Gen2 Butler, serving a made-up repo of a given size.
+
+    Parameters
+    ----------
+    visits: int, optional
+        Number of visits [def=20].
+    ccds: int, optional
+        Number of ccds per visit [def=10].
+    tracts: int, optional
+        Number of tracts with coadds [def=4].
+    patches: int, optional
+        Number of patches along each side of a tract [def=3].
+    sources: int, optional
+        Mean number of sources per ccd [def=100].
+    filters: list of strings, optional
+        Filters, used in turn by the visits [def=HSC g, r and i].
+    latency: float or dict, optional
+        Seconds to wait on every call, or a dictionary of seconds by method
+        name, eg ``{'queryMetadata': 0.1}`` [def=0].
+    root: string, optional
+        Repo path, eg for :meth:`make_tree` [def='synthetic'].
+    seed: int, optional
+        Random number seed [def=0].
+
+    Attributes
+    ----------
+    calls: collections.Counter
+        Number of calls of each method so far.
+
+    Notes
+    -----
+    The coadd tracts are the ones nearest to RA, Dec = 150, 2 in a
+    :class:`SkyMap` of the given number of ``patches`` per tract, and the
+    visits are scattered over them, each with its ccds in a square grid.
+    Dataset types: ``raw``, ``calexp``, ``src``, ``calexp_md``,
+    ``calexp_bbox``, ``calexp_wcs`` and ``src_len`` (by visit and ccd),
+    ``deepCoadd_calexp``, ``deepCoadd_meas`` and ``deepCoadd_forced_src``
+    (by tract, patch and filter), and ``deepCoadd_skyMap``.
+    """
+    visit_keys = {'visit': int, 'ccd': int, 'filter': str, 'field': str, 'pointing': int}
+    coadd_keys = {'tract': int, 'patch': str, 'filter': str}
+    visit_types = ['raw', 'calexp', 'src', 'calexp_md', 'calexp_bbox', 'calexp_wcs', 'src_len']
+    coadd_types = ['deepCoadd_calexp', 'deepCoadd_meas', 'deepCoadd_forced_src']
+
+    def __init__(self, visits=20, ccds=10, tracts=4, patches=3, sources=100,
+                 filters=('HSC-G', 'HSC-R', 'HSC-I'), latency=0.0, root='synthetic', seed=0):
+        self.root = root
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.filters = list(filters)
+        self.sources = sources
+        rng = np.random.default_rng(seed)
+        self.skyMap = SkyMap(patches=patches)
+
+        # The tracts nearest the field center:
+        ring = np.searchsorted(self.skyMap.ring_start, np.arange(len(self.skyMap)), side='right') - 1
+        centers = self.skyMap.ring_dec[ring]
+        ras = 360.0 * (np.arange(len(self.skyMap)) - self.skyMap.ring_start[ring]) / self.skyMap.ring_count[ring]
+        distance = np.hypot((np.mod(ras - 150.0 + 180.0, 360.0) - 180.0) * np.cos(np.radians(centers)),
+                            centers - 2.0)
+        self.tracts = np.sort(np.argsort(distance, kind='stable')[:tracts])
+
+        # Visits, scattered over the tracts:
+        visit = np.arange(visits, dtype=np.int64) + 1000
+        home = rng.choice(self.tracts, size=visits) if tracts > 0 else np.zeros(visits, dtype=int)
+        self.visit_ra = np.empty(visits)
+        self.visit_dec = np.empty(visits)
+        for i, tract in enumerate(home):
+            center = self.skyMap[int(tract)].getCtrCoord()
+            self.visit_dec[i] = center[1].asDegrees() + rng.uniform(-0.8, 0.8)
+            self.visit_ra[i] = center[0].asDegrees() + rng.uniform(-0.8, 0.8) / np.cos(np.radians(self.visit_dec[i]))
+        ccd = np.arange(ccds, dtype=np.int64)
+        v, c = np.meshgrid(visit, ccd, indexing='ij')
+        self._visit_rows = {'visit': v.ravel(), 'ccd': c.ravel(),
+                            'filter': np.array(self.filters)[(v.ravel() % len(self.filters))],
+                            'field': np.full(v.size, 'SYNTH'),
+                            'pointing': v.ravel() // 10}
+        self._nsources = rng.poisson(sources, size=v.size)
+        self.ccds = ccds
+        self.ccd_grid = int(np.ceil(np.sqrt(max(ccds, 1))))
+
+        # Coadds: every patch of every tract, in every filter:
+        rows = [(int(t), '{},{}'.format(x, y), f) for t in self.tracts
+                for x in range(patches) for y in range(patches) for f in self.filters]
+        self._coadd_rows = {'tract': np.array([r[0] for r in rows], dtype=np.int64),
+                            'patch': np.array([r[1] for r in rows], dtype=str),
+                            'filter': np.array([r[2] for r in rows], dtype=str)}
+        return
+
+    @classmethod
+    def from_scale(cls, scale='small', **kwargs):
+        """
+        Make a butler of one of the ``SCALES``, eg 'medium'.
+        """
+        options = dict(SCALES[scale])
+        options.update(kwargs)
+        return cls(**options)
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        latency = self.latency.get(method, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+    def _rows(self, datasetType):
+        if datasetType in self.visit_types:
+            return self._visit_rows
+        if datasetType in self.coadd_types:
+            return self._coadd_rows
+        raise KeyError("unknown dataset type '{}'".format(datasetType))
+
+    def _select(self, datasetType, dataId, rest):
+        rows = self._rows(datasetType)
+        dataId = dict(dataId or {}, **rest)
+        keep = np.ones(len(next(iter(rows.values()))), dtype=bool)
+        for key, value in dataId.items():
+            if key in rows:
+                keep &= rows[key] == value
+        return rows, keep
+
+    def getKeys(self, datasetType=None, level=None):
+        self._call('getKeys')
+        if datasetType in self.visit_types:
+            return dict(self.visit_keys)
+        if datasetType in self.coadd_types:
+            return dict(self.coadd_keys)
+        if datasetType == 'deepCoadd_skyMap':
+            return {}
+        raise KeyError("unknown dataset type '{}'".format(datasetType))
+
+    def queryMetadata(self, datasetType, format, dataId=None, **rest):
+        self._call('queryMetadata')
+        keys = [format] if isinstance(format, str) else list(format)
+        rows, keep = self._select(datasetType, dataId, rest)
+        columns = [rows[key][keep] for key in keys]
+        # Distinct values (or combinations), like the registry gives:
+        values = sorted(set(zip(*[column.tolist() for column in columns])))
+        if len(keys) == 1:
+            return [value[0] for value in values]
+        return values
+
+    def _ccd(self, dataId):
+        """
+        Find the row of a visit-level dataId, and its bounding box and WCS.
+        """
+        # The visit-level rows are a full grid of visits and ccds:
+        try:
+            visit, ccd = int(dataId['visit']) - 1000, int(dataId['ccd'])
+        except (KeyError, TypeError, ValueError):
+            raise RuntimeError("no unique calexp for dataId {}".format(dataId))
+        if not (0 <= visit < len(self.visit_ra) and 0 <= ccd < self.ccds):
+            raise RuntimeError("no calexp for dataId {}".format(dataId))
+        i = visit * self.ccds + ccd
+        # 4k x 4k ccds at 0.2 arcsec/pixel, in a square grid with small gaps:
+        size, gap = 4000, 100
+        gx, gy = ccd % self.ccd_grid, ccd // self.ccd_grid
+        half = 0.5 * self.ccd_grid * (size + gap)
+        x0 = half - gx * (size + gap) - 0.5 * size
+        y0 = half - gy * (size + gap) - 0.5 * size
+        wcs = Wcs(self.visit_ra[visit], self.visit_dec[visit], x0, y0, 0.2)
+        return i, Box(0, 0, size - 1, size - 1), wcs
+
+    def get(self, datasetType, dataId=None, immediate=True, **rest):
+        self._call('get')
+        dataId = dict(dataId or {}, **rest)
+        if datasetType == 'deepCoadd_skyMap':
+            return self.skyMap
+        if datasetType in ('calexp', 'calexp_bbox', 'calexp_wcs', 'calexp_md', 'src', 'src_len'):
+            i, bbox, wcs = self._ccd(dataId)
+            if datasetType == 'calexp':
+                return Exposure(bbox, wcs)
+            if datasetType == 'calexp_bbox':
+                return bbox
+            if datasetType == 'calexp_wcs':
+                return wcs
+            if datasetType == 'calexp_md':
+                return {'NAXIS1': bbox.getWidth(), 'NAXIS2': bbox.getHeight(),
+                        'CRVAL1': np.degrees(wcs.ra), 'CRVAL2': np.degrees(wcs.dec),
+                        'CRPIX1': wcs.x0 + 1, 'CRPIX2': wcs.y0 + 1,
+                        'VISIT': int(dataId['visit']), 'CCD': int(dataId['ccd'])}
+            if datasetType == 'src_len':
+                return int(self._nsources[i])
+            return np.zeros(self._nsources[i], dtype=[('id', 'i8'), ('coord_ra', 'f8'), ('coord_dec', 'f8')])
+        raise RuntimeError("no {} dataset for dataId {}".format(datasetType, dataId))
+
+    def datasetExists(self, datasetType, dataId=None, **rest):
+        self._call('datasetExists')
+        if datasetType == 'deepCoadd_skyMap':
+            return True
+        try:
+            rows, keep = self._select(datasetType, dataId, rest)
+        except KeyError:
+            return False
+        return bool(keep.any())
+
+    def subset(self, datasetType, level=None, dataId=None, **rest):
+        self._call('subset')
+        rows, keep = self._select(datasetType, dataId, rest)
+        keys = list(self.getKeys(datasetType))
+        return [DataRef(self, datasetType, dict(zip(keys, values)))
+                for values in zip(*[rows[key][keep].tolist() for key in keys])]
+
+    def make_tree(self, root=None, files=False):
+        """
+        Make the repo's directory tree on disk, for the code that scans it.
+
+        Parameters
+        ----------
+        root: string, optional
+            Where to make it [def=this butler's ``root``].
+        files: boolean, optional
+            Also write (empty) coadd and calexp files [def=False, just the
+            ``deepCoadd-results/merged/<tract>/<patch>`` folders].
+        """
+        root = root or self.root
+        self.root = root
+        for tract, patch, filt in zip(self._coadd_rows['tract'], self._coadd_rows['patch'],
+                                      self._coadd_rows['filter']):
+            os.makedirs(os.path.join(root, 'deepCoadd-results', 'merged', str(tract), patch), exist_ok=True)
+            if files:
+                folder = os.path.join(root, 'deepCoadd-results', filt, str(tract), patch)
+                os.makedirs(folder, exist_ok=True)
+                open(os.path.join(folder, 'calexp-{}-{}-{}.fits'.format(filt, tract, patch)), 'w').close()
+        if files:
+            rows = self._visit_rows
+            for visit, ccd, filt, pointing in zip(rows['visit'], rows['ccd'], rows['filter'], rows['pointing']):
+                folder = os.path.join(root, '{:05d}'.format(pointing), filt, 'corr')
+                os.makedirs(folder, exist_ok=True)
+                open(os.path.join(folder, 'CORR-{:07d}-{:03d}.fits'.format(visit, ccd)), 'w').close()
+        return root
@@ -1,89 +1,530 @@
+import os, re, json, time, hashlib, threading, importlib, importlib.util
 import numpy as np
 from IPython.display import display, Markdown
+from .cache import cache_dir, write_atomic
+from .skyarea import tract_vertices, union_area
+from .scanner import scan_repo
+
+# Dataset keys in (rough) order of how few distinct values they have, i.e. how
+# cheap they are to list when all we want to know is whether there are any:
+CHEAP_KEYS = ['filter', 'tract', 'field', 'pointing', 'expTime', 'dateObs', 'visit', 'patch']
+
+def dataset_exists(butler, datasettype):
+    """
+    Check whether a butler knows of any datasets of the given type.
+    
+    Parameters
+    ==========
+    butler: lsst.daf.persistence.Butler
+        The butler to ask.
+    datasettype: string
+        Type of dataset to look for, eg 'calexp'.
+    
+    Returns
+    =======
+    exists: boolean
+        True if the registry lists at least one dataset of this type.
+    
+    Notes
+    =====
+    Rather than listing the full dataIds, this only asks the registry for 
+    the values of the dataset's cheapest key (see ``CHEAP_KEYS``). The Gen2
+    Butler has no way to ask for just the first matching dataId, so that
+    one short list is as close to "stop at the first one" as we can get.
+    """
+    try:
+        datasetkeys = list(butler.getKeys(datasettype).keys())
+        onekey = min(datasetkeys, key=lambda key: CHEAP_KEYS.index(key) if key in CHEAP_KEYS else len(CHEAP_KEYS))
+        metadata = butler.queryMetadata(datasettype, [onekey])
+    except:
+        return False
+    return len(metadata) > 0
+
+def dataid_index(butler, datasettype, keys=None):
+    """
+    Load the dataIds of a dataset type into columns, with a single registry query.
+    
+    Parameters
+    ==========
+    butler: lsst.daf.persistence.Butler
+        The butler to ask.
+    datasettype: string
+        Type of dataset, eg 'calexp'.
+    keys: list of strings, optional
+        The dataId keys wanted [def=all of the dataset type's keys]. 
+        Keys that the dataset type does not have are left out.
+    
+    Returns
+    =======
+    index: dict of numpy arrays
+        One array per key, with one element per dataId.
+    
+    Examples
+    ========
+    >>> index = dataid_index(butler, 'calexp', ['visit', 'filter'])
+    >>> len(np.unique(index['visit']))
+    """
+    available = list(butler.getKeys(datasettype).keys())
+    if keys is None:
+        keys = available
+    keys = [key for key in keys if key in available]
+    if not keys:
+        return {}
+    rows = butler.queryMetadata(datasettype, keys)
+    if len(keys) == 1:
+        return {keys[0]: np.asarray(rows)}
+    columns = list(zip(*rows)) if len(rows) > 0 else [[] for key in keys]
+    return {key: np.asarray(column) for key, column in zip(keys, columns)}
+
+def count_rows(butler, datasettype):
+    """
+    Count the rows in all the catalogs of a given dataset type, eg 'src'.
+    
+    Notes
+    =====
+    The row count of each catalog comes from the ``<datasettype>_len`` 
+    dataset, which only reads the FITS header, so memory use does not grow 
+    with the number of rows. (If the mapper does not provide it, each 
+    catalog is read in turn instead.)
+    """
+    keys = list(butler.getKeys(datasettype).keys())
+    rows = butler.queryMetadata(datasettype, keys)
+    total = 0
+    use_len = True
+    for row in rows:
+        dataId = dict(zip(keys, row if len(keys) > 1 else [row]))
+        if use_len:
+            try:
+                total += int(butler.get(datasettype + '_len', dataId))
+                continue
+            except:
+                pass
+        try:
+            total += len(butler.get(datasettype, dataId))
+        except:
+            # e.g. listed in the registry, but never written
+            continue
+        # The catalog is there, so it was the _len dataset that failed:
+        use_len = False
+    return total
+
+# Mappers for the repos we know about, keyed by a word to look for in the repo
+# path. They are given as "module:Class" strings so that only the obs package
+# a repo actually needs gets imported, when it is needed.
+MAPPERS = {
+    'hsc': 'lsst.obs.hsc:HscMapper',
+    'comCam': 'lsst.obs.comCam:ComCamMapper',
+    #'DC2': 'lsst.obs.lsst:LsstCamMapper',
+    'ctio0m9': 'lsst.obs.ctio0m9:Ctio0m9Mapper',
+}
+
+# Dataset types with these in their names are not worth looking for:
+REMOVE = ['_config', '_filename', '_md', '_sub', '_len', '_schema', '_metadata']
+
+# Dataset type lists already worked out in this session, by mapper:
+_interesting = {}
+
+def register_mapper(keyword, mapper):
+    """
+    Tell the Taster which mapper to use for repos with ``keyword`` in their path.
+    
+    Parameters
+    ==========
+    keyword: string
+        Word to look for in the repo path, eg 'hsc'.
+    mapper: string
+        The mapper class, as 'module:Class', eg 'lsst.obs.hsc:HscMapper'.
+    """
+    MAPPERS[keyword] = mapper
+    return
+
+def find_mapper(repo):
+    """
+    Work out which mapper a repo uses, without importing anything.
+    
+    Returns
+    =======
+    mapper: string
+        The mapper class, as 'module:Class', or None if it could not be found.
+    
+    Notes
+    =====
+    The repo's ``_mapper`` file (or, for a rerun, its 
+    ``repositoryCfg.yaml``) is read first; if neither names the mapper, 
+    the repo path is checked for the keywords in ``MAPPERS``.
+    """
+    name = None
+    try:
+        with open(os.path.join(repo, '_mapper')) as f:
+            name = f.read().strip()
+    except OSError:
+        try:
+            with open(os.path.join(repo, 'repositoryCfg.yaml')) as f:
+                match = re.search(r'mapper:\s*!!python/name:([\w.]+)', f.read())
+            if match:
+                name = match.group(1)
+        except OSError:
+            pass
+    if name:
+        return name if ':' in name else ':'.join(name.rsplit('.', 1))
+    for keyword, mapper in MAPPERS.items():
+        if repo.find(keyword) != -1:
+            return mapper
+    return None
+
+def load_mapper(mapper):
+    """
+    Import a mapper class, given as 'module:Class'.
+    """
+    module, name = mapper.split(':')
+    return getattr(importlib.import_module(module), name)
+
+def interesting_dataset_types(mapper, root=None):
+    """
+    List the dataset types a mapper knows about that are worth looking for in a repo.
+    
+    Parameters
+    ==========
+    mapper: string
+        The mapper class, as 'module:Class'.
+    root: string, optional
+        Repo to instantiate the mapper with, if it has to be.
+    
+    Returns
+    =======
+    dataset_types: list of strings
+        The mapper's dataset types, less those with any of ``REMOVE`` in their names.
+    
+    Notes
+    =====
+    Importing an obs package and instantiating its mapper is slow, so 
+    the list is cached on disk, and only worked out again when the obs 
+    package's files change (e.g. with a new version of the Stack).
+    """
+    if mapper in _interesting:
+        return _interesting[mapper]
+    # Fingerprint the obs package from where it is installed, without importing it:
+    module = mapper.split(':')[0]
+    try:
+        origin = importlib.util.find_spec(module).origin
+        version = [origin, os.stat(origin).st_mtime_ns]
+    except Exception:
+        version = None
+    cache_file = os.path.join(cache_dir('taster', 'mappers'),
+                              hashlib.sha1(mapper.encode('utf-8')).hexdigest() + '.json')
+    if version is not None:
+        try:
+            with open(cache_file) as f:
+                saved = json.load(f)
+            if saved['mapper'] == mapper and saved['version'] == version:
+                _interesting[mapper] = saved['dataset_types']
+                return _interesting[mapper]
+        except (OSError, ValueError, KeyError):
+            pass
+    all_dataset_types = load_mapper(mapper)(root=root).getDatasetTypes()
+    dataset_types = [dataset_type for dataset_type in all_dataset_types
+                     if not any(word in dataset_type for word in REMOVE)]
+    _interesting[mapper] = dataset_types
+    if version is not None:
+        try:
+            write_atomic(cache_file, json.dumps({'mapper': mapper, 'version': version,
+                                                 'dataset_types': dataset_types}).encode('utf-8'))
+        except OSError:
+            pass
+    return dataset_types
+
+AREA_LABEL = 'Total Sky Area (deg$^2$)'
 
 class Taster(object):
     """
     Worker for tasting the datasets in a Butler's repo (based mostly off of querying metadata).
     Instantiate with a repo.
+    
+    Parameters
+    ==========
+    repo: string
+        Path to the repo.
+    vb: boolean, optional
+        Verbose in operation [def=False]
+    path_to_tracts: string, optional
+        Path, relative to the repo, of the rerun containing the coadd tracts.
+    cache: boolean, optional
+        Keep the inventory on disk, and reuse the parts of it whose 
+        backing files have not changed since they were collected [def=True].
+    butler: lsst.daf.persistence.Butler, optional
+        Butler to use, instead of making one for the repo (and for the 
+        tracts rerun), eg a :class:`stackclub.synthetic.SyntheticButler`
+        [def=None].
+        
+    Notes
+    =====
+    The inventory is in three parts, each checked against the modification 
+    times of the files and folders it was collected from:
+    
+    * ``exists`` (from :meth:`what_exists`) and ``counts`` (from 
+      :meth:`count_things`) depend on the repo folder and its 
+      ``registry.sqlite3`` file;
+    * ``tracts`` and the sky area (from :meth:`estimate_sky_area`) depend 
+      on the ``deepCoadd-results/merged`` folder of the tracts rerun.
+    
+    The ``exists`` part also records whether it was collected with 
+    ``all=True``: a checklist of the few usual dataset types is not reused
+    when all of them are asked for (see :meth:`knows_what_exists`).
+    
+    Only the first level of each folder is checked, so datasets added deep
+    inside an existing folder of a repo without a registry can be missed:
+    in that case, call :meth:`what_exists`, or :meth:`count_things` or
+    :meth:`estimate_sky_area` with ``refresh=True``, to collect that part again.
     """
-    def __init__(self, repo, vb=False, path_to_tracts=''):
+    def __init__(self, repo, vb=False, path_to_tracts='', cache=True, butler=None):
         self.repo = repo
+        self.injected = butler is not None
         # Instantiate a butler, or report failure:
-        from lsst.daf.persistence import Butler
-        try:
-            self.butler = Butler(repo)
-        except:
-            self.butler = None
-            print("Warning: failed to instantiate a butler to get data from repo '"+repo+"'")
-            return None
+        if self.injected:
+            self.butler = butler
+        else:
+            from lsst.daf.persistence import Butler
+            try:
+                self.butler = Butler(repo)
+            except:
+                self.butler = None
+                print("Warning: failed to instantiate a butler to get data from repo '"+repo+"'")
+                return None
         # Set up some internal variables:
         self.vb = vb
         self.exists = {}
         self.existence = False
+        # Whether the existence checklist covers all the mapper's dataset types:
+        self.existence_all = False
         self.counts = {}
         self.tracts = []
+        # Seconds spent collecting each part of the inventory:
+        self.timings = {}
+        # Tract vertex arrays, read from the skymap when first needed:
+        self._vertices = None
         self.path_to_tracts = path_to_tracts
-        if path_to_tracts != '':
+        if self.injected:
+            self.skymap_butler = butler
+        elif path_to_tracts != '':
             try:
                 self.skymap_butler = Butler(repo + path_to_tracts)
             except:
                 self.skymap_butler = None
                 print("Warning: failed to find a skyMap for the path " + repo + path_to_tracts)
+        # Pick up whatever is still valid from the last time we looked:
+        self.cache = cache
+        self.fresh = set()
+        if cache:
+            self.load_inventory()
+        return
+    
+    def _inventory_file(self):
+        key = os.path.realpath(self.repo) + '|' + self.path_to_tracts
+        return os.path.join(cache_dir('taster'), hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+    
+    def _signatures(self):
+        """
+        Fingerprint the files and folders that each part of the inventory comes from.
+        """
+        def fingerprint(*paths):
+            stats = []
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                    stats.append([path, st.st_mtime_ns, st.st_size])
+                except OSError:
+                    stats.append([path, None, None])
+            return stats
+        registry = fingerprint(self.repo, os.path.join(self.repo, 'registry.sqlite3'))
+        tracts = fingerprint(os.path.join(self.repo + self.path_to_tracts, 'deepCoadd-results', 'merged'))
+        return {'exists': registry, 'counts': registry, 'area': tracts}
+    
+    def load_inventory(self):
+        """
+        Restore the parts of the inventory that have not changed since they were last saved.
+        
+        Returns
+        =======
+        fresh: set of strings
+            Which parts (``'exists'``, ``'counts'``, ``'area'``) were restored.
+        """
+        try:
+            with open(self._inventory_file()) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return self.fresh
+        signatures = self._signatures()
+        for part in ('exists', 'counts', 'area'):
+            if part in saved and saved[part]['signature'] == signatures[part]:
+                self.fresh.add(part)
+        if 'exists' in self.fresh:
+            self.exists.update(saved['exists']['data'])
+            self.existence = True
+            self.existence_all = saved['exists'].get('all', False)
+            if self.exists.get('deepCoadd_skyMap'):
+                self.look_for_skymap()
+            else:
+                self.skyMap = None
+        if 'counts' in self.fresh:
+            self.counts.update(saved['counts']['data'])
+        if 'area' in self.fresh:
+            self.counts.update(saved['area']['data'])
+            self.tracts = saved['area']['tracts']
+        if self.vb and self.fresh:
+            print("Restored {} from the saved inventory of {}".format(sorted(self.fresh), self.repo))
+        return self.fresh
+    
+    def inventory(self):
+        """
+        Return everything collected so far about this repo, as a dictionary.
+        
+        Returns
+        =======
+        inventory: dict
+            The ``repo`` and ``path_to_tracts``, and copies of the ``exists``
+            checklist, the ``counts``, the ``tracts`` and the ``timings``
+            (seconds taken by each method, in this session).
+        """
+        return {'repo': self.repo, 'path_to_tracts': self.path_to_tracts,
+                'exists': dict(self.exists), 'counts': dict(self.counts),
+                'tracts': [int(tract) for tract in self.tracts], 'timings': dict(self.timings)}
+    
+    def records(self):
+        """
+        Return the inventory as a flat list of records, one per item.
+        
+        Returns
+        =======
+        records: list of dicts
+            Each with the ``repo``, the ``section`` (``'exists'``, 
+            ``'counts'``, ``'tracts'`` or ``'timings'``), the item ``name``
+            and its (numerical) ``value``: 1 or 0 for whether a dataset type
+            exists, the count or area, the tract id, or the time in seconds.
+        """
+        inventory = self.inventory()
+        repo = self.repo + self.path_to_tracts
+        records = []
+        for section in ('exists', 'counts', 'timings'):
+            for name, value in inventory[section].items():
+                records.append({'repo': repo, 'section': section, 'name': name, 'value': float(value)})
+        for tract in inventory['tracts']:
+            records.append({'repo': repo, 'section': 'tracts', 'name': str(tract), 'value': float(tract)})
+        return records
+    
+    def export(self, filename, format=None):
+        """
+        Write the inventory collected so far to a file, for other programs to read.
+        
+        Parameters
+        ==========
+        filename: string
+            Name of the file to write.
+        format: string, optional
+            ``'json'`` (the :meth:`inventory` dictionary) or ``'parquet'``
+            (the :meth:`records` table, which needs ``pandas`` and 
+            ``pyarrow``) [def=from the file name extension, else 'json'].
+        """
+        if format is None:
+            format = 'parquet' if filename.endswith('.parquet') else 'json'
+        if format == 'json':
+            write_atomic(filename, json.dumps(self.inventory(), indent=1).encode('utf-8'))
+        elif format == 'parquet':
+            try:
+                import pandas as pd
+            except ImportError:
+                raise ImportError("exporting to parquet needs pandas (and pyarrow): try format='json'")
+            pd.DataFrame(self.records(), columns=['repo', 'section', 'name', 'value']).to_parquet(filename)
+        else:
+            raise ValueError("unknown export format '{}': use 'json' or 'parquet'".format(format))
+        return
+    
+    def save_inventory(self):
+        """
+        Save the inventory collected so far, to be reused next time.
+        """
+        try:
+            with open(self._inventory_file()) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        signatures = self._signatures()
+        saved['repo'] = self.repo
+        saved['path_to_tracts'] = self.path_to_tracts
+        area_keys = ['Number of Tracts', AREA_LABEL]
+        if self.existence:
+            saved['exists'] = {'signature': signatures['exists'], 'all': self.existence_all, 'data': self.exists}
+        counts = {key: value for key, value in self.counts.items() if key not in area_keys}
+        if counts:
+            saved['counts'] = {'signature': signatures['counts'], 'data': counts}
+        if AREA_LABEL in self.counts:
+            saved['area'] = {'signature': signatures['area'], 'tracts': [int(t) for t in self.tracts],
+                             'data': {key: self.counts[key] for key in area_keys if key in self.counts}}
+        try:
+            write_atomic(self._inventory_file(), json.dumps(saved, indent=1).encode('utf-8'))
+        except OSError as error:
+            if self.vb: print("Warning: could not save the inventory: {}".format(error))
         return
     
-    def what_exists(self, all=False):
+    def what_exists(self, all=False, max_workers=None, timeout=None):
         """
         Check for the existence of various useful things. 
         
         Parameters
         ==========
         all: boolean
-            If true, the method will check all possible dataset types
+            If true, the method will check all possible dataset types (of 
+            the repo's mapper, see :func:`find_mapper`)
+        max_workers: int, optional
+            Number of dataset types to check at once [def=8 if all, else 1].
+        timeout: float, optional
+            Per-dataset type time limit, in seconds [def=None].
         
         Returns
         =======
         exists: dict
             Checklist of what exists (True) and what does not (False)
         """
-        # Get mappers for all tested repos
-        from lsst.obs.hsc import HscMapper
-        from lsst.obs.comCam import ComCamMapper
-        #from lsst.obs.lsst import LsstCamMapper
-        from lsst.obs.ctio0m9 import Ctio0m9Mapper
-        
-        #select proper mapper
-        if self.repo.find('hsc') != -1: mapper = HscMapper(root=self.repo)
-        elif self.repo.find('comCam') != -1: mapper = ComCamMapper(root=self.repo)
-        #elif self.repo.find('DC2') != -1: mapper = LsstCamMapper(root=self.repo)
-        elif self.repo.find('ctio0m9') != -1: mapper = Ctio0m9Mapper(root=self.repo)
-        else: print("Unable to locate Mapper file in specified repo. Check that you selected a valid repo.")
-            
-        
         if all:
-            #collect a list of all possible dataset types
-            mapper = HscMapper(root=self.repo)
-            all_dataset_types = mapper.getDatasetTypes()
-
-            remove = ['_config', '_filename', '_md', '_sub', '_len', '_schema', '_metadata']
-
-            interesting = []
-            for dataset_type in all_dataset_types:
-                keep = True
-                for word in remove:
-                    if word in dataset_type:
-                        keep = False
-                if keep:
-                    interesting.append(dataset_type)
+            # Collect a list of all possible dataset types, from this repo's mapper
+            mapper = find_mapper(self.repo)
+            if mapper is None:
+                print("Unable to locate Mapper file in specified repo. Check that you selected a valid repo.")
+                return
+            interesting = interesting_dataset_types(mapper, root=self.repo)
         
         else: 
             interesting = ['raw', 'calexp', 'src', 'deepCoadd_calexp', 'deepCoadd_meas']
         
-        self.look_for_datasets_of_type(interesting)
+        start = time.perf_counter()
+        self.fresh.discard('exists')
+        if max_workers is None:
+            max_workers = 8 if all else 1
+        self.look_for_datasets_of_type(interesting, max_workers=max_workers, timeout=timeout)
         self.look_for_skymap()
         self.existence = True
+        self.existence_all = bool(all)
+        self.timings['what_exists'] = time.perf_counter() - start
+        if self.cache: self.save_inventory()
         return
     
-    def look_for_datasets_of_type(self, datasettypes):
+    def knows_what_exists(self, all=False):
+        """
+        Check whether the existence checklist is already good enough, or :meth:`what_exists` needs to run.
+        
+        Parameters
+        ==========
+        all: boolean, optional
+            Whether all the mapper's dataset types are wanted [def=False].
+        
+        Returns
+        =======
+        known: boolean
+            True if the checklist has been collected (or restored from the
+            saved inventory), with ``all=True`` if that is what is asked.
+        """
+        return self.existence and (self.existence_all or not all)
+    
+    def look_for_datasets_of_type(self, datasettypes, max_workers=1, timeout=None):
         """
         Check whether dataset of given type is in the metadata.
         
@@ -91,21 +532,42 @@ class Taster(object):
         ==========
         datasettype: list of strings
             Types of dataset to check for, eg 'calexp', 'raw', 'wcs' etc. 
+        max_workers: int, optional
+            Number of dataset types to check at the same time [def=1].
+        timeout: float, optional
+            Give up on a dataset type (and record it as not existing) if 
+            checking for it takes longer than this many seconds [def=None, no limit].
+        
+        Notes
+        =====
+        Each check asks the registry for the values of just one of the 
+        dataset's keys - the one expected to have the fewest distinct values.
+        With ``max_workers > 1``, the checks run in a pool of threads, each 
+        with its own Butler (the Gen2 sqlite registry cannot be shared between 
+        threads).
+        
+        Python threads cannot be killed, so a check that times out is only
+        abandoned: its thread (and that thread's Butler) carries on in the
+        background until the registry query returns.
         """
         datasets_that_exist = []
         datasets_that_do_not_exist = []
+        datasets_that_timed_out = []
         
-        for datasettype in datasettypes:        
-            try:
-                datasetkeys = self.butler.getKeys(datasettype)
-                onekey = list(datasetkeys.keys())[0]
-                metadata = self.butler.queryMetadata(datasettype, [onekey])
+        if max_workers > 1 or timeout is not None:
+            results, datasets_that_timed_out = self._probe_in_threads(datasettypes, max_workers, timeout)
+        else:
+            results = {datasettype: dataset_exists(self.butler, datasettype) for datasettype in datasettypes}
+        
+        for datasettype in datasettypes:
+            if results.get(datasettype, False):
                 #if self.vb: print("{} dataset exists.".format(datasettype))
                 datasets_that_exist.append(datasettype)
                 self.exists[datasettype] = True
-            except:
+            else:
                 #if self.vb: print("{} dataset doesn't exist.".format(datasettype))
-                datasets_that_do_not_exist.append(datasettype)
+                if datasettype not in datasets_that_timed_out:
+                    datasets_that_do_not_exist.append(datasettype)
                 self.exists[datasettype] = False
         
         #Organize output
@@ -114,9 +576,69 @@ class Taster(object):
             print(datasets_that_exist)
             print("\nDatasets that do not exist\n--------------------------")
             print(datasets_that_do_not_exist)
+            if datasets_that_timed_out:
+                print("\nDatasets that timed out\n-----------------------")
+                print(datasets_that_timed_out)
             
         return
     
+    def _probe_in_threads(self, datasettypes, max_workers, timeout):
+        """
+        Run dataset_exists on many dataset types in a thread pool, with a per-type timeout.
+        
+        Returns
+        =======
+        results: dict
+            Whether each (completed) dataset type exists.
+        timed_out: list of strings
+            The dataset types that took too long.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        local = threading.local()
+        started = {}
+        
+        def probe(datasettype):
+            started[datasettype] = time.monotonic()
+            if not hasattr(local, 'butler'):
+                local.butler = self._new_butler()
+            return dataset_exists(local.butler, datasettype)
+        
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        pending = {pool.submit(probe, datasettype): datasettype for datasettype in datasettypes}
+        results, timed_out = {}, []
+        # Stuck probes hold on to their threads, so queued ones may never start:
+        # give up on everything after enough time for every batch to time out.
+        if timeout is not None:
+            deadline = time.monotonic() + timeout * (len(datasettypes) // max_workers + 2)
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=None if timeout is None else min(timeout, 0.1),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+                if timeout is None:
+                    continue
+                now = time.monotonic()
+                for future, datasettype in list(pending.items()):
+                    if now > deadline or now - started.get(datasettype, now) > timeout:
+                        timed_out.append(pending.pop(future))
+        finally:
+            # Drop the probes that never started (by hand, rather than with
+            # shutdown's cancel_futures, which needs Python 3.9):
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+        return results, timed_out
+    
+    def _new_butler(self):
+        """
+        Make another Butler for this repo (for use in another thread).
+        """
+        if self.injected:
+            return self.butler
+        from lsst.daf.persistence import Butler
+        return Butler(self.repo)
+    
     def look_for_skymap(self):
         """
         Check for the existence of a skymap. 
@@ -133,25 +655,41 @@ class Taster(object):
     
        
     
-    def estimate_sky_area(self):
+    def estimate_sky_area(self, pixel_size=5.0, refresh=False):
         """
         Use available skymap to estimate sky area covered by tracts and patches.
         
+        Parameters
+        ==========
+        pixel_size: float, optional
+            Resolution, in arcminutes, of the pixelization used to find the 
+            area of the union of the tracts [def=5].
+        refresh: boolean, optional
+            Find the tracts and their area again, even if they are already
+            known (e.g. from the saved inventory) [def=False].
+        
         Returns
         =======
         area: float
             Sky area in square degrees
+        
+        Notes
+        =====
+        Neighbouring tracts overlap, so the area is that of their union 
+        (see :func:`stackclub.skyarea.union_area`), not the sum of their 
+        areas.
         """
         if self.skyMap is None: return None
         
-        area_label = 'Total Sky Area (deg$^2$)'
-        if area_label in self.counts.keys():
+        area_label = AREA_LABEL
+        if area_label in self.counts.keys() and not refresh:
             return self.counts[area_label]
+        self.fresh.discard('area')
         
-        # Collect tracts from files
-        import os, glob
-        tracts = sorted([int(os.path.basename(x)) for x in
-                 glob.glob(os.path.join(self.repo + self.path_to_tracts, 'deepCoadd-results', 'merged', '*'))])
+        start = time.perf_counter()
+        # Collect tracts from the merged coadd folders
+        merged = scan_repo(self.repo + self.path_to_tracts, 'deepCoadd-results/merged/*', dirs=True)
+        tracts = [int(tract) for tract in merged.unique('tract')]
         
         self.tracts = tracts
         self.counts['Number of Tracts'] = len(tracts)
@@ -159,100 +697,349 @@ class Taster(object):
         # Note: We'd like to do this with the butler, but it appears 'tracts' have to be
         #       specified in the dataId to be queried, so the queryMetadata method fails
 
-        # Calculate area from all tracts
-        total_area = 0.0  #deg^2
-        plotting_vertices = []
-        for test_tract in tracts:
-            # Get inner vertices for tract
-            tractInfo = self.skyMap[test_tract]
-            vertices = tractInfo._vertexCoordList
-            plotting_vertices.append(vertices)
-
-            # Calculate area of box
-            av_dec = 0.5 * (vertices[2][1] + vertices[0][1])
-            av_dec = av_dec.asRadians()
-            delta_ra_raw = vertices[0][0] - vertices[1][0] 
-            delta_ra = delta_ra_raw.asDegrees() * np.cos(av_dec)
-            delta_dec= vertices[2][1] - vertices[0][1]
-            area = delta_ra * delta_dec.asDegrees()
-
-            # Combine areas
-            total_area += area
-
+        # Calculate the area covered by all the tracts, counting their overlaps once:
+        if len(tracts) > 0:
+            ra, dec = self._tract_vertices()
+            total_area = union_area(ra, dec, pixel_size=pixel_size)
+        else:
+            total_area = 0.0
+        
         if self.vb: print(area_label, ": ", total_area)
 
         # Round of the total area for table purposes
         self.counts[area_label] = round(total_area, 2)
+        self.timings['estimate_sky_area'] = time.perf_counter() - start
+        if self.cache: self.save_inventory()
         return self.counts[area_label]
 
-    def count_things(self):
+    def count_things(self, refresh=False):
         """
         Count the available number of calexp visits, sensors, fields etc.
+        
+        Parameters
+        ==========
+        refresh: boolean, optional
+            Count them again, even if the counts were restored from the 
+            saved inventory [def=False].
+        
+        Notes
+        =====
+        If the counts were restored from the saved inventory (see 
+        :meth:`load_inventory`), they are not collected again unless 
+        ``refresh`` is True.
         """
-        # Collect numbers of images of various kinds:
-        if self.exists['calexp']:
-            self.counts['Number of Visits'] = \
-                len(self.butler.queryMetadata('calexp', ['visit']))
-            self.counts['Number of Pointings'] = \
-                len(self.butler.queryMetadata('calexp', ['pointing']))
-            self.counts['Number of Sensor Visits'] = \
-                len(self.butler.queryMetadata('calexp', ['ccd']))
-            self.counts['Number of Fields'] = \
-                len(self.butler.queryMetadata('calexp', ['field']))
-            self.counts['Number of Filters'] = \
-                len(self.butler.queryMetadata('calexp', ['filter']))
+        if 'counts' in self.fresh and not refresh:
+            return
+        self.fresh.discard('counts')
+        start = time.perf_counter()
+        # Collect numbers of images of various kinds, from one scan of the calexp dataIds:
+        if self.exists.get('calexp'):
+            index = dataid_index(self.butler, 'calexp', ['visit', 'pointing', 'ccd', 'field', 'filter'])
+            for label, key in [('Number of Visits', 'visit'),
+                               ('Number of Pointings', 'pointing'),
+                               ('Number of Sensor Visits', 'ccd'),
+                               ('Number of Fields', 'field'),
+                               ('Number of Filters', 'filter')]:
+                if key in index:
+                    self.counts[label] = len(np.unique(index[key]))
         # Collect number of objects from Source Catalog
-        if self.exists['src']:
-            self.counts['Number of Sources'] = \
-                len(self.butler.queryMetadata('src', ['id']))
+        if self.exists.get('src'):
+            self.counts['Number of Sources'] = count_rows(self.butler, 'src')
+        self.timings['count_things'] = time.perf_counter() - start
+        if self.cache: self.save_inventory()
         return
     
-    def plot_sky_coverage(self):
+    def _tract_vertices(self):
+        """
+        Return the vertices of the tracts as arrays (see :func:`stackclub.skyarea.tract_vertices`).
+        """
+        if self._vertices is None or self._vertices[0] != list(self.tracts):
+            self._vertices = (list(self.tracts),) + tract_vertices(self.skyMap, self.tracts)
+        return self._vertices[1:]
+
+    def plot_sky_coverage(self, show=True, max_polygons=5000):
+        """
+        Plot the outlines of the tracts.
+        
+        Parameters
+        ==========
+        show: boolean, optional
+            Call ``plt.show()`` (which can block, outside a notebook) [def=True].
+        max_polygons: int, optional
+            With more tracts than this, plot an image of how many tracts 
+            cover each point instead of their outlines [def=5000].
+        
+        Returns
+        =======
+        fig: matplotlib.figure.Figure
+            The figure, eg to save to a file.
+        
+        Notes
+        =====
+        All the tracts are drawn at once, see 
+        :func:`stackclub.skyplot.plot_polygons`.
+        """
         import matplotlib.pyplot as plt
+        from .skyplot import plot_polygons
         fig = plt.figure()
 
-        for tract in self.tracts:
-            tractInfo = self.skyMap[tract]
-
-            corners = [(x[0].asDegrees(), x[1].asDegrees()) for x in tractInfo.getVertexList()]
-            x = [k[0] for k in corners] + [corners[0][0]]
-            y = [k[1] for k in corners] + [corners[0][1]]
-
-            plt.plot(x,y, color='b')
+        if len(self.tracts) > 0:
+            ra, dec = self._tract_vertices()
+            plot_polygons(ra, dec, ax=fig.gca(), max_polygons=max_polygons, color='b')
 
         plt.xlabel('RA (deg)')
         plt.ylabel('Dec (deg)')
         plt.title('2D Projection of Sky Coverage')
 
-        plt.show()
-        return 
+        if show: plt.show()
+        return fig
 
+    def _steps(self, all=False):
+        """
+        The methods that collect each section of the inventory, and what to report for each.
+        """
+        area_keys = ['Number of Tracts', AREA_LABEL]
+        def exists():
+            if not self.knows_what_exists(all=all): self.what_exists(all=all)
+        return [('exists', exists, lambda: dict(self.exists)),
+                ('area', self.estimate_sky_area,
+                 lambda: dict({key: self.counts[key] for key in area_keys if key in self.counts},
+                              tracts=list(self.tracts))),
+                ('counts', self.count_things,
+                 lambda: {key: value for key, value in self.counts.items() if key not in area_keys}),
+                ('timings', lambda: None, lambda: dict(self.timings))]
     
-    def report(self):
+    def sections(self, all=False):
         """
-        Print a nice report of the data available in this repo.
+        Collect the inventory, yielding each section as soon as it is ready.
+        
+        Parameters
+        ==========
+        all: boolean, optional
+            Passed on to :meth:`what_exists` [def=False].
+        
+        Yields
+        ======
+        name: string
+            ``'exists'``, then ``'area'``, ``'counts'`` and ``'timings'``.
+        section: dict
+            The checklist of dataset types, the number of tracts, sky area 
+            and tract ids, the other counts, and the time taken by each step.
+        
+        Notes
+        =====
+        The existence checks are usually quick, and counting things slow,
+        so this lets you see (or save) what is there without waiting for 
+        the counts. For use in an ``asyncio`` event loop, see 
+        :meth:`asections`.
+        """
+        for name, collect, section in self._steps(all=all):
+            collect()
+            yield name, section()
+    
+    async def asections(self, all=False):
+        """
+        Asynchronous version of :meth:`sections`: each step runs in a thread, so the event loop is not held up.
+        
+        Notes
+        =====
+        The Butler is not known to be safe to use from several threads, so 
+        all the steps run, one after the other, in a single thread of their
+        own (not in the event loop's default executor, whose threads may 
+        also be running other code against the same Butler).
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for name, collect, section in self._steps(all=all):
+                await loop.run_in_executor(executor, collect)
+                yield name, section()
+        finally:
+            executor.shutdown(wait=False)
+    
+    def report(self, show=True):
         """
-        # First check what's there:
-        if not self.existence: self.what_exists()
+        Print a nice report of the data available in this repo.
         
-        # Then, get the numbers:
-        self.count_things()
-        self.estimate_sky_area()
+        Parameters
+        ==========
+        show: boolean, optional
+            Show the sky coverage plot with ``plt.show()`` [def=True].
         
+        Notes
+        =====
+        Each table is displayed as soon as its numbers are in, see 
+        :meth:`sections`.
+        """
         # A nice bold section heading:
         display(Markdown('### Main Repo: %s' % self.repo))
         if self.path_to_tracts != '':
             display(Markdown('### Specified Tract Directory: %s' %self.path_to_tracts))
 
-        # Make a table of the collected metadata
-        output_table = "|   Metadata Characteristics  |  | \n  | :---: | --- | \n "
-        for key in self.counts.keys():
-            output_table += "| %s |  %s | \n" %(key, self.counts[key])
-        
-        # Display it:
-        display(Markdown(output_table))
+        for name, section in self.sections():
+            if name == 'exists':
+                output_table = "|   Dataset Type  | Exists | \n  | :---: | --- | \n "
+            elif name in ('area', 'counts'):
+                output_table = "|   Metadata Characteristics  |  | \n  | :---: | --- | \n "
+            else:
+                continue
+            rows = 0
+            for key in section.keys():
+                if key == 'tracts': continue
+                output_table += "| %s |  %s | \n" %(key, section[key])
+                rows += 1
+            # Display it:
+            if rows > 0: display(Markdown(output_table))
         
         # Plot sky coverage
-        self.plot_sky_coverage()
+        if self.skyMap is not None:
+            self.plot_sky_coverage(show=show)
+
+        return
+
+def taste(repo, path_to_tracts='', all=False, cache=True):
+    """
+    Inventory one repo, catching any errors: this is what :func:`survey` runs in each worker process.
+    
+    Parameters
+    ==========
+    repo: string
+        Path to the repo.
+    path_to_tracts: string, optional
+        Path, relative to the repo, of the rerun containing the coadd tracts.
+    all: boolean, optional
+        Check all the mapper's dataset types (see :meth:`Taster.what_exists`) [def=False].
+    cache: boolean, optional
+        Use the saved inventory (see :class:`Taster`) [def=True].
+    
+    Returns
+    =======
+    result: dict
+        As returned by :meth:`Taster.inventory`, plus the time taken 
+        (``'seconds'``) and the error message if it failed (``'error'``, 
+        otherwise None).
+    """
+    start = time.perf_counter()
+    result = {'repo': repo, 'path_to_tracts': path_to_tracts, 'exists': {}, 'counts': {}, 'tracts': []}
+    try:
+        taster = Taster(repo, path_to_tracts=path_to_tracts, cache=cache)
+        if taster.butler is None:
+            raise RuntimeError("failed to instantiate a butler for repo '{}'".format(repo))
+        if not taster.knows_what_exists(all=all):
+            taster.what_exists(all=all)
+        taster.count_things()
+        taster.estimate_sky_area()
+        result.update(taster.inventory())
+        result['error'] = None
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['seconds'] = time.perf_counter() - start
+    return result
 
+def survey(repos, all=False, cache=True, max_workers=None):
+    """
+    Inventory several repos at once, in a pool of worker processes.
+    
+    Parameters
+    ==========
+    repos: list
+        Repos to inventory, each either a path or a ``(path, path_to_tracts)`` pair.
+    all: boolean, optional
+        Check all the mappers' dataset types [def=False].
+    cache: boolean, optional
+        Use the saved inventories (see :class:`Taster`) [def=True].
+    max_workers: int, optional
+        Number of worker processes [def=one per CPU, up to the number of repos].
+    
+    Yields
+    ======
+    result: dict
+        The result of :func:`taste` for each repo, as soon as it is finished 
+        (so not necessarily in the order given).
+    
+    Notes
+    =====
+    A repo that fails only spoils its own result: errors are reported in 
+    the result's ``'error'`` entry. If a worker process dies altogether 
+    (taking the pool down with it), the repos that were still going are 
+    tried again, each in a process of its own.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+    jobs = [(repo, '') if isinstance(repo, str) else tuple(repo) for repo in repos]
+    if not jobs:
         return
+    if max_workers is None:
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+    retry = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(taste, repo, path_to_tracts, all, cache): (repo, path_to_tracts)
+                   for repo, path_to_tracts in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                retry.append(futures[future])
+    # The repos caught up in a crash, one at a time, so that a repo that
+    # crashes its worker again does not take the others with it:
+    for repo, path_to_tracts in retry:
+        start = time.perf_counter()
+        try:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                yield pool.submit(taste, repo, path_to_tracts, all, cache).result()
+        except BrokenProcessPool:
+            yield {'repo': repo, 'path_to_tracts': path_to_tracts, 'exists': {}, 'counts': {}, 'tracts': [],
+                   'error': 'BrokenProcessPool: the worker process died', 'seconds': time.perf_counter() - start}
+    return
+
+def comparison_table(results):
+    """
+    Make a Markdown table comparing the inventories of several repos.
+    
+    Parameters
+    ==========
+    results: list of dicts
+        As yielded by :func:`survey`.
+    
+    Returns
+    =======
+    table: string
+        One column per repo, and one row per count, plus rows for the 
+        time taken and any error.
+    """
+    labels = []
+    for result in results:
+        for label in result['counts']:
+            if label not in labels:
+                labels.append(label)
+    names = [result['repo'] + result['path_to_tracts'] for result in results]
+    table = "|   Metadata Characteristics  | " + " | ".join(names) + " | \n"
+    table += "  | :---: | " + " | ".join(['---'] * len(results)) + " | \n "
+    for label in labels:
+        table += "| %s | " % label + " | ".join(str(result['counts'].get(label, '')) for result in results) + " | \n"
+    table += "| Time Taken (s) | " + " | ".join('%.1f' % result['seconds'] for result in results) + " | \n"
+    if any(result['error'] for result in results):
+        table += "| Error | " + " | ".join(result['error'] or '' for result in results) + " | \n"
+    return table
+
+def survey_report(repos, all=False, cache=True, max_workers=None):
+    """
+    Inventory several repos in parallel (see :func:`survey`), reporting on each as it finishes, then compare them.
+    
+    Returns
+    =======
+    results: list of dicts
+        As yielded by :func:`survey`, in the order of ``repos``.
+    """
+    results = []
+    for result in survey(repos, all=all, cache=cache, max_workers=max_workers):
+        status = 'failed (%s)' % result['error'] if result['error'] else 'done'
+        display(Markdown('**%s%s**: %s in %.1f s' % (result['repo'], result['path_to_tracts'],
+                                                     status, result['seconds'])))
+        results.append(result)
+    order = [(repo, '') if isinstance(repo, str) else tuple(repo) for repo in repos]
+    results.sort(key=lambda result: order.index((result['repo'], result['path_to_tracts'])))
+    display(Markdown(comparison_table(results)))
+    return results
@@ -0,0 +1,491 @@
+"""
+A pyramid of map tiles holding the outlines of tracts, patches and visit CCDs, for smooth interactive browsing.
+
+Redrawing every polygon of a survey on every pan and zoom gets slower as the
+survey grows. :func:`build_tiles` does the work once, up front: it cuts the
+sky into square RA, Dec tiles at a range of zoom levels, and saves in each
+tile only what can be seen in it at that zoom - an image of how many polygons
+cover each point when they would be too small to make out, and their
+(simplified) outlines when they are big enough. A viewer then only reads the
+handful of tiles in view::
+
+    from stackclub.tiles import build_tiles, layers_from_index, TilePyramid
+    build_tiles('skymap_tiles', layers_from_index(index))   # again when new visits land
+    tiles = TilePyramid('skymap_tiles')
+    tiles.draw(ax, colors={'patch': 'gray', 'ccd': 'violet'})
+
+where ``index`` is a :class:`stackclub.spatial.SpatialIndex`. The same tiles
+can feed a HoloViews ``DynamicMap``, as in the
+``Visualization/bokeh_holoviews_datashader`` notebook::
+
+    def patches(x_range, y_range):
+        view = tiles.view('patch', x_range[0], x_range[1], y_range[0], y_range[1])
+        return hv.Polygons([{'x': p[:, 0], 'y': p[:, 1]} for p in tiles.polygons(view)])
+    hv.DynamicMap(patches, streams=[hv.streams.RangeXY()])
+"""
+import os, io, json, shutil
+from functools import lru_cache
+import numpy as np
+from .skyplot import coverage_image
+from .cache import write_atomic
+
+TILE_PIXELS = 256    # tile width and height, in screen pixels
+TOP_TILE = 90.0      # width of a level 0 tile, in degrees
+MAX_LEVEL = 12
+# Coverage images are made at most this level of detail, to bound their size:
+MAX_COVERAGE_LEVEL = 3
+METADATA = 'pyramid.json'
+
+def tile_size(level):
+    """
+    Return the width (and height) of the tiles at a zoom level, in degrees.
+    """
+    return TOP_TILE / 2**level
+
+def _unwrap(ra):
+    """
+    Make each polygon continuous in RA, with its first vertex in [0, 360).
+    """
+    ra = np.asarray(ra, dtype=float)
+    return np.mod(ra[:, :1], 360.0) + np.mod(ra - ra[:, :1] + 180.0, 360.0) - 180.0
+
+def _assign(bounds, level):
+    """
+    Find the tiles at a zoom level that each polygon's bounding box overlaps.
+
+    Returns
+    -------
+    polygon, column, row: numpy arrays of ints
+        One entry per (polygon, tile) pair. The columns are not wrapped, so
+        that a polygon crossing RA=360 has columns beyond the last one.
+    """
+    size = tile_size(level)
+    ra_lo, ra_hi, dec_lo, dec_hi = bounds
+    nrows = 2 * 2**level
+    i0, i1 = np.floor(ra_lo / size).astype(int), np.floor(ra_hi / size).astype(int)
+    j0 = np.clip(np.floor((dec_lo + 90.0) / size).astype(int), 0, nrows - 1)
+    j1 = np.clip(np.floor((dec_hi + 90.0) / size).astype(int), 0, nrows - 1)
+    ni, nj = i1 - i0 + 1, j1 - j0 + 1
+    polygon = np.repeat(np.arange(len(ra_lo)), ni * nj)
+    # Position of each pair within its polygon's block of tiles:
+    k = np.arange(len(polygon)) - np.repeat(np.cumsum(ni * nj) - ni * nj, ni * nj)
+    column = i0[polygon] + k % ni[polygon]
+    row = j0[polygon] + k // ni[polygon]
+    return polygon, column, row
+
+def _gather(vertices, starts, which):
+    """
+    Pick some polygons out of a flat (vertices, starts) list.
+    """
+    lengths = starts[which + 1] - starts[which]
+    new_starts = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    take = np.repeat(starts[which] - new_starts[:-1], lengths) + np.arange(new_starts[-1])
+    return vertices[take], new_starts
+
+def _save(path, **arrays):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    write_atomic(path, buffer.getvalue())
+    return
+
+def _coverage_tiles(folder, ra, dec, bounds, levels, tile_pixels):
+    """
+    Save the coverage image tiles of a layer, for zoom levels ``levels``.
+
+    The image is made once, at the finest of the levels, for each level 0
+    tile in turn, and then averaged down 2x2 at a time for the coarser ones.
+    """
+    written = {level: [] for level in levels}
+    npix = tile_pixels * 2**max(levels)
+    pixel = TOP_TILE / npix
+    polygon, column, row = _assign(bounds, 0)
+    for top in sorted(set(zip(np.mod(column, 4).tolist(), row.tolist()))):
+        inside = np.unique(polygon[(np.mod(column, 4) == top[0]) & (row == top[1])])
+        start = top[0] * TOP_TILE
+        counts, ra_edges, dec_edges = coverage_image(ra[inside], dec[inside], pixel_size=pixel * 60.0, start=start)
+        if counts.size == 0:
+            continue
+        # Sample the (equal area) coverage grid at the centers of the tile pixels:
+        centers = (np.arange(npix) + 0.5) * pixel
+        c = np.searchsorted(ra_edges, np.mod(start + centers - ra_edges[0], 360.0) + ra_edges[0], side='right') - 1
+        r = np.searchsorted(dec_edges, -90.0 + top[1] * TOP_TILE + centers, side='right') - 1
+        good_c = (c >= 0) & (c < counts.shape[1])
+        good_r = (r >= 0) & (r < counts.shape[0])
+        image = np.zeros((npix, npix), dtype=np.float32)
+        image[np.ix_(good_r, good_c)] = counts[np.ix_(r[good_r], c[good_c])]
+        for level in sorted(levels, reverse=True):
+            n = 2**level
+            blocks = image.reshape(n, tile_pixels, n, tile_pixels)
+            for j, i in zip(*np.nonzero(blocks.max(axis=(1, 3)))):
+                i_all, j_all = top[0] * n + i, top[1] * n + j
+                path = os.path.join(folder, str(level), '{}_{}.npz'.format(i_all, j_all))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _save(path, counts=blocks[j, :, i, :])
+                written[level].append([int(i_all), int(j_all)])
+            # Half the resolution for the next level up:
+            half = image.shape[0] // 2
+            image = image.reshape(half, 2, half, 2).mean(axis=(1, 3))
+    return written
+
+def _polygon_tiles(folder, ra, dec, bounds, level, tile_pixels):
+    """
+    Save the outline tiles of a layer at one zoom level.
+
+    The vertices are rounded to the tile pixels, and then repeated vertices
+    dropped, and polygons that have become identical (the same field
+    observed again, say) merged, keeping a count of them.
+    """
+    size = tile_size(level)
+    pixel = size / tile_pixels
+    ncolumns = 4 * 2**level
+    q = np.stack([np.round(ra / pixel), np.round(dec / pixel)], axis=-1).astype(np.int64)
+    _, first, count = np.unique(q.reshape(len(q), -1), axis=0, return_index=True, return_counts=True)
+    q = q[first]
+    keep = np.any(q != np.roll(q, 1, axis=1), axis=-1)
+    keep[:, 0] |= ~keep.any(axis=1)
+    starts = np.concatenate([[0], np.cumsum(keep.sum(axis=1))]).astype(np.int64)
+    vertices = (q[keep] * pixel).astype(np.float32)
+    polygon, column, row = _assign(tuple(b[first] for b in bounds), level)
+    shift = -360.0 * (column // ncolumns)
+    column = np.mod(column, ncolumns)
+    order = np.lexsort((polygon, row, column))
+    polygon, column, row, shift = polygon[order], column[order], row[order], shift[order]
+    breaks = np.nonzero(np.diff(column * (2 * 2**level) + row))[0] + 1
+    written = []
+    for group in np.split(np.arange(len(polygon)), breaks):
+        if len(group) == 0:
+            continue
+        which = polygon[group]
+        v, s = _gather(vertices, starts, which)
+        v[:, 0] += np.repeat(shift[group], np.diff(s)).astype(np.float32)
+        i, j = int(column[group[0]]), int(row[group[0]])
+        path = os.path.join(folder, str(level), '{}_{}.npz'.format(i, j))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _save(path, vertices=v, starts=s.astype(np.int32), index=first[which].astype(np.int32),
+              count=count[which].astype(np.int32))
+        written.append([i, j])
+    return written
+
+def build_tiles(folder, layers, max_level=None, min_pixels=8, tile_pixels=TILE_PIXELS, vb=False):
+    """
+    Precompute a tile pyramid of some layers of sky polygons.
+
+    Parameters
+    ----------
+    folder: string
+        Where to put the tiles. Layers already there that are not being
+        rebuilt are kept.
+    layers: dict
+        Layer name (e.g. 'tract', 'patch', 'ccd') -> dict of the layer's
+        polygons: their vertices ``'ra'`` and ``'dec'`` (shape (N, K), in
+        degrees) and, optionally, their ``'dataIds'`` (as returned by
+        :func:`stackclub.footprints.load_footprints`).
+    max_level: int, optional
+        The most detailed zoom level [def=3 levels beyond the one where the
+        smallest layer's polygons first appear as outlines]. A level ``z``
+        tile is ``90/2**z`` degrees across.
+    min_pixels: float, optional
+        Polygons are shown as outlines once they are about this many tile
+        pixels across, and as a coverage image before that [def=8].
+    tile_pixels: int, optional
+        Width of a tile, in pixels [def=256].
+    vb: boolean, optional
+        Print the number of tiles written for each layer [def=False].
+
+    Returns
+    -------
+    pyramid: TilePyramid
+        The pyramid, ready for viewing.
+
+    Notes
+    -----
+    Each tile is a small compressed ``.npz`` file, ``<layer>/<level>/<i>_<j>.npz``
+    (``i`` counting RA columns from RA=0, ``j`` Dec rows from the South
+    pole), and only tiles with something in them are written. The list of
+    tiles goes into ``pyramid.json``, so viewers never look for missing ones.
+    Polygons around a pole are not supported.
+    """
+    sizes, data = {}, {}
+    for name, layer in layers.items():
+        ra = _unwrap(np.atleast_2d(layer['ra']))
+        dec = np.atleast_2d(np.asarray(layer['dec'], dtype=float))
+        bounds = (ra.min(axis=1), ra.max(axis=1), dec.min(axis=1), dec.max(axis=1))
+        width = np.maximum((bounds[1] - bounds[0]) * np.cos(np.radians(dec.mean(axis=1))), bounds[3] - bounds[2])
+        sizes[name] = np.median(width) if len(width) else TOP_TILE
+        data[name] = (ra, dec, bounds, layer.get('dataIds'))
+    polygon_levels = {name: int(np.clip(np.ceil(np.log2(TOP_TILE * min_pixels / (max(size, 1e-6) * tile_pixels))),
+                                        0, MAX_COVERAGE_LEVEL + 1))
+                      for name, size in sizes.items()}
+    if max_level is None:
+        max_level = min(max(polygon_levels.values(), default=0) + 3, MAX_LEVEL)
+
+    path = os.path.join(folder, METADATA)
+    metadata = {'tile_pixels': tile_pixels, 'top_tile': TOP_TILE, 'layers': {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            old = json.load(f)
+        if old.get('tile_pixels') == tile_pixels:
+            metadata = old
+    for name, (ra, dec, bounds, dataIds) in data.items():
+        layer_folder = os.path.join(folder, name)
+        shutil.rmtree(layer_folder, ignore_errors=True)
+        os.makedirs(layer_folder)
+        polygon_level = min(polygon_levels[name], max_level)
+        tiles = {}
+        if len(ra) > 0:
+            if polygon_level > 0:
+                coverage = _coverage_tiles(layer_folder, ra, dec, bounds, list(range(polygon_level)), tile_pixels)
+                tiles.update({str(level): found for level, found in coverage.items()})
+            for level in range(polygon_level, max_level + 1):
+                tiles[str(level)] = _polygon_tiles(layer_folder, ra, dec, bounds, level, tile_pixels)
+        if dataIds is not None:
+            write_atomic(os.path.join(layer_folder, 'dataIds.json'),
+                         json.dumps(list(dataIds), default=str).encode('utf-8'))
+        metadata['layers'][name] = {'count': len(ra), 'polygon_level': polygon_level,
+                                    'max_level': max_level, 'tiles': tiles}
+        if vb:
+            print("{}: {} polygons in {} tiles, outlines from level {} to {}".format(
+                name, len(ra), sum(len(found) for found in tiles.values()), polygon_level, max_level))
+    write_atomic(path, json.dumps(metadata).encode('utf-8'))
+    return TilePyramid(folder)
+
+def layers_from_index(index, kinds=('tract', 'patch', 'ccd')):
+    """
+    Collect the polygons in a :class:`stackclub.spatial.SpatialIndex` into layers for :func:`build_tiles`.
+
+    Parameters
+    ----------
+    index: stackclub.spatial.SpatialIndex
+        The index, holding the skymap and visit geometry.
+    kinds: list of strings, optional
+        The kinds of region to make layers of [def=tracts, patches and CCDs].
+
+    Returns
+    -------
+    layers: dict
+        Kind -> dict of the regions' ``'ra'``, ``'dec'`` and ``'dataIds'``,
+        for each kind in the index.
+    """
+    layers = {}
+    for kind in kinds:
+        rows = index.conn.execute('select dataId, ra, dec from regions where kind = ? order by id', (kind,)).fetchall()
+        if not rows:
+            continue
+        ra = [np.frombuffer(row[1]) for row in rows]
+        dec = [np.frombuffer(row[2]) for row in rows]
+        # Pad any polygons with fewer vertices by repeating their last one:
+        K = max(len(r) for r in ra)
+        pad = lambda v: np.concatenate([v, np.repeat(v[-1:], K - len(v))])
+        layers[kind] = {'ra': np.array([pad(r) for r in ra]), 'dec': np.array([pad(d) for d in dec]),
+                        'dataIds': [json.loads(row[0]) for row in rows]}
+    return layers
+
+class TilePyramid(object):
+    """
+    Read the tiles of a pyramid made by :func:`build_tiles` that are in view.
+
+    Parameters
+    ----------
+    folder: string
+        The pyramid's folder.
+    max_tiles: int, optional
+        Number of tiles to keep in memory, for panning back and forth [def=2048].
+
+    Notes
+    -----
+    The zoom level is chosen so that a tile pixel is about a screen pixel,
+    so a view needs at most a few tens of tiles, however big the survey.
+    """
+    def __init__(self, folder, max_tiles=2048):
+        self.folder = folder
+        with open(os.path.join(folder, METADATA)) as f:
+            self.metadata = json.load(f)
+        self.tile_pixels = self.metadata['tile_pixels']
+        self.layers = self.metadata['layers']
+        self._tiles = {name: {int(level): set(map(tuple, found)) for level, found in layer['tiles'].items()}
+                       for name, layer in self.layers.items()}
+        self._dataIds = {}
+        self._read = lru_cache(maxsize=max_tiles)(self._read_tile)
+        return
+
+    def __repr__(self):
+        return "<TilePyramid {}: {}>".format(self.folder, ', '.join(
+            '{}: {}'.format(name, layer['count']) for name, layer in self.layers.items()))
+
+    def _read_tile(self, name, level, i, j):
+        with np.load(os.path.join(self.folder, name, str(level), '{}_{}.npz'.format(i, j))) as tile:
+            return {key: tile[key] for key in tile.files}
+
+    def level(self, ra_min, ra_max, pixels=1000):
+        """
+        Return the zoom level for a view ``ra_max - ra_min`` degrees across, drawn ``pixels`` wide.
+        """
+        width = max(abs(ra_max - ra_min), 1e-6)
+        level = int(np.round(np.log2(TOP_TILE * pixels / (self.tile_pixels * width))))
+        return max(level, 0)
+
+    def tiles_in_view(self, level, ra_min, ra_max, dec_min, dec_max):
+        """
+        Return the (unwrapped column, row) of the tiles at a zoom level that overlap an RA, Dec box.
+        """
+        size = tile_size(level)
+        ra_min, ra_max = sorted((ra_min, ra_max))
+        dec_min, dec_max = sorted((dec_min, dec_max))
+        if ra_max - ra_min >= 360.0:
+            ra_min, ra_max = 0.0, 360.0 - 1e-9
+        nrows = 2 * 2**level
+        j0 = min(max(int(np.floor((dec_min + 90.0) / size)), 0), nrows - 1)
+        j1 = min(max(int(np.floor((dec_max + 90.0) / size)), 0), nrows - 1)
+        return [(i, j) for i in range(int(np.floor(ra_min / size)), int(np.floor(ra_max / size)) + 1)
+                for j in range(j0, j1 + 1)]
+
+    def view(self, name, ra_min, ra_max, dec_min, dec_max, pixels=1000):
+        """
+        Load what there is to see of a layer in an RA, Dec box.
+
+        Parameters
+        ----------
+        name: string
+            The layer, e.g. 'patch'.
+        ra_min, ra_max, dec_min, dec_max: floats
+            The view, in degrees (e.g. a plot's ``xlim`` and ``ylim``).
+        pixels: int, optional
+            Width of the plot, in screen pixels [def=1000].
+
+        Returns
+        -------
+        view: dict
+            The ``'level'`` used, and its ``'kind'``. For ``'coverage'``,
+            an ``'image'`` (float array, rows going North) of the mean
+            number of polygons covering each pixel, and its ``'extent'``
+            (RA and Dec limits, for ``imshow``). For ``'polygons'``, the
+            outlines' ``'vertices'`` (shape (V, 2), RA and Dec, in the
+            view's RA range) and ``'starts'`` (the index of each one's first
+            vertex, plus one past the last), the ``'index'`` of each in the
+            layer, and the ``'count'`` of polygons merged into each.
+        """
+        layer = self.layers[name]
+        ra_min, ra_max = sorted((ra_min, ra_max))
+        dec_min, dec_max = sorted((dec_min, dec_max))
+        level = min(self.level(ra_min, ra_max, pixels), layer['max_level'])
+        found = self._tiles[name].get(level, set())
+        ncolumns = 4 * 2**level
+        in_view = [(i, j) for i, j in self.tiles_in_view(level, ra_min, ra_max, dec_min, dec_max)
+                   if (i % ncolumns, j) in found]
+        if level < layer['polygon_level']:
+            tiles = self.tiles_in_view(level, ra_min, ra_max, dec_min, dec_max)
+            size, n = tile_size(level), self.tile_pixels
+            i0, j0 = min(i for i, j in tiles), min(j for i, j in tiles)
+            i1, j1 = max(i for i, j in tiles), max(j for i, j in tiles)
+            image = np.zeros(((j1 - j0 + 1) * n, (i1 - i0 + 1) * n), dtype=np.float32)
+            for i, j in in_view:
+                image[(j - j0) * n:(j - j0 + 1) * n, (i - i0) * n:(i - i0 + 1) * n] = \
+                    self._read(name, level, i % ncolumns, j)['counts']
+            extent = (i0 * size, (i1 + 1) * size, -90.0 + j0 * size, -90.0 + (j1 + 1) * size)
+            return {'level': level, 'kind': 'coverage', 'image': image, 'extent': extent}
+        vertices, starts, index, count, seen, total = [], [np.zeros(1, np.int64)], [], [], set(), 0
+        for i, j in in_view:
+            tile = self._read(name, level, i % ncolumns, j)
+            # Polygons overlapping several tiles are in each of them:
+            new = np.array([k not in seen for k in tile['index'].tolist()], dtype=bool)
+            seen.update(tile['index'].tolist())
+            # Tiles can be much bigger than the view, so skip what's outside it:
+            tile_starts = tile['starts'].astype(np.int64)
+            ra, dec = tile['vertices'][:, 0] + 360.0 * (i // ncolumns), tile['vertices'][:, 1]
+            lo, hi = np.minimum.reduceat, np.maximum.reduceat
+            new &= ((hi(ra, tile_starts[:-1]) >= ra_min) & (lo(ra, tile_starts[:-1]) <= ra_max)
+                    & (hi(dec, tile_starts[:-1]) >= dec_min) & (lo(dec, tile_starts[:-1]) <= dec_max))
+            if not new.any():
+                continue
+            v, s = _gather(tile['vertices'], tile_starts, np.nonzero(new)[0])
+            v = v.astype(float)
+            v[:, 0] += 360.0 * (i // ncolumns)
+            vertices.append(v)
+            starts.append(s[1:] + total)
+            total += s[-1]
+            index.append(tile['index'][new])
+            count.append(tile['count'][new])
+        return {'level': level, 'kind': 'polygons',
+                'vertices': np.concatenate(vertices) if vertices else np.zeros((0, 2)),
+                'starts': np.concatenate(starts),
+                'index': np.concatenate(index) if index else np.zeros(0, dtype=np.int32),
+                'count': np.concatenate(count) if count else np.zeros(0, dtype=np.int32)}
+
+    @staticmethod
+    def polygons(view):
+        """
+        Split the outlines in a view into a list of (V, 2) vertex arrays, e.g. for a ``PolyCollection``.
+        """
+        if view['kind'] != 'polygons':
+            return []
+        return np.split(view['vertices'], view['starts'][1:-1])
+
+    def dataIds(self, name, index):
+        """
+        Return the dataIds of some of a layer's polygons, given their ``'index'`` in a view.
+        """
+        if name not in self._dataIds:
+            with open(os.path.join(self.folder, name, 'dataIds.json')) as f:
+                self._dataIds[name] = json.load(f)
+        return [self._dataIds[name][k] for k in np.atleast_1d(index)]
+
+    def draw(self, ax=None, layers=None, colors=None, cmap='Blues', pixels=None, **kwargs):
+        """
+        Draw some layers on a plot, and redraw them from the tiles in view whenever it is panned or zoomed.
+
+        Parameters
+        ----------
+        ax: matplotlib.axes.Axes, optional
+            The plot (with RA on the x axis, either way round) [def=the current one].
+        layers: list of strings, optional
+            The layers to draw [def=all of them].
+        colors: dict, optional
+            Layer name -> outline color [def=matplotlib's color cycle].
+        cmap: string, optional
+            Colormap for the coverage images [def='Blues'].
+        pixels: int, optional
+            Width of the plot, in screen pixels [def=from the figure].
+        kwargs: dict, optional
+            Passed on to the ``PolyCollection`` of outlines.
+
+        Returns
+        -------
+        update: function
+            Redraws the layers (called automatically on pan and zoom).
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import PolyCollection
+        from matplotlib.image import AxesImage
+        if ax is None:
+            ax = plt.gca()
+        if layers is None:
+            layers = list(self.layers)
+        cycle = plt.rcParams['axes.prop_cycle'].by_key().get('color', ['b'])
+        colors = dict({name: cycle[k % len(cycle)] for k, name in enumerate(layers)}, **(colors or {}))
+        kwargs.setdefault('linewidths', 0.5)
+        artists = {}
+
+        def update(*args):
+            (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+            width = pixels or max(int(ax.get_window_extent().width), 1)
+            for name in layers:
+                if name in artists:
+                    artists.pop(name).remove()
+                view = self.view(name, min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1), pixels=width)
+                if view['kind'] == 'coverage':
+                    artist = AxesImage(ax, cmap=cmap, origin='lower', extent=view['extent'],
+                                       interpolation='nearest', alpha=0.7)
+                    artist.set_data(np.ma.masked_equal(view['image'], 0))
+                    ax.add_image(artist)
+                else:
+                    artist = PolyCollection(self.polygons(view), closed=True, facecolors='none',
+                                            edgecolors=colors[name], **kwargs)
+                    ax.add_collection(artist, autolim=False)
+                artists[name] = artist
+            ax.figure.canvas.draw_idle()
+            return
+
+        update()
+        ax.callbacks.connect('xlim_changed', update)
+        ax.callbacks.connect('ylim_changed', update)
+        return update
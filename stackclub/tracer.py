@@ -0,0 +1,359 @@
+"""
+Find out where the time goes in a notebook: Butler I/O, WCS transforms, the
+``Taster`` and skymap helpers, or matplotlib.
+
+Put the slow cells' code in a ``with`` block::
+
+    from stackclub.tracer import Tracer
+    with Tracer(filename='trace.json') as tracer:
+        calexp = butler.get('calexp', visit=1228, ccd=49)
+        ...
+
+While the block runs, the functions and methods listed in ``TARGETS`` are
+wrapped so that every call is timed; at the end a summary table is shown, and
+a trace of all the calls is written to ``filename`` (if one is given), which you can load into
+Chrome's ``chrome://tracing`` (or https://ui.perfetto.dev) to see a timeline.
+"""
+import os, sys, json, math, time, threading, importlib
+from collections import defaultdict
+from .cache import write_atomic
+from .butlercache import sizeof
+
+BUTLER_METHODS = ['get', 'put', 'queryMetadata', 'subset', 'datasetExists', 'getUri', 'getKeys']
+
+# What gets traced, by category, as 'module:attribute' - the stackclub modules
+# are imported if need be, but the others are only traced if they have already
+# been imported (so import the Stack, and matplotlib, before the block):
+TARGETS = {
+    'butler': ['lsst.daf.persistence:Butler.' + method for method in BUTLER_METHODS],
+    'wcs': ['lsst.afw.geom:SkyWcs.pixelToSky', 'lsst.afw.geom:SkyWcs.skyToPixel',
+            'lsst.afw.geom:SkyWcs.pixelToSkyArray', 'lsst.afw.geom:SkyWcs.skyToPixelArray'],
+    'taster': ['stackclub.taster:Taster.what_exists', 'stackclub.taster:Taster.estimate_sky_area',
+               'stackclub.taster:Taster.count_things', 'stackclub.taster:Taster.plot_sky_coverage'],
+    'skymap': ['stackclub.skyarea:tract_vertices', 'stackclub.skyarea:polygon_areas',
+               'stackclub.skyarea:union_area', 'stackclub.skyplot:plot_polygons',
+               'stackclub.skyplot:coverage_image'],
+    'plot': ['matplotlib.backends.backend_agg:FigureCanvasAgg.draw', 'matplotlib.figure:Figure.savefig'],
+}
+
+# Latency histogram bins: four per decade, from 1 microsecond up.
+BINS_PER_DECADE = 4
+MIN_SECONDS = 1e-6
+
+class Tracer(object):
+    """
+    Context manager that times calls to the Butler, WCS, ``Taster``, skymap and plotting code.
+
+    Parameters
+    ----------
+    objects: Butlers, optional
+        Butler-like objects whose methods (``BUTLER_METHODS``) should be
+        traced too - e.g. a :class:`stackclub.butlercache.CachingButler`, or
+        a :class:`stackclub.synthetic.SyntheticButler`. Instances of the
+        real ``Butler`` class are traced anyway.
+    filename: string, optional
+        Where to write the Chrome trace at the end of the block [def=None,
+        don't write one - call :meth:`write_trace` later if you want it].
+    show: boolean, optional
+        Display the summary table at the end of the block [def=True].
+    targets: dict, optional
+        Lists of 'module:attribute' names to trace, by category [def=``TARGETS``].
+    max_events: int, optional
+        Most calls to keep for the trace file; calls after that still count
+        towards the summary [def=1,000,000].
+
+    Notes
+    -----
+    Times include the calls made inside each call, so for example a
+    ``Taster.count_things`` includes the Butler calls it made; the trace
+    timeline shows them nested. Bytes read are estimated from the sizes
+    of the objects returned by ``get`` (see :func:`stackclub.butlercache.sizeof`).
+    """
+    def __init__(self, *objects, filename=None, show=True, targets=None, max_events=1000000):
+        self.objects = objects
+        self.filename = filename
+        self.show = show
+        self.targets = TARGETS if targets is None else targets
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        # (category, name, dataset) -> [calls, seconds, max seconds, bytes, errors, {bin: calls}]
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0, 0, 0, defaultdict(int)])
+        self._patches = []
+        self._lock = threading.Lock()
+        self._t0 = self._t1 = None
+        return
+
+    def _wrap(self, function, category, name, is_method):
+        tracer = self
+        offset = 1 if is_method else 0
+
+        def traced(*args, **kwargs):
+            dataset = None
+            if category == 'butler':
+                dataset = kwargs.get('datasetType')
+                if dataset is None and len(args) > offset and isinstance(args[offset], str):
+                    dataset = args[offset]
+            start = time.perf_counter()
+            error = False
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            except BaseException:
+                error = True
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                nbytes = sizeof(result) if category == 'butler' and name.endswith('.get') and not error else 0
+                tracer._record(category, name, dataset, start, seconds, nbytes, error)
+
+        traced.__wrapped__ = function
+        traced.__name__ = getattr(function, '__name__', name)
+        traced.__doc__ = getattr(function, '__doc__', None)
+        return traced
+
+    def _record(self, category, name, dataset, start, seconds, nbytes, error):
+        b = int(math.floor(math.log10(max(seconds, MIN_SECONDS) / MIN_SECONDS) * BINS_PER_DECADE))
+        with self._lock:
+            stats = self.stats[(category, name, dataset)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += nbytes
+            stats[4] += error
+            stats[5][b] += 1
+            if len(self.events) < self.max_events:
+                self.events.append((category, name, dataset, start, seconds, nbytes, error,
+                                    threading.get_ident()))
+            else:
+                self.dropped += 1
+        return
+
+    def _patch(self, owner, attribute, category, name):
+        """
+        Replace ``owner.attribute`` by a traced version, remembering how to undo it.
+        """
+        is_class = isinstance(owner, type)
+        original = owner.__dict__.get(attribute) if hasattr(owner, '__dict__') else None
+        current = getattr(owner, attribute)
+        if any(patch[0] is owner and patch[1] == attribute for patch in self._patches):
+            return
+        if is_class and isinstance(original, (staticmethod, classmethod)):
+            # Leave these alone, rather than get the binding wrong.
+            return
+        traced = self._wrap(current, category, name, is_method=is_class)
+        try:
+            setattr(owner, attribute, traced)
+        except (AttributeError, TypeError):
+            # e.g. a built-in type
+            return
+        self._patches.append((owner, attribute, original, current, traced))
+        return
+
+    def _resolve(self, target):
+        module_name, attribute = target.split(':')
+        if module_name not in sys.modules:
+            if not module_name.startswith('stackclub'):
+                return None
+            module = importlib.import_module(module_name)
+        else:
+            module = sys.modules[module_name]
+        owner = module
+        parts = attribute.split('.')
+        for part in parts[:-1]:
+            owner = getattr(owner, part, None)
+            if owner is None:
+                return None
+        if not hasattr(owner, parts[-1]):
+            return None
+        return owner, parts[-1]
+
+    def start(self):
+        """
+        Start tracing (this is what entering the ``with`` block does).
+        """
+        self._t0, self._t1 = time.perf_counter(), None
+        for category, targets in self.targets.items():
+            for target in targets:
+                resolved = self._resolve(target)
+                if resolved is None:
+                    continue
+                owner, attribute = resolved
+                original = getattr(owner, attribute)
+                self._patch(owner, attribute, category, target.split(':')[1])
+                if not isinstance(owner, type):
+                    # Functions also live on in the modules that imported them by name:
+                    for module in list(sys.modules.values()):
+                        if getattr(module, '__name__', '').startswith('stackclub') and module is not owner \
+                                and getattr(module, attribute, None) is original:
+                            self._patch(module, attribute, category, target.split(':')[1])
+        for obj in self.objects:
+            label = type(obj).__name__
+            for method in BUTLER_METHODS:
+                if hasattr(obj, method):
+                    self._patch(obj, method, 'butler', label + '.' + method)
+        return self
+
+    def stop(self):
+        """
+        Stop tracing, putting back everything that was wrapped.
+        """
+        for owner, attribute, original, current, traced in reversed(self._patches):
+            try:
+                if original is None:
+                    delattr(owner, attribute)
+                else:
+                    setattr(owner, attribute, original)
+            except (AttributeError, TypeError):
+                setattr(owner, attribute, current)
+        self._patches = []
+        self._t1 = time.perf_counter()
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        if self.filename is not None:
+            self.write_trace(self.filename)
+        if self.show:
+            self.display()
+        return False
+
+    def histogram(self, name, dataset=None):
+        """
+        Return the latency histogram of the calls to one function or method.
+
+        Parameters
+        ----------
+        name: string
+            The traced name, e.g. ``'Butler.get'``.
+        dataset: string, optional
+            Only count the calls for this dataset type [def=all of them].
+
+        Returns
+        -------
+        edges: list of floats
+            Bin edges, in seconds (four bins per decade).
+        counts: list of ints
+            Number of calls taking between each pair of edges.
+        """
+        bins = defaultdict(int)
+        for (category, other, other_dataset), stats in self.stats.items():
+            if other == name and (dataset is None or other_dataset == dataset):
+                for b, n in stats[5].items():
+                    bins[b] += n
+        if not bins:
+            return [], []
+        lo, hi = min(bins), max(bins)
+        edges = [MIN_SECONDS * 10**(b / BINS_PER_DECADE) for b in range(lo, hi + 2)]
+        counts = [bins[b] for b in range(lo, hi + 1)]
+        return edges, counts
+
+    @staticmethod
+    def _quantile(bins, q):
+        """
+        Approximate quantile of a latency histogram (the middle of the bin it falls in).
+        """
+        total = sum(bins.values())
+        seen = 0
+        for b in sorted(bins):
+            seen += bins[b]
+            if seen >= q * total:
+                return MIN_SECONDS * 10**((b + 0.5) / BINS_PER_DECADE)
+        return 0.0
+
+    def summary(self):
+        """
+        Return the call statistics, slowest first.
+
+        Returns
+        -------
+        rows: list of dicts
+            One per traced function and dataset type, with the ``'category'``,
+            ``'name'``, ``'dataset'``, number of ``'calls'`` and ``'errors'``,
+            ``'total_seconds'``, ``'mean_seconds'``, ``'p50_seconds'``,
+            ``'p90_seconds'`` and ``'max_seconds'`` (the percentiles from the
+            histogram, so only good to a factor of 10**0.125), and ``'bytes'``.
+        """
+        rows = []
+        with self._lock:
+            items = [(key, list(stats[:5]), dict(stats[5])) for key, stats in self.stats.items()]
+        for (category, name, dataset), (calls, seconds, slowest, nbytes, errors), bins in items:
+            rows.append({'category': category, 'name': name, 'dataset': dataset,
+                         'calls': calls, 'errors': errors, 'total_seconds': seconds,
+                         'mean_seconds': seconds / calls, 'p50_seconds': min(self._quantile(bins, 0.5), slowest),
+                         'p90_seconds': min(self._quantile(bins, 0.9), slowest), 'max_seconds': slowest,
+                         'bytes': nbytes})
+        rows.sort(key=lambda row: -row['total_seconds'])
+        return rows
+
+    def table(self):
+        """
+        Return the summary (see :meth:`summary`) as a Markdown table.
+        """
+        elapsed = 0.0
+        if self._t0 is not None:
+            elapsed = (self._t1 or time.perf_counter()) - self._t0
+        table = "|   Call  | Dataset | Calls | Total (s) | Mean (ms) | Median (ms) | 90% (ms) | Max (ms) | MB | \n"
+        table += "  | :--- | --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: | \n "
+        for row in self.summary():
+            table += "| %s | %s | %d | %.3f | %.3g | %.3g | %.3g | %.3g | %s | \n" % (
+                row['name'], row['dataset'] or '', row['calls'], row['total_seconds'],
+                1e3 * row['mean_seconds'], 1e3 * row['p50_seconds'], 1e3 * row['p90_seconds'],
+                1e3 * row['max_seconds'], '%.1f' % (row['bytes'] / 1024**2) if row['bytes'] else '')
+        table += "| Whole block | | | %.3f | | | | | | \n" % elapsed
+        return table
+
+    def display(self):
+        """
+        Display the summary table (in a notebook, or printed otherwise).
+        """
+        try:
+            from IPython.display import display, Markdown
+            from IPython import get_ipython
+            if get_ipython() is None:
+                raise ImportError
+        except ImportError:
+            print(self.table())
+            return
+        display(Markdown(self.table()))
+        return
+
+    def trace_events(self):
+        """
+        Return the traced calls in the Chrome trace event format.
+
+        Returns
+        -------
+        trace: dict
+            With a ``'traceEvents'`` list of complete ('X') events, times in
+            microseconds from the start of the block.
+        """
+        pid = os.getpid()
+        t0 = self._t0 or 0.0
+        with self._lock:
+            events = list(self.events)
+        trace = []
+        for category, name, dataset, start, seconds, nbytes, error, tid in events:
+            args = {}
+            if dataset is not None:
+                args['dataset'] = dataset
+            if nbytes:
+                args['bytes'] = nbytes
+            if error:
+                args['error'] = True
+            trace.append({'name': name if dataset is None else '{} {}'.format(name, dataset),
+                          'cat': category, 'ph': 'X', 'ts': 1e6 * (start - t0), 'dur': 1e6 * seconds,
+                          'pid': pid, 'tid': tid, 'args': args})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms',
+                'otherData': {'dropped_events': self.dropped}}
+
+    def write_trace(self, filename):
+        """
+        Write the traced calls to a Chrome trace JSON file (see :meth:`trace_events`).
+        """
+        write_atomic(filename, json.dumps(self.trace_events()).encode('utf-8'))
+        return
@@ -1,8 +1,322 @@
-import os, sys
-import urllib.request
-import importlib
+import os, sys, json, time, shutil, hashlib, threading, ast
+import urllib.request, urllib.error, urllib.parse
+import http.client
+import importlib, importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from .cache import write_atomic
 
-def wimport(url, vb=False):
+class DownloadCache(object):
+    """
+    Content-addressed store of downloaded files, revalidated with conditional requests.
+
+    Parameters
+    ----------
+    folder: string
+        Where to keep the cache.
+    ttl: float, optional
+        For this many seconds after a download (or revalidation), the cached
+        copy is used without contacting the server at all [def=300].
+    max_age: float, optional
+        Forget files that have not been used for this many seconds [def=30 days].
+    max_bytes: int, optional
+        Keep the cache below this size, forgetting the least recently used
+        files first [def=256 MB].
+
+    Notes
+    -----
+    Each file is stored once, under the SHA-256 hash of its contents, in
+    ``<folder>/objects``; ``<folder>/index.json`` maps each URL to its current
+    contents, along with the ``ETag`` and ``Last-Modified`` headers the server
+    sent. Once the ``ttl`` has expired, the next request for the URL is sent
+    with ``If-None-Match`` / ``If-Modified-Since`` headers, so that an
+    unchanged file costs a "304 Not Modified" rather than a download.
+    """
+    def __init__(self, folder, ttl=300, max_age=30*24*3600, max_bytes=256*1024*1024):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._index = None
+        # get() can be called from several threads at once:
+        self._lock = threading.RLock()
+
+    @property
+    def index(self):
+        with self._lock:
+            return self._load_index()
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.folder, 'index.json')) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def object_path(self, digest):
+        """
+        Return the path to the cached file with SHA-256 hex digest ``digest``.
+        """
+        return os.path.join(self.folder, 'objects', digest)
+
+    def get(self, url, offline=False, vb=False):
+        """
+        Return the path to an up to date copy of the file at ``url``.
+
+        Parameters
+        ----------
+        url: string
+            Web address of the file.
+        offline: boolean, optional
+            Only use the cache, never the network [def=False].
+        vb: boolean, optional
+            Verbose in operation [def=False]
+
+        Returns
+        -------
+        path: string
+            Path to the cached file (which should not be modified).
+        status: string
+            How the file was obtained: ``'downloaded'``, ``'not modified'``
+            (revalidated with the server), ``'fresh'`` (within the ``ttl``),
+            ``'offline'``, or ``'stale'`` (the server could not be reached).
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                entry = dict(entry)
+        if entry is not None and not os.path.exists(self.object_path(entry['sha256'])):
+            entry = None
+        now = time.time()
+
+        if entry is not None and (offline or now - entry['checked'] < self.ttl):
+            status = 'offline' if offline else 'fresh'
+        elif offline:
+            raise IOError("{} is not in the download cache, and we are offline".format(url))
+        else:
+            headers = {}
+            if entry is not None:
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+            try:
+                code, response_headers, body = _fetch(url, headers)
+            except (urllib.error.URLError, OSError, http.client.HTTPException) as error:
+                if entry is None:
+                    raise
+                if vb: print("WARNING: could not reach {} ({}), using cached copy".format(url, error))
+                code = None
+            if code is None:
+                status = 'stale'
+            elif code == 304:
+                status = 'not modified'
+                entry['checked'] = now
+            else:
+                status = 'downloaded'
+                entry = {'sha256': hashlib.sha256(body).hexdigest(), 'size': len(body), 'checked': now,
+                         'etag': response_headers.get('ETag'),
+                         'last_modified': response_headers.get('Last-Modified')}
+
+        entry['used'] = now
+        with self._lock:
+            # Write the file and index it in one go, so that no other
+            # thread's prune() sees it unindexed and deletes it:
+            path = self.object_path(entry['sha256'])
+            if status == 'downloaded' and not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_atomic(path, body)
+            self.index[url] = entry
+            self.prune(now)
+            self.save()
+        return self.object_path(entry['sha256']), status
+
+    def prune(self, now=None):
+        """
+        Forget files that are too old, or that don't fit in ``max_bytes``.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._prune(now)
+        return
+
+    def _prune(self, now):
+        index = self.index
+        for url in [url for url, entry in index.items() if now - entry['used'] > self.max_age]:
+            del index[url]
+        # Least recently used last, so we can pop them off the end:
+        urls = sorted(index, key=lambda url: index[url]['used'], reverse=True)
+        sizes = {index[url]['sha256']: index[url]['size'] for url in urls}
+        while urls and sum(sizes.values()) > self.max_bytes:
+            del index[urls.pop()]
+            sizes = {index[url]['sha256']: index[url]['size'] for url in urls}
+        # Delete the files that no URL refers to any more:
+        objects = os.path.join(self.folder, 'objects')
+        if os.path.isdir(objects):
+            for digest in os.listdir(objects):
+                # (files being written by write_atomic start with a dot)
+                if digest not in sizes and not digest.startswith('.'):
+                    try:
+                        os.remove(os.path.join(objects, digest))
+                    except OSError:
+                        pass
+        return
+
+    def save(self):
+        """
+        Write the index to disk.
+        """
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            write_atomic(os.path.join(self.folder, 'index.json'),
+                         json.dumps(self.index, indent=1, sort_keys=True).encode('utf-8'))
+        return
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections, shared between threads.
+
+    Parameters
+    ----------
+    max_per_host: int, optional
+        Maximum number of idle connections kept open to each server [def=8].
+    timeout: float, optional
+        Socket timeout, in seconds [def=30].
+
+    Notes
+    -----
+    Fetching a dozen files from the same server then costs one TCP (and TLS)
+    handshake per thread, rather than one per file. URLs that the
+    ``http_proxy``/``https_proxy`` environment variables send through a
+    proxy are fetched with urllib instead, as before.
+    """
+    def __init__(self, max_per_host=8, timeout=30):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, url, headers, max_redirects=5):
+        """
+        GET a URL, following redirects.
+
+        Returns
+        -------
+        code: int
+            The HTTP status code (200, or 304 for "Not Modified").
+        headers: http.client.HTTPMessage
+            The response headers (whose names are not case-sensitive).
+        body: bytes
+            The response body.
+
+        Raises
+        ------
+        urllib.error.HTTPError
+            For any other HTTP status.
+        """
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or _proxied(parts):
+                # e.g. file://, or through an http_proxy/https_proxy: leave it to urllib
+                return _urlopen(url, headers, self.timeout)
+            target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            while True:
+                connection, reused = self._connect(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', target, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    # The server may have closed an idle connection: try a fresh one.
+                    if not reused:
+                        raise
+            # (header names are case-insensitive, and servers do send e.g. "location")
+            response_headers = response.msg
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            location = response_headers.get('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status in (200, 304):
+                return response.status, response_headers, body
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, None)
+        raise urllib.error.HTTPError(url, response.status, "too many redirects", response.msg, None)
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+        return
+
+def _proxied(parts):
+    """
+    Return True if the environment sets a proxy for a URL (split with ``urllib.parse.urlsplit``).
+    """
+    proxies = urllib.request.getproxies()
+    if parts.scheme not in proxies:
+        return False
+    return not urllib.request.proxy_bypass(parts.hostname or '')
+
+def _urlopen(url, headers, timeout):
+    """
+    GET a URL with urllib, returning the status code, response headers and body.
+
+    The headers are returned as an ``http.client.HTTPMessage``, so that
+    looking them up is not case-sensitive.
+    """
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return getattr(response, 'status', None) or 200, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return 304, error.headers, b''
+        raise
+
+connection_pool = ConnectionPool()
+
+def _fetch(url, headers):
+    """
+    GET a URL, returning the status code, response headers and body.
+
+    A "304 Not Modified" response is returned, not raised.
+    """
+    return connection_pool.get(url, headers)
+
+# wimport's secret local cache:
+modulefolder = ".downloads"
+download_cache = DownloadCache(os.path.join(modulefolder, '.cache'))
+
+def wimport(url, vb=False, offline=None):
     """
     Download a module and import it.
     
@@ -12,6 +326,9 @@ def wimport(url, vb=False):
         Web address of the target module
     vb: boolean, optional
         Verbose in operation [def=False]
+    offline: boolean, optional
+        Import from the local cache, without going online 
+        [def=True if the ``STACKCLUB_OFFLINE`` environment variable is set]
     
     Returns
     -------
@@ -23,7 +340,11 @@ def wimport(url, vb=False):
     :mod:`wimport` maintains a secret local cache of downloaded modules, 
     hidden from the user so that they are not tempted to edit the 
     module locally. (If they need to do that, they should clone
-    the relevant repo.)
+    the relevant repo.) Modules are only downloaded again if they have 
+    changed on the server: see :class:`DownloadCache`. Each URL's module
+    is kept in its own sub-folder of ``.downloads``, so modules from two URLs
+    with the same file name don't overwrite each other (although only one
+    of them can be imported at a time).
     
     Examples
     --------
@@ -35,24 +356,67 @@ def wimport(url, vb=False):
     >>> so = wimport(where_is_url, vb=True)
     >>> so.where_is(Butler.get, in_the='source')
     """
+    if offline is None:
+        offline = bool(os.environ.get('STACKCLUB_OFFLINE'))
 
     # First set up wimport's .downloads directory and prepare to 
     # download the module into it:
+    modulepath = _prepare(url)
+    
+    # Get the file from the cache (which downloads it if necessary), and 
+    # put it where it can be imported from:
+    cachedpath, status = download_cache.get(url, offline=offline, vb=vb)
+    changed = _install(cachedpath, modulepath)
+    
+    return _import(url, modulepath, changed, status, vb)
+
+def _prepare(url):
+    """
+    Make a .downloads sub-folder for the module at ``url``, and return the path it will be imported from.
+
+    Each URL gets its own sub-folder, so that two URLs with the same file
+    name do not overwrite each other's copies.
+    """
     a = urllib.parse.urlparse(url)
     modulefile = os.path.basename(a.path)
-    modulefolder = ".downloads"
-    if not os.path.exists(modulefolder):
-        os.makedirs(modulefolder)
-    sys.path.append(modulefolder)
-    modulepath = modulefolder+'/'+modulefile
-    
-    # Get the file, over-writing anything that is already there:
-    urllib.request.urlretrieve(url, modulepath)
+    folder = os.path.join(modulefolder, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+    # (wimport_many calls this from several threads at once)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.abspath(os.path.join(folder, modulefile))
+
+def _load(modulename, modulepath):
+    """
+    Import the module (or notebook) in the file ``modulepath`` as ``modulename``.
+    """
+    loader = None
+    if modulepath.endswith('.ipynb'):
+        from .nbimport import NotebookLoader
+        loader = NotebookLoader()
+    spec = importlib.util.spec_from_file_location(modulename, modulepath, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    # Register it first, as the import system does, so that modules
+    # importing it while it runs get this one:
+    sys.modules[modulename] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(modulename, None)
+        raise
+    return module
 
-    # Now import the module, and add it to the global namespace:
-    modulename = os.path.splitext(modulefile)[0]
+def _import(url, modulepath, changed, status, vb):
+    """
+    Import a downloaded module, importing it again if it has changed.
+    """
+    # Now import the module, and add it to the global namespace. The
+    # download folders are not on sys.path, so it is imported from its
+    # file, and later "import modulename" statements find it in sys.modules:
+    modulename = os.path.splitext(os.path.basename(modulepath))[0]
     try:
-        globals()[modulename] = importlib.import_module(modulename)
+        module = sys.modules.get(modulename)
+        if changed or module is None or getattr(module, '__file__', None) != modulepath:
+            module = _load(modulename, modulepath)
+        globals()[modulename] = module
     except:
         print("WARNING: module was downloaded to {} but cound not be imported.")
         print("Returning path to module: {}".format(modulepath))
@@ -60,10 +424,140 @@ def wimport(url, vb=False):
     
     # Report to the user:
     if vb: 
-        print("Imported external module '{}' (downloaded from {} and stored in {})".format(modulename, url, modulepath))
+        print("Imported external module '{}' ({} from {} and stored in {})".format(modulename, status, url, modulepath))
         # print("Module file contains the following lines: ")
         # with open(modulepath, 'r') as fin:
         #     print(fin.read(), end="")
 
     # Pass back the module, so it can be named and then used by the user.
-    return globals()[modulename]
\ No newline at end of file
+    return globals()[modulename]
+
+def _install(cachedpath, modulepath):
+    """
+    Copy a cached file to ``modulepath``, unless it is already there. Returns True if it was copied.
+    """
+    if os.path.exists(modulepath) and os.path.getsize(modulepath) == os.path.getsize(cachedpath):
+        with open(modulepath, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == os.path.basename(cachedpath):
+                return False
+    shutil.copyfile(cachedpath, modulepath + '.tmp')
+    os.replace(modulepath + '.tmp', modulepath)
+    importlib.invalidate_caches()
+    return True
+
+def wimport_many(urls, vb=False, offline=None, max_workers=8):
+    """
+    Download several modules at once, and import them all.
+    
+    Parameters
+    ----------
+    urls: list of strings
+        Web addresses of the target modules (or notebooks).
+    vb: boolean, optional
+        Verbose in operation [def=False]
+    offline: boolean, optional
+        Import from the local cache, without going online 
+        [def=True if the ``STACKCLUB_OFFLINE`` environment variable is set]
+    max_workers: int, optional
+        Number of downloads to run at the same time [def=8].
+    
+    Returns
+    -------
+    modules: list of modules
+        The imported modules, in the same order as ``urls``. (As with 
+        :func:`wimport`, a module that could not be imported is replaced 
+        by the path to its file.)
+    report: list of dicts
+        For each URL: the ``'url'``, the ``'status'`` of the download 
+        (see :meth:`DownloadCache.get`), the time it took (``'seconds'``), 
+        and the number of ``'bytes'`` downloaded.
+    
+    Notes
+    -----
+    The downloads run in a pool of threads, sharing keep-alive connections.
+    The modules are then imported so that any that import each other come
+    in the right order.
+    
+    Examples
+    --------
+    >>> from stackclub import wimport_many
+    >>> (so, mpl), report = wimport_many([where_is_url, mpl_url], vb=True)
+    """
+    if offline is None:
+        offline = bool(os.environ.get('STACKCLUB_OFFLINE'))
+    
+    def download(url):
+        start = time.perf_counter()
+        modulepath = _prepare(url)
+        cachedpath, status = download_cache.get(url, offline=offline, vb=vb)
+        nbytes = os.path.getsize(cachedpath) if status == 'downloaded' else 0
+        return modulepath, cachedpath, status, \
+            {'url': url, 'status': status, 'seconds': time.perf_counter() - start, 'bytes': nbytes}
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        downloads = list(pool.map(download, urls))
+    
+    if vb:
+        for modulepath, cachedpath, status, stats in downloads:
+            print("{url}: {status}, {bytes} bytes in {seconds:.3f}s".format(**stats))
+    
+    # Put all the files in place before importing any of them, in case they import each other:
+    changed = [_install(cachedpath, modulepath) for modulepath, cachedpath, status, stats in downloads]
+    modules = [None] * len(urls)
+    for i in _import_order([modulepath for modulepath, cachedpath, status, stats in downloads]):
+        modulepath, cachedpath, status, stats = downloads[i]
+        modules[i] = _import(urls[i], modulepath, changed[i], status, vb)
+    return modules, [stats for modulepath, cachedpath, status, stats in downloads]
+
+def _import_order(modulepaths):
+    """
+    Return the indices of some downloaded modules, sorted so that each comes after the others it imports.
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in modulepaths]
+    requires = []
+    for path in modulepaths:
+        imported = set()
+        for tree in _parse_module(path):
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    imported.update(alias.name.split('.')[0] for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    imported.add(node.module.split('.')[0])
+        requires.append([j for j, name in enumerate(names) if name in imported and modulepaths[j] != path])
+    
+    order, visiting, done = [], set(), set()
+    def visit(i):
+        # (an import cycle is broken at the module we started from)
+        if i in done or i in visiting:
+            return
+        visiting.add(i)
+        for j in requires[i]:
+            visit(j)
+        visiting.discard(i)
+        done.add(i)
+        order.append(i)
+    for i in range(len(modulepaths)):
+        visit(i)
+    return order
+
+def _parse_module(path):
+    """
+    Parse a downloaded python module or notebook, returning a list of syntax trees.
+    """
+    try:
+        if path.endswith('.ipynb'):
+            from .nbstream import read_code_cells
+            sources, digest = read_code_cells(path)
+        else:
+            with open(path, 'rb') as f:
+                sources = [f.read()]
+    except (OSError, ValueError):
+        return []
+    trees = []
+    for source in sources:
+        try:
+            trees.append(ast.parse(source))
+        except (SyntaxError, ValueError):
+            # e.g. a notebook cell with some IPython magic in it
+            continue
+    return trees
@@ -0,0 +1,19 @@
+"""
+Regression checks on "import stackclub": it must stay quick, and lazy.
+
+Run them with ``python -m pytest tests`` from the top of the repo.
+"""
+import os, sys, subprocess
+from stackclub.benchmarks import check_import_time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_time():
+    # Raises AssertionError if "import stackclub" got slow, or pulled in numpy, IPython etc:
+    check_import_time()
+
+def test_star_import():
+    script = ("from stackclub import *\n"
+              "print(wimport.__name__, where_is.__name__, Taster.__name__)\n")
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO)
+    assert output.decode().split() == ['wimport', 'where_is', 'Taster']
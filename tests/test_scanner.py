@@ -0,0 +1,25 @@
+"""
+Checks on the repo scanner, against ``glob``.
+
+Run them with ``python -m pytest tests`` from the top of the repo.
+"""
+import os, glob
+from stackclub.scanner import scan
+
+def test_scan_matches_glob(tmp_path):
+    # A small repo-like tree, with a hidden file and an empty folder:
+    for path in ['calexp/v100-fr/R22/S11.fits', 'calexp/v100-fr/R22/S12.fits', 'calexp/v101-fg/R23/S00.fits',
+                 'src/v100-fr/R22/S11.fits', 'registry.sqlite3', 'calexp/.hidden/x.fits', 'deep/a/b/c/d.txt']:
+        os.makedirs(os.path.dirname(os.path.join(str(tmp_path), path)), exist_ok=True)
+        open(os.path.join(str(tmp_path), path), 'w').close()
+    os.makedirs(os.path.join(str(tmp_path), 'empty'))
+    root = str(tmp_path)
+    # (A pattern ending in "**" finds only directories, unlike glob, so is left out.)
+    for pattern in ['*', 'calexp/*/*/*.fits', 'calexp/v10[01]-f?/R22/*', '**/*.fits', '**/S11.fits',
+                    'calexp/**/*', 'deep/**/*.txt', 'src/v100-fr', 'nothing/*']:
+        wanted = sorted(os.path.relpath(path, root) for path in glob.glob(os.path.join(root, pattern), recursive=True))
+        assert scan(root, pattern, max_workers=2) == wanted
+    files = [os.path.relpath(path, root) for path in glob.glob(os.path.join(root, '**', '*'), recursive=True)
+             if os.path.isfile(path)]
+    assert scan(root) == sorted(files)
+    assert scan(root, '*', dirs=True) == ['calexp', 'deep', 'empty', 'src']
@@ -0,0 +1,43 @@
+"""
+Checks on the sky area calculations, against areas worked out by hand.
+
+Run them with ``python -m pytest tests`` from the top of the repo.
+"""
+import numpy as np
+from stackclub.skyarea import SQDEG, polygon_areas, union_area
+
+def box(ra_min, ra_max, dec_min, dec_max, n=1):
+    # An RA, Dec box with n great circle arcs along each side:
+    t = np.arange(n) / n
+    ra = np.concatenate([ra_min + (ra_max - ra_min) * t, np.full(n, ra_max),
+                         ra_max - (ra_max - ra_min) * t, np.full(n, ra_min)])
+    dec = np.concatenate([np.full(n, dec_min), dec_min + (dec_max - dec_min) * t,
+                          np.full(n, dec_max), dec_max - (dec_max - dec_min) * t])
+    return ra[None, :], dec[None, :]
+
+def test_box_area():
+    # With its sides cut into short arcs, a box is as good as bounded by
+    # lines of constant RA and Dec, whose area we know:
+    exact = np.radians(10.0) * (np.sin(np.radians(10.0)) - 0.0) * SQDEG
+    assert abs(polygon_areas(*box(0.0, 10.0, 0.0, 10.0, n=200))[0] - exact) < 1e-3
+    # The pixel count estimate is good to a fraction of a percent,
+    # wherever the box is, including across RA=0:
+    for ra_min, dec_min in [(0.0, 0.0), (355.0, 0.0), (123.0, -47.0), (200.0, 79.0)]:
+        ra, dec = box(ra_min, ra_min + 10.0, dec_min, dec_min + 10.0)
+        area = polygon_areas(ra, dec)[0]
+        assert abs(union_area(ra % 360.0, dec, pixel_size=2.0) - area) < 0.005 * area
+
+def test_overlapping_union():
+    # Three of the four triangles made from the corners of a box overlap,
+    # and between them cover the box and nothing else:
+    ra, dec = box(20.0, 30.0, -40.0, -30.0)
+    corners = [[0, 1, 2], [1, 2, 3], [2, 3, 0]]
+    triangles = ra[0][corners], dec[0][corners]
+    area = polygon_areas(ra, dec)[0]
+    assert polygon_areas(*triangles).sum() > 1.4 * area
+    assert abs(union_area(*triangles, pixel_size=2.0) - area) < 0.01 * area
+    # The same polygon twice counts once, and polygons that don't touch add up:
+    twice = np.concatenate([ra, ra]), np.concatenate([dec, dec])
+    assert union_area(*twice, pixel_size=2.0) == union_area(ra, dec, pixel_size=2.0)
+    apart = np.concatenate([ra, ra + 90.0]), np.concatenate([dec, dec])
+    assert abs(union_area(*apart, pixel_size=2.0) - 2 * area) < 0.01 * area
@@ -0,0 +1,67 @@
+"""
+Checks on the spatial index queries, against brute force on random polygons.
+
+Run them with ``python -m pytest tests`` from the top of the repo.
+"""
+import numpy as np
+from stackclub.skyarea import unit_vectors
+from stackclub.spatial import SpatialIndex
+
+# How close to the edge of a query a region can be and still go either way, in degrees:
+SLACK = 0.05
+
+def random_quads(rng, n):
+    # Small quadrilaterals, up to a degree across, on both sides of RA=0:
+    ra0, dec0 = rng.uniform(-20.0, 20.0, n), rng.uniform(-50.0, 50.0, n)
+    h = rng.uniform(0.05, 0.5, n)[:, None]
+    w = h / np.cos(np.radians(dec0))[:, None]
+    ra = np.mod(ra0[:, None] + w * np.array([-1, 1, 1, -1]), 360.0)
+    dec = dec0[:, None] + h * np.array([-1, -1, 1, 1])
+    return ra, dec
+
+def samples(ra, dec, n=21):
+    # Points all over each quadrilateral (edges included), as unit vectors, shape (N, n*n, 3):
+    v = unit_vectors(ra, dec)
+    s, t = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    s, t = s.ravel()[None, :, None], t.ravel()[None, :, None]
+    p = ((1 - s) * (1 - t) * v[:, None, 0] + s * (1 - t) * v[:, None, 1]
+         + s * t * v[:, None, 2] + (1 - s) * t * v[:, None, 3])
+    return p / np.linalg.norm(p, axis=-1, keepdims=True)
+
+def make_index(seed=12, n=500):
+    rng = np.random.default_rng(seed)
+    ra, dec = random_quads(rng, n)
+    index = SpatialIndex(pixel_size=3.0)
+    index.add('ccd', ra, dec, [{'visit': i, 'ccd': 0} for i in range(n)])
+    return rng, index, samples(ra, dec)
+
+def test_query_cone():
+    rng, index, points = make_index()
+    found = 0
+    for trial in range(50):
+        ra, dec, radius = rng.uniform(-20.0, 20.0), rng.uniform(-50.0, 50.0), rng.uniform(0.5, 5.0)
+        center = unit_vectors(ra % 360.0, dec)
+        nearest = np.degrees(np.arccos(np.clip(points @ center, -1.0, 1.0))).min(axis=1)
+        got = {region['visit'] for region in index.query_cone(ra % 360.0, dec, radius)}
+        assert set(np.flatnonzero(nearest < radius - SLACK)) <= got
+        assert got <= set(np.flatnonzero(nearest < radius + SLACK))
+        found += len(got)
+    assert found > 50
+
+def test_query_box():
+    rng, index, points = make_index()
+    ra = np.degrees(np.arctan2(points[..., 1], points[..., 0]))
+    dec = np.degrees(np.arcsin(points[..., 2]))
+    found = 0
+    for trial in range(50):
+        # Boxes bigger than the quadrilaterals, so that if they overlap, a corner is in the box:
+        ra_min, dec_min = rng.uniform(-25.0, 20.0), rng.uniform(-55.0, 45.0)
+        width, height = rng.uniform(2.0, 10.0), rng.uniform(2.0, 10.0)
+        got = {region['visit'] for region in
+               index.query_box(ra_min % 360.0, (ra_min + width) % 360.0, dec_min, dec_min + height)}
+        def inside(slack):
+            return set(np.flatnonzero(((np.mod(ra - ra_min + slack, 360.0) <= width + 2 * slack)
+                                       & (dec >= dec_min - slack) & (dec <= dec_min + height + slack)).any(axis=1)))
+        assert inside(-SLACK) <= got <= inside(SLACK)
+        found += len(got)
+    assert found > 50
@@ -0,0 +1,41 @@
+"""
+Checks on the tile pyramid views, against a bounding box filter of the polygons.
+
+Run them with ``python -m pytest tests`` from the top of the repo.
+"""
+import numpy as np
+from stackclub.tiles import build_tiles, tile_size
+
+def test_view(tmp_path):
+    # Small quadrilaterals, up to a degree across, on both sides of RA=0:
+    rng = np.random.default_rng(25)
+    n = 500
+    ra0, dec0 = rng.uniform(-20.0, 20.0, n), rng.uniform(-50.0, 50.0, n)
+    h = rng.uniform(0.05, 0.5, n)[:, None]
+    w = h / np.cos(np.radians(dec0))[:, None]
+    ra = np.mod(ra0[:, None] + w * np.array([-1, 1, 1, -1]), 360.0)
+    dec = dec0[:, None] + h * np.array([-1, -1, 1, 1])
+    tiles = build_tiles(str(tmp_path), {'ccd': {'ra': ra, 'dec': dec}})
+    # Each polygon's bounding box, going up in RA from somewhere in [0, 360):
+    lo = np.mod(ra0 - w[:, 0], 360.0)
+    hi, dec_lo, dec_hi = lo + 2 * w[:, 0], dec0 - h[:, 0], dec0 + h[:, 0]
+    found = 0
+    for trial in range(30):
+        ra_min, dec_min = rng.uniform(-25.0, 20.0), rng.uniform(-55.0, 45.0)
+        ra_max, dec_max = ra_min + rng.uniform(1.0, 10.0), dec_min + rng.uniform(1.0, 10.0)
+        view = tiles.view('ccd', ra_min, ra_max, dec_min, dec_max)
+        assert view['kind'] == 'polygons'
+        got = set(view['index'].tolist())
+        assert len(got) == len(view['index'])
+        # The outlines are rounded to the tile pixels:
+        slack = tile_size(view['level']) / tiles.tile_pixels
+
+        def overlapping(slack):
+            ra_overlap = np.zeros(n, dtype=bool)
+            for shift in (-360.0, 0.0, 360.0):
+                ra_overlap |= (hi + shift >= ra_min - slack) & (lo + shift <= ra_max + slack)
+            return set(np.flatnonzero(ra_overlap & (dec_hi >= dec_min - slack) & (dec_lo <= dec_max + slack)))
+
+        assert overlapping(-slack) <= got <= overlapping(slack)
+        found += len(got)
+    assert found > 50